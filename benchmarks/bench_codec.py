@@ -0,0 +1,45 @@
+'''Decode throughput of the available Cirrus codecs on recorded SubscribeData frames.
+
+Run from the repository root:
+
+    python benchmarks/bench_codec.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from custom_components.yanzi import codec  # noqa: E402
+
+FRAMES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'subscribe_data.jsonl')
+ROUNDS = 2000
+
+
+def load_frames():
+    with open(FRAMES_PATH) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    frames = load_frames()
+    total_bytes = sum(len(frame) for frame in frames) * ROUNDS
+
+    codecs = [codec.JsonCodec()]
+    if codec.orjson is not None:
+        codecs.append(codec.OrjsonCodec())
+
+    print(f'{"codec":>8} {"frames/s":>12} {"MB/s":>8}')
+    for c in codecs:
+        def run():
+            for _ in range(ROUNDS):
+                for frame in frames:
+                    c.loads(frame)
+
+        elapsed = min(timeit.repeat(run, number=1, repeat=3))
+        print(f'{c.name:>8} {len(frames) * ROUNDS / elapsed:>12.0f} '
+              f'{total_bytes / elapsed / 1e6:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''Compare per-sample dispatch cost of bus broadcasting and the keyed dispatcher.
+
+Run from the repository root:
+
+    python benchmarks/bench_dispatch.py
+'''
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from custom_components.yanzi.dispatcher import YanziDispatcher  # noqa: E402
+
+SAMPLES = 10000
+ENTITY_COUNTS = [10, 100, 1000, 2000]
+
+
+def make_keys(count):
+    return [f'EUI64-GW/123456/EUI64-{i:08d}-3/temperatureC/0' for i in range(count)]
+
+
+def broadcast(keys):
+    '''The old behaviour: every entity filters every sample.'''
+    seen = []
+    listeners = []
+    for key in keys:
+        def filter_data(event, key=key):
+            if event['key'] == key:
+                seen.append(event['sample'])
+        listeners.append(filter_data)
+
+    def run():
+        for i in range(SAMPLES):
+            event = {'key': keys[i % len(keys)], 'sample': i}
+            for listener in listeners:
+                listener(event)
+
+    return run
+
+
+def keyed(keys):
+    seen = []
+    dispatcher = YanziDispatcher()
+    for key in keys:
+        dispatcher.subscribe(key, seen.append)
+
+    def run():
+        for i in range(SAMPLES):
+            dispatcher.dispatch(keys[i % len(keys)], i)
+
+    return run
+
+
+def main():
+    print(f'{"entities":>10} {"broadcast us/sample":>22} {"keyed us/sample":>18}')
+    for count in ENTITY_COUNTS:
+        keys = make_keys(count)
+        results = []
+        for make in (broadcast, keyed):
+            elapsed = min(timeit.repeat(make(keys), number=1, repeat=3))
+            results.append(elapsed / SAMPLES * 1e6)
+        print(f'{count:>10} {results[0]:>22.3f} {results[1]:>18.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''Allocations and time per sample of turning SubscribeData frames into batches.
+
+Compares key derivation with `dsa_to_key` plus the old temperatureK to
+temperatureC emulation, which copied every temperature sample, against the
+KeyIndex lookup used by YanziLocation.watch. Allocations are counted with
+tracemalloc as the blocks and bytes per sample that the batches hold on to.
+
+Run from the repository root:
+
+    python benchmarks/bench_keys.py
+'''
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from custom_components.yanzi.location import KeyIndex, dsa_to_key, message_to_batch  # noqa: E402
+
+FRAMES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'subscribe_data.jsonl')
+ROUNDS = 5000
+
+
+def load_messages():
+    with open(FRAMES_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def emulating_message_to_batch(message, last_seen=None):
+    '''message_to_batch as it was, with a fresh key and a copied temperatureC sample.'''
+    batch = []
+    for sample_list in message.get('list', []):
+        dsa = sample_list['dataSourceAddress']
+        key = dsa_to_key(dsa)
+
+        if last_seen is not None and sample_list.get('list'):
+            last_seen[key] = max(
+                last_seen.get(key, 0),
+                max(sample.get('sampleTime', 0) for sample in sample_list['list']))
+
+        emulated_key = None
+        if dsa['variableName']['name'] == 'temperatureK':
+            emulated_key = dsa_to_key({
+                **dsa,
+                'variableName': {
+                    **dsa['variableName'],
+                    'name': 'temperatureC'
+                }
+            })
+
+        for sample in sample_list.get('list', []):
+            batch.append((key, sample))
+
+            if emulated_key is not None:
+                batch.append((emulated_key, {
+                    **sample,
+                    'value': round(sample['value'] - 273.15, 2)
+                }))
+
+    return batch
+
+
+def measure(name, to_batch, messages, samples):
+    last_seen = {}
+
+    def run():
+        for _ in range(ROUNDS):
+            for message in messages:
+                to_batch(message, last_seen)
+
+    elapsed = min(timeit.repeat(run, number=1, repeat=3))
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    batches = [to_batch(message, last_seen) for _ in range(ROUNDS) for message in messages]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in diff)
+    size = sum(stat.size_diff for stat in diff)
+    # The list of batches itself is not part of the per sample cost.
+    blocks -= 1
+    size -= sys.getsizeof(batches)
+
+    total = samples * ROUNDS
+    print(f'{name:>10} {elapsed / total * 1e9:>10.0f} {blocks / total:>12.2f} {size / total:>12.1f}')
+
+
+def main():
+    messages = load_messages()
+    samples = sum(len(sample_list['list']) for message in messages for sample_list in message['list'])
+
+    # The inventory knows every key before samples arrive.
+    keys = KeyIndex()
+    for message in messages:
+        for sample_list in message['list']:
+            keys.add(dsa_to_key(sample_list['dataSourceAddress']))
+
+    print(f'{"":>10} {"ns/sample":>10} {"blocks/sample":>12} {"bytes/sample":>12}')
+    measure('before', emulating_message_to_batch, messages, samples)
+    measure('after', lambda message, last_seen: message_to_batch(message, last_seen, keys), messages, samples)
+
+
+if __name__ == '__main__':
+    main()
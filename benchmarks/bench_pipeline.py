@@ -0,0 +1,162 @@
+'''End-to-end throughput of the Cirrus pipeline against a local fake Cirrus.
+
+Each stage is measured on its own connection for `--duration` seconds:
+
+    cirrus    Cirrus.subscribe frames as they come off the socket
+    watch     YanziLocation.watch batches
+    dispatch  YanziLocation.watch + DerivedVariables + YanziDispatcher to
+              one listener per source that updates the source like an
+              entity does
+
+Every stage counts each received sample once, also when it reaches several
+listeners or derived samples are emitted from it, so samples/s compares
+across stages. Latency is sample-to-consumer time, for dispatch until all
+listeners of the sample are done. CPU is process time over wall time
+(the fake server runs in the same process and is included). Run from the
+repository root:
+
+    python benchmarks/bench_pipeline.py --sources 2000 --rate 5000
+'''
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from custom_components.yanzi.cirrus import connect  # noqa: E402
+from custom_components.yanzi.location import YanziLocation, message_to_batch  # noqa: E402
+from custom_components.yanzi.pool import CirrusPool  # noqa: E402
+from fake_cirrus import FakeCirrus, LOCATION_ID  # noqa: E402
+
+
+class Result:
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        self.latencies = []
+
+    def observe(self, sample):
+        self.samples += 1
+        if 'benchSent' in sample:
+            self.latencies.append(time.perf_counter() - sample['benchSent'])
+
+    def quantile(self, q):
+        if not self.latencies:
+            return float('nan')
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+
+SUBSCRIBE_REQUEST = {
+    'messageType': 'SubscribeRequest',
+    'unitAddress': {'resourceType': 'UnitAddress', 'locationId': LOCATION_ID},
+    'subscriptionType': {'resourceType': 'SubscriptionType', 'name': 'data'},
+}
+
+
+async def run_cirrus(uri, result):
+    async with connect(uri.format(host='bench')) as ws:
+        await ws.authenticate({'accessToken': 'bench'})
+        async for message in ws.subscribe(SUBSCRIBE_REQUEST):
+            for key, sample in message_to_batch(message):
+                result.observe(sample)
+
+
+async def run_watch(uri, result):
+    location = YanziLocation('bench', {'accessToken': 'bench'}, LOCATION_ID, pool=CirrusPool(uri))
+    try:
+        async for batch in location.watch():
+            for key, sample in batch:
+                result.observe(sample)
+    finally:
+        location.unload()
+
+
+async def run_dispatch(uri, result):
+    location = YanziLocation('bench', {'accessToken': 'bench'}, LOCATION_ID, pool=CirrusPool(uri))
+    try:
+        async for added in location.get_device_sources():
+            pass
+
+        for device, source in location.device_sources:
+            def on_sample(sample, source=source):
+                source.latest = sample
+            location.dispatcher.subscribe(source.sample_key, on_sample)
+
+        async for batch in location.watch():
+            for key, sample in batch:
+                location.derived.update(key, sample, location.dispatcher.dispatch)
+                location.dispatcher.dispatch(key, sample)
+                result.observe(sample)
+    finally:
+        location.unload()
+
+
+STAGES = {
+    'cirrus': run_cirrus,
+    'watch': run_watch,
+    'dispatch': run_dispatch,
+}
+
+
+async def run_stage(name, args):
+    fake = FakeCirrus(args.sources, args.rate, args.samples_per_frame)
+    server, uri = await fake.serve()
+    result = Result(name)
+
+    if args.memory:
+        tracemalloc.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    task = asyncio.create_task(STAGES[name](uri, result))
+    await asyncio.sleep(args.duration)
+    # On Python 3.11 asyncio.wait_for can swallow a cancellation that races
+    # with its result, so cancel until the stage has actually stopped.
+    while not task.done():
+        task.cancel()
+        await asyncio.wait({task}, timeout=1)
+    if not task.cancelled() and task.exception() is not None:
+        raise task.exception()
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+
+    server.close()
+    await server.wait_closed()
+
+    print(f'{name:>10} {result.samples / wall:>12.0f} {result.quantile(0.5):>9.2f} '
+          f'{result.quantile(0.99):>9.2f} {cpu / wall * 100:>6.1f}% '
+          f'{"" if peak is None else f"{peak / 1e6:>8.1f}"}')
+
+
+async def main(args):
+    print(f'{args.sources} sources, {args.rate} samples/s offered, '
+          f'{args.samples_per_frame} samples per frame')
+    print(f'{"stage":>10} {"samples/s":>12} {"p50 ms":>9} {"p99 ms":>9} {"cpu":>7} '
+          f'{"peak MB" if args.memory else ""}')
+    for name in args.stages:
+        await run_stage(name, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sources', type=int, default=2000)
+    parser.add_argument('--rate', type=int, default=2000, help='samples per second')
+    parser.add_argument('--samples-per-frame', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=5, help='seconds per stage')
+    parser.add_argument('--memory', action='store_true', help='trace peak memory (much slower, use a lower --rate)')
+    parser.add_argument('stages', nargs='*', default=list(STAGES),
+                        help=f'stages to run, any of {", ".join(STAGES)}')
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage {stage}')
+    asyncio.run(main(args))
@@ -0,0 +1,175 @@
+'''A local stand-in for a Cirrus server, for benchmarks.
+
+It serves a synthetic location with `sources` data sources, answers
+LoginRequest, PeriodicRequest, GraphQLRequest (with paging),
+GetSamplesRequest and SubscribeRequest, and streams SubscribeData frames at
+`rate` samples per second once subscribed. Frames are built from the
+recorded ones in data/subscribe_data.jsonl, spread over all sources, and
+every sample carries a `benchSent` perf_counter timestamp so consumers in
+the same process can measure latency.
+'''
+import asyncio
+import copy
+import json
+import os
+import re
+import time
+
+import websockets
+
+FRAMES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'subscribe_data.jsonl')
+
+GATEWAY_DID = 'EUI64-0090DAFFFF0040F1'
+LOCATION_ID = '123456'
+SOURCES_PER_DEVICE = 4
+TICK = 0.01
+
+
+def load_templates():
+    with open(FRAMES_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class FakeCirrus:
+    def __init__(self, sources=1000, rate=1000, samples_per_frame=1, location_id=LOCATION_ID):
+        self.location_id = location_id
+        self.rate = rate
+        self.samples_per_frame = samples_per_frame
+        self.sent = 0
+
+        templates = [t['list'][0] for t in load_templates()]
+        self.devices = []
+        self.frames = []
+        for i in range(max(1, sources // SOURCES_PER_DEVICE)):
+            did = f'EUI64-0090DAFF{i:08X}'
+            device = {
+                'key': f'unit-{did}',
+                'productType': '0090DA0301010522',
+                'name': f'Bench {i}',
+                'lifeCycleState': 'present',
+                'assetParent': {'name': f'Room {i % 50}'},
+                'unitAddress': {'did': did, 'serverDid': GATEWAY_DID},
+                'dataSources': [],
+                'chassisChildren': [],
+            }
+            for template in templates[:SOURCES_PER_DEVICE]:
+                dsa = {
+                    **template['dataSourceAddress'],
+                    'did': did,
+                    'serverDid': GATEWAY_DID,
+                    'locationId': location_id,
+                }
+                device['dataSources'].append({
+                    'key': '/'.join([GATEWAY_DID, location_id, did,
+                                     dsa['variableName']['name'], str(dsa['instanceNumber'])]),
+                    'variableName': dsa['variableName']['name'],
+                    'siUnit': 'NA',
+                })
+                self.frames.append((dsa, template['list'][0]))
+            self.devices.append(device)
+
+    async def serve(self, host='127.0.0.1', port=0):
+        '''Start serving, returns the server and the uri format for CirrusPool.'''
+        server = await websockets.serve(self._handler, host, port)
+        port = server.sockets[0].getsockname()[1]
+        return server, f'ws://{host}:{port}/cirrusAPI'
+
+    async def _handler(self, ws, path=None):
+        streams = []
+        try:
+            async for raw in ws:
+                request = json.loads(raw)
+                response = self._respond(request)
+                await ws.send(json.dumps(response))
+
+                if request['messageType'] == 'SubscribeRequest':
+                    streams.append(asyncio.create_task(self._stream(ws)))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for stream in streams:
+                stream.cancel()
+
+    def _respond(self, request):
+        response = {
+            'messageType': request['messageType'].replace('Request', 'Response'),
+            'messageIdentifier': request.get('messageIdentifier'),
+            'responseCode': {'resourceType': 'ResponseCode', 'name': 'success'},
+        }
+        message_type = request['messageType']
+
+        if message_type == 'LoginRequest':
+            response['sessionId'] = 'bench-session'
+        elif message_type == 'SubscribeRequest':
+            response['expireTime'] = int((time.time() + 3600) * 1000)
+        elif message_type == 'GraphQLRequest':
+            response['result'] = json.dumps({'data': {'location': self._graphql(request['query'])}})
+        elif message_type == 'GetSamplesRequest':
+            variable_name = request['dataSourceAddress']['variableName']['name']
+            sample = next((s for dsa, s in self.frames
+                           if dsa['variableName']['name'] == variable_name), {'value': 0})
+            response['sampleListDto'] = {
+                'resourceType': 'SampleList',
+                'list': [{**sample, 'sampleTime': int(time.time() * 1000)}],
+            }
+
+        return response
+
+    def _graphql(self, query):
+        first = int(re.search(r'first: (\d+)', query).group(1))
+        after = re.search(r'after: "([^"]*)"', query)
+        start = int(after.group(1)) + 1 if after else 0
+        page = self.devices[start:start + first]
+
+        location = {
+            'units': {
+                'cursor': str(start + len(page) - 1),
+                'endCursor': str(len(self.devices) - 1),
+                'list': copy.deepcopy(page),
+            },
+        }
+        if 'gateway' in query:
+            location['gateway'] = {
+                'key': 'gateway',
+                'productType': '0090DA0301020422',
+                'name': 'Bench gateway',
+                'lifeCycleState': 'present',
+                'unitAddress': {'did': GATEWAY_DID, 'serverDid': GATEWAY_DID},
+                'dataSources': [],
+            }
+        if 'inventory' in query:
+            location['inventory'] = {'list': [
+                {'key': device['key'], 'version': '1.0.0'} for device in self.devices
+            ] + [{'key': 'gateway', 'version': '1.0.0'}]}
+
+        return location
+
+    async def _stream(self, ws):
+        index = 0
+        budget = 0
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(TICK)
+            now = time.perf_counter()
+            budget += (now - last) * self.rate
+            last = now
+
+            while budget >= self.samples_per_frame:
+                dsa, sample = self.frames[index % len(self.frames)]
+                index += 1
+                sample_time = int(time.time() * 1000)
+                frame = {
+                    'messageType': 'SubscribeData',
+                    'timeSent': sample_time,
+                    'list': [{
+                        'resourceType': 'SampleList',
+                        'dataSourceAddress': dsa,
+                        'list': [
+                            {**sample, 'sampleTime': sample_time, 'benchSent': time.perf_counter()}
+                            for _ in range(self.samples_per_frame)
+                        ],
+                    }],
+                }
+                await ws.send(json.dumps(frame))
+                self.sent += self.samples_per_frame
+                budget -= self.samples_per_frame
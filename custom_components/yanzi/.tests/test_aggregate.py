@@ -0,0 +1,49 @@
+"""Test the yanzi sample aggregation."""
+from operator import itemgetter
+
+from custom_components.yanzi.aggregate import Aggregator
+
+
+def test_flush_aggregates_subscribed_keys():
+    """Test only subscribed keys are buffered and each flush starts over."""
+    aggregator = Aggregator(size=4)
+    aggregates = []
+    remove = aggregator.subscribe("a", "a", itemgetter("value"), aggregates.append)
+
+    for value in [1, 2, 6, "bad"]:
+        aggregator.add("a", {"value": value})
+    aggregator.add("b", {"value": 100})
+    aggregator.flush()
+    aggregator.flush()
+
+    assert aggregates == [{"min": 1, "mean": 3, "max": 6, "count": 3}]
+    assert aggregator.latest == {"a": aggregates[0]}
+
+    remove()
+    assert aggregator.latest == {}
+
+
+def test_ring_buffer_keeps_latest_values():
+    """Test a burst larger than the buffer keeps the most recent values."""
+    aggregator = Aggregator(size=3)
+    aggregates = []
+    aggregator.subscribe("a", "a", itemgetter("value"), aggregates.append)
+
+    for value in range(10):
+        aggregator.add("a", {"value": value})
+    aggregator.flush()
+
+    assert aggregates == [{"min": 7, "mean": 8, "max": 9, "count": 10}]
+
+
+def test_several_aggregates_per_key():
+    """Test aggregates computed from the same samples are kept apart."""
+    aggregator = Aggregator()
+    aggregator.subscribe("raw", "a", itemgetter("value"), lambda aggregate: None)
+    aggregator.subscribe("double", "a", lambda sample: sample["value"] * 2, lambda aggregate: None)
+
+    aggregator.add("a", {"value": 1})
+    aggregator.flush()
+
+    assert aggregator.latest["raw"]["mean"] == 1
+    assert aggregator.latest["double"]["mean"] == 2
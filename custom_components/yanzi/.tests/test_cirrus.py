@@ -0,0 +1,235 @@
+"""Test the yanzi Cirrus consumer queues and response routing."""
+import asyncio
+import json
+import time
+
+import pytest
+
+from custom_components.yanzi.cirrus import COALESCE, DISCONNECT, Cirrus, ConsumerQueue, SlowConsumerError
+
+
+def drain(q):
+    async def run():
+        items = []
+        while len(q):
+            items.append(await q.get())
+        return items
+
+    return asyncio.run(run())
+
+
+def frame(location_id, value):
+    return {
+        "messageType": "SubscribeData",
+        "list": [{"dataSourceAddress": {"locationId": location_id, "did": "A"}, "value": value}],
+    }
+
+
+def test_drop_oldest_when_full():
+    """Test a full queue drops its oldest frame by default."""
+    q = ConsumerQueue(2)
+    for item in [1, 2, 3]:
+        q.put_nowait(item)
+
+    assert q.dropped == 1
+    assert drain(q) == [2, 3]
+
+
+def test_coalesce_replaces_frame_with_same_key():
+    """Test a full coalescing queue replaces a queued frame of the same key in place."""
+    q = ConsumerQueue(2, COALESCE, key=lambda item: item[0])
+    q.put_nowait(("a", 1))
+    q.put_nowait(("b", 1))
+    q.put_nowait(("a", 2))
+
+    assert q.coalesced == 1
+    assert q.dropped == 0
+
+    # Without a queued frame of its key the oldest one is dropped.
+    q.put_nowait(("c", 1))
+    assert q.dropped == 1
+    assert drain(q) == [("b", 1), ("c", 1)]
+
+    # Consumed frames no longer take part in coalescing.
+    q.put_nowait(("x", 1))
+    q.put_nowait(("y", 1))
+    q.put_nowait(("c", 2))
+    assert q.coalesced == 1
+    assert q.dropped == 2
+    assert drain(q) == [("y", 1), ("c", 2)]
+
+
+def test_disconnect_slow_consumer():
+    """Test a full disconnecting queue stops its consumer and ignores later frames."""
+    q = ConsumerQueue(1, DISCONNECT)
+    q.put_nowait(1)
+    q.put_nowait(2)
+    q.put_nowait(3)
+
+    assert q.disconnected
+    assert len(q) == 0
+    with pytest.raises(SlowConsumerError):
+        asyncio.run(q.get())
+
+
+def test_fail_after_queued_frames():
+    """Test a failed queue hands out its queued frames before raising."""
+    q = ConsumerQueue()
+    q.put_nowait(1)
+    q.fail(ConnectionError("gone"))
+
+    async def run():
+        assert await q.get() == 1
+        with pytest.raises(ConnectionError):
+            await q.get()
+
+    asyncio.run(run())
+
+
+def test_route_responses_and_frames():
+    """Test responses go to their request and other frames to the consumers of their location."""
+
+    async def run():
+        cirrus = Cirrus(None)
+        request = asyncio.get_running_loop().create_future()
+        stream = asyncio.Queue()
+        cirrus._pending["1"] = request
+        cirrus._pending["2"] = stream
+        watching = cirrus._add_consumer(location_id="123")
+        other = cirrus._add_consumer(location_id="456")
+        everything = cirrus._add_consumer()
+
+        cirrus._route({"messageIdentifier": {"messageId": "1"}, "value": 1})
+        cirrus._route({"messageIdentifier": {"messageId": "2"}, "value": 2})
+        cirrus._route({"messageIdentifier": {"messageId": "2"}, "value": 3})
+        cirrus._route(frame("123", 4))
+        cirrus._route({"messageIdentifier": {"messageId": "9"}, "locationAddress": {"locationId": "456"}})
+
+        assert request.result()["value"] == 1
+        assert [stream.get_nowait()["value"] for _ in range(stream.qsize())] == [2, 3]
+        assert len(watching) == 1
+        assert len(other) == 1
+        assert len(everything) == 2
+
+        cirrus._remove_consumer(other)
+        assert cirrus.stats["consumers"] == 2
+
+    asyncio.run(run())
+
+
+def test_fail_reaches_every_waiter():
+    """Test a failed connection fails pending requests, streams and consumers."""
+
+    async def run():
+        cirrus = Cirrus(None)
+        request = asyncio.get_running_loop().create_future()
+        stream = asyncio.Queue()
+        cirrus._pending["1"] = request
+        cirrus._pending["2"] = stream
+        consumer = cirrus._add_consumer(location_id="123")
+        error = ConnectionError("gone")
+
+        cirrus._fail(error)
+
+        assert request.exception() is error
+        assert stream.get_nowait() is error
+        with pytest.raises(ConnectionError):
+            await consumer.get()
+        assert await cirrus.wait_closed() is error
+
+        # Consumers added later fail straight away, and so do new requests.
+        with pytest.raises(ConnectionError):
+            await cirrus._add_consumer().get()
+        with pytest.raises(ConnectionError):
+            await cirrus.request({"messageType": "PeriodicRequest"})
+
+    asyncio.run(run())
+
+
+class FakeWebSocket:
+    """Answers every request with the given number of responses, a moment apart."""
+
+    def __init__(self, cirrus, responses):
+        self.cirrus = cirrus
+        self.responses = responses
+
+    async def send(self, message):
+        message_id = json.loads(message)["messageIdentifier"]["messageId"]
+
+        async def respond():
+            for i in range(self.responses):
+                await asyncio.sleep(0.01)
+                self.cirrus._route({"messageIdentifier": {"messageId": message_id}, "part": i})
+
+        asyncio.get_running_loop().create_task(respond())
+
+
+def test_send_stops_when_responses_stop():
+    """Test send waits long for the first response and only `idle_timeout` for the rest."""
+
+    async def run():
+        cirrus = Cirrus(None)
+        cirrus.ws = FakeWebSocket(cirrus, 3)
+        start = time.monotonic()
+        parts = [response["part"] async for response in cirrus.send({"messageType": "GetLocationsRequest"}, 5, 0.05)]
+        return parts, time.monotonic() - start
+
+    parts, elapsed = asyncio.run(run())
+    assert parts == [0, 1, 2]
+    assert elapsed < 1
+
+
+class FakeSubscriptionSocket:
+    """Accepts SubscribeRequests that expire shortly, until `renewals` run out."""
+
+    def __init__(self, cirrus, renewals):
+        self.cirrus = cirrus
+        self.renewals = renewals
+
+    async def send(self, message):
+        message_id = json.loads(message)["messageIdentifier"]["messageId"]
+        result = "success" if self.renewals >= 0 else "error"
+        self.renewals -= 1
+        self.cirrus._route({
+            "messageIdentifier": {"messageId": message_id},
+            "messageType": "SubscribeResponse",
+            "responseCode": {"name": result},
+            "expireTime": (time.time() + 0.05) * 1000,
+        })
+
+
+@pytest.fixture
+def fast_timeouts(monkeypatch):
+    """Make every asyncio.wait_for timeout a thousand times shorter."""
+    wait_for = asyncio.wait_for
+
+    async def scaled(awaitable, timeout):
+        return await wait_for(awaitable, None if timeout is None else timeout / 1000)
+
+    monkeypatch.setattr(asyncio, "wait_for", scaled)
+
+
+def test_quiet_subscription_keeps_waiting(fast_timeouts):
+    """Test a subscription without data for minutes neither times out nor resubscribes."""
+
+    async def run():
+        cirrus = Cirrus(None)
+        cirrus.ws = FakeSubscriptionSocket(cirrus, 100)
+        async with cirrus.subscription({"messageType": "SubscribeRequest"}) as frames:
+            asyncio.get_running_loop().call_later(0.3, cirrus._route, frame("123", 1))
+            return await frames.__anext__()
+
+    assert asyncio.run(run())["list"][0]["value"] == 1
+
+
+def test_failed_renewal_ends_quiet_subscription():
+    """Test a renewal that fails ends the frames even when no data arrives."""
+
+    async def run():
+        cirrus = Cirrus(None)
+        cirrus.ws = FakeSubscriptionSocket(cirrus, 1)
+        async with cirrus.subscription({"messageType": "SubscribeRequest"}) as frames:
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(frames.__anext__(), 1)
+
+    asyncio.run(run())
@@ -1,13 +1,77 @@
 """Test the yanzi config flow."""
-from asynctest import patch
+import base64
+import contextlib
+from unittest.mock import patch
+
+import pytest
+from websockets.exceptions import InvalidHandshake
 
 from homeassistant import config_entries, setup
-from homeassistant.components.yanzi.config_flow import CannotConnect, InvalidAuth
-from homeassistant.components.yanzi.const import DOMAIN
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+from custom_components.yanzi import async_migrate_entry
+from custom_components.yanzi.accounts import async_get_accounts
+from custom_components.yanzi.const import DOMAIN
+
+LOCATIONS = {"123456": "Office", "654321": "Warehouse"}
+
+USER_INPUT = {
+    "host": "1.1.1.1",
+    "username": "test-username",
+    "password": "test-password",
+}
+
+ENTRY_DATA = {"host": "1.1.1.1", "username": "test-username"}
+LOGIN = {"username": "test-username", "password": "test-password"}
+
+
+@pytest.fixture(autouse=True)
+def auto_enable_custom_integrations(enable_custom_integrations):
+    yield
+
+
+class FakeCirrus:
+    """Answers the requests of the config flow, counting the connections made."""
+
+    connections = 0
+
+    def __init__(self, session_id="session"):
+        self.session_id = session_id
+
+    async def authenticate(self, credentials):
+        return self.session_id
+
+    async def send(self, request, timeout=30, idle_timeout=None):
+        # Listed in two parts, like a Cirrus with many locations.
+        for location_id, name in LOCATIONS.items():
+            yield {"list": [{"locationAddress": {"locationId": location_id}, "name": name}]}
+
+    async def request(self, request, timeout=5):
+        location_id = base64.b64decode(request["list"][0]["blobData"]).decode()
+        return {"list": [{"blobData": base64.b64encode(f"token-{location_id}".encode()).decode()}]}
+
+
+def fake_connect(cirrus):
+    @contextlib.asynccontextmanager
+    async def connect(uri):
+        FakeCirrus.connections += 1
+        yield cirrus
+
+    return connect
+
 
+@pytest.fixture
+def mock_setup():
+    with patch(
+        "custom_components.yanzi.async_setup", return_value=True
+    ) as mock_setup, patch(
+        "custom_components.yanzi.async_setup_entry", return_value=True,
+    ) as mock_setup_entry:
+        yield mock_setup, mock_setup_entry
 
-async def test_form(hass):
-    """Test we get the form."""
+
+async def test_form(hass, mock_setup):
+    """Test a location given up front is set up over a single connection."""
     await setup.async_setup_component(hass, "persistent_notification", {})
     result = await hass.config_entries.flow.async_init(
         DOMAIN, context={"source": config_entries.SOURCE_USER}
@@ -15,33 +79,23 @@ async def test_form(hass):
     assert result["type"] == "form"
     assert result["errors"] == {}
 
-    with patch(
-        "homeassistant.components.yanzi.config_flow.PlaceholderHub.authenticate",
-        return_value=True,
-    ), patch(
-        "homeassistant.components.yanzi.async_setup", return_value=True
-    ) as mock_setup, patch(
-        "homeassistant.components.yanzi.async_setup_entry", return_value=True,
-    ) as mock_setup_entry:
+    FakeCirrus.connections = 0
+    with patch("custom_components.yanzi.config_flow.connect", fake_connect(FakeCirrus())):
         result2 = await hass.config_entries.flow.async_configure(
-            result["flow_id"],
-            {
-                "host": "1.1.1.1",
-                "username": "test-username",
-                "password": "test-password",
-            },
+            result["flow_id"], {**USER_INPUT, "location_id": "123456"},
         )
 
     assert result2["type"] == "create_entry"
-    assert result2["title"] == "Name of the device"
+    assert result2["title"] == "Office (123456)"
     assert result2["data"] == {
-        "host": "1.1.1.1",
-        "username": "test-username",
-        "password": "test-password",
+        **ENTRY_DATA,
+        "location_id": "123456",
+        "access_token": "token-123456",
     }
+    assert await async_get_accounts(hass).async_login("1.1.1.1", "test-username") == LOGIN
+    assert FakeCirrus.connections == 1
     await hass.async_block_till_done()
-    assert len(mock_setup.mock_calls) == 1
-    assert len(mock_setup_entry.mock_calls) == 1
+    assert len(mock_setup[1].mock_calls) == 1
 
 
 async def test_form_invalid_auth(hass):
@@ -50,41 +104,140 @@ async def test_form_invalid_auth(hass):
         DOMAIN, context={"source": config_entries.SOURCE_USER}
     )
 
-    with patch(
-        "homeassistant.components.yanzi.config_flow.PlaceholderHub.authenticate",
-        side_effect=InvalidAuth,
-    ):
+    with patch("custom_components.yanzi.config_flow.connect", fake_connect(FakeCirrus(session_id=None))):
         result2 = await hass.config_entries.flow.async_configure(
-            result["flow_id"],
-            {
-                "host": "1.1.1.1",
-                "username": "test-username",
-                "password": "test-password",
-            },
+            result["flow_id"], {**USER_INPUT, "location_id": "123456"},
         )
 
     assert result2["type"] == "form"
     assert result2["errors"] == {"base": "invalid_auth"}
 
 
+async def test_form_invalid_location(hass):
+    """Test we handle a location the account has no access to."""
+    result = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": config_entries.SOURCE_USER}
+    )
+
+    with patch("custom_components.yanzi.config_flow.connect", fake_connect(FakeCirrus())):
+        result2 = await hass.config_entries.flow.async_configure(
+            result["flow_id"], {**USER_INPUT, "location_id": "999999"},
+        )
+
+    assert result2["type"] == "form"
+    assert result2["errors"] == {"base": "invalid_location"}
+
+
 async def test_form_cannot_connect(hass):
     """Test we handle cannot connect error."""
     result = await hass.config_entries.flow.async_init(
         DOMAIN, context={"source": config_entries.SOURCE_USER}
     )
 
-    with patch(
-        "homeassistant.components.yanzi.config_flow.PlaceholderHub.authenticate",
-        side_effect=CannotConnect,
-    ):
+    with patch("custom_components.yanzi.config_flow.connect", side_effect=InvalidHandshake):
         result2 = await hass.config_entries.flow.async_configure(
-            result["flow_id"],
-            {
-                "host": "1.1.1.1",
-                "username": "test-username",
-                "password": "test-password",
-            },
+            result["flow_id"], {**USER_INPUT, "location_id": "123456"},
         )
 
     assert result2["type"] == "form"
     assert result2["errors"] == {"base": "cannot_connect"}
+
+
+async def test_form_picks_several_locations(hass, mock_setup):
+    """Test all locations are listed without a location id, and several can be added at once."""
+    result = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": config_entries.SOURCE_USER}
+    )
+
+    with patch("custom_components.yanzi.config_flow.connect", fake_connect(FakeCirrus())):
+        result2 = await hass.config_entries.flow.async_configure(
+            result["flow_id"], USER_INPUT,
+        )
+
+        assert result2["type"] == "form"
+        assert result2["step_id"] == "locations"
+
+        result3 = await hass.config_entries.flow.async_configure(
+            result["flow_id"], {"location_ids": ["123456", "654321"]},
+        )
+        await hass.async_block_till_done()
+
+    assert result3["type"] == "create_entry"
+    assert result3["title"] == "Office (123456)"
+
+    entries = hass.config_entries.async_entries(DOMAIN)
+    assert sorted(entry.title for entry in entries) == ["Office (123456)", "Warehouse (654321)"]
+    warehouse = next(entry for entry in entries if entry.data["location_id"] == "654321")
+    assert warehouse.unique_id == "yanzi://test-username@1.1.1.1/654321"
+    assert warehouse.data == {
+        **ENTRY_DATA,
+        "location_id": "654321",
+        "access_token": "token-654321",
+    }
+
+
+async def test_import_already_configured(hass, mock_setup):
+    """Test an imported location that is already set up is not added twice."""
+    data = {
+        **ENTRY_DATA,
+        "location_id": "123456",
+        "location_name": "Office",
+        "access_token": "token-123456",
+    }
+    result = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": config_entries.SOURCE_IMPORT}, data=data,
+    )
+    assert result["type"] == "create_entry"
+
+    result2 = await hass.config_entries.flow.async_init(
+        DOMAIN, context={"source": config_entries.SOURCE_IMPORT}, data=data,
+    )
+    assert result2["type"] == "abort"
+    assert result2["reason"] == "already_configured"
+
+
+async def test_reauth_updates_every_location_of_the_account(hass):
+    """Test a new password is stored once and reloads all locations of the account."""
+    entries = [
+        MockConfigEntry(domain=DOMAIN, version=2, data={**ENTRY_DATA, "location_id": location_id})
+        for location_id in LOCATIONS
+    ]
+    for entry in entries:
+        entry.add_to_hass(hass)
+
+    result = await hass.config_entries.flow.async_init(
+        DOMAIN,
+        context={"source": config_entries.SOURCE_REAUTH, "entry_id": entries[0].entry_id},
+        data=entries[0].data,
+    )
+    assert result["type"] == "form"
+    assert result["step_id"] == "reauth_confirm"
+
+    with patch("custom_components.yanzi.config_flow.connect", fake_connect(FakeCirrus())), patch(
+        "homeassistant.config_entries.ConfigEntries.async_reload", return_value=True,
+    ) as mock_reload:
+        result2 = await hass.config_entries.flow.async_configure(
+            result["flow_id"], {"password": "new-password"},
+        )
+        await hass.async_block_till_done()
+
+    assert result2["type"] == "abort"
+    assert result2["reason"] == "reauth_successful"
+    assert await async_get_accounts(hass).async_login("1.1.1.1", "test-username") == {
+        **LOGIN, "password": "new-password"}
+    assert sorted(call.args[0] for call in mock_reload.mock_calls) == sorted(
+        entry.entry_id for entry in entries)
+
+
+async def test_migrate_moves_password_to_accounts(hass):
+    """Test the password of an older entry moves to the account logins."""
+    entry = MockConfigEntry(
+        domain=DOMAIN, version=1,
+        data={**USER_INPUT, "location_id": "123456", "access_token": "token-123456"})
+    entry.add_to_hass(hass)
+
+    assert await async_migrate_entry(hass, entry)
+
+    assert entry.version == 2
+    assert "password" not in entry.data
+    assert await async_get_accounts(hass).async_login("1.1.1.1", "test-username") == LOGIN
@@ -0,0 +1,124 @@
+"""Test the yanzi derived variables."""
+from custom_components.yanzi.derived import DerivedVariables, derive
+from custom_components.yanzi.records import YanziDevice, YanziSource
+
+
+def make_device():
+    return YanziDevice("dev", "A", "EUI64-GW", "Desk", "0090DA03010104A0")
+
+
+def make_source(device, variable_name, si_unit="NA", did="A", instance=0):
+    return YanziSource(f"EUI64-GW/123456/{did}/{variable_name}/{instance}", did, variable_name, si_unit, device)
+
+
+def test_energy_source_gets_its_own_key():
+    """Test totalEnergy is added next to totalPowerInst under a key of its own."""
+    device = make_device()
+    power = make_source(device, "totalPowerInst")
+
+    sources = derive(device, [power])
+
+    assert len(sources) == 2
+    energy = sources[1]
+    assert energy.key == "EUI64-GW/123456/A/totalEnergy/0"
+    assert energy.sample_key == power.key
+    assert energy.sample_variable == "totalPowerInst"
+    assert energy.value({"totalEnergy": 7200000}) == 2
+
+
+def test_each_child_derived_on_its_own():
+    """Test every channel of a multi-channel unit gets its own derived sources."""
+    device = make_device()
+    sources = derive(device, [
+        make_source(device, "totalPowerInst", did="A-4-Power"),
+        make_source(device, "totalPowerInst", did="A-5-Power"),
+        make_source(device, "totalPowerInst", did="A-6-Power"),
+        make_source(device, "temperatureK", "kelvin", did="B", instance=0),
+        make_source(device, "relativeHumidity", "percent", did="B", instance=0),
+        make_source(device, "temperatureK", "kelvin", did="B", instance=1),
+        make_source(device, "relativeHumidity", "percent", did="B", instance=1),
+    ])
+    derived = {source.key: source for source in sources if source.derivation is not None}
+
+    assert sorted(derived) == [
+        "EUI64-GW/123456/A-4-Power/totalEnergy/0",
+        "EUI64-GW/123456/A-5-Power/totalEnergy/0",
+        "EUI64-GW/123456/A-6-Power/totalEnergy/0",
+        "EUI64-GW/123456/B/dewPoint/0",
+        "EUI64-GW/123456/B/dewPoint/1",
+        "EUI64-GW/123456/B/temperatureC/0",
+        "EUI64-GW/123456/B/temperatureC/1",
+    ]
+    assert derived["EUI64-GW/123456/A-5-Power/totalEnergy/0"].sample_key == "EUI64-GW/123456/A-5-Power/totalPowerInst/0"
+    assert derived["EUI64-GW/123456/B/dewPoint/1"].inputs[1][0] == "EUI64-GW/123456/B/relativeHumidity/1"
+
+
+def test_inputs_from_separate_children():
+    """Test a unit reporting each quantity from a child of its own still gets a dew point."""
+    device = make_device()
+    sources = derive(device, [
+        make_source(device, "temperatureK", "kelvin", did="A-3-Temp"),
+        make_source(device, "relativeHumidity", "percent", did="A-3-Humidity"),
+    ])
+
+    dew_point = next(source for source in sources if source.variable_name == "dewPoint")
+    assert dew_point.key == "EUI64-GW/123456/A-3-Temp/dewPoint/0"
+    assert [key for key, extractor in dew_point.inputs] == [
+        "EUI64-GW/123456/A-3-Temp/temperatureK/0",
+        "EUI64-GW/123456/A-3-Humidity/relativeHumidity/0",
+    ]
+
+
+def test_dew_point_emitted_on_change():
+    """Test dew point is computed once both inputs are known and only emitted when it changes."""
+    device = make_device()
+    sources = derive(device, [
+        make_source(device, "temperatureK", "kelvin"),
+        make_source(device, "relativeHumidity", "percent"),
+    ])
+    dew_point = next(source for source in sources if source.variable_name == "dewPoint")
+    assert dew_point.sample_variable is None
+
+    derived = DerivedVariables()
+    for source in sources:
+        derived.add(source)
+
+    emitted = []
+
+    def emit(key, sample):
+        emitted.append((key, sample))
+
+    derived.update("EUI64-GW/123456/A/temperatureK/0", {"value": 293.15, "sampleTime": 1}, emit)
+    assert emitted == []
+
+    derived.update("EUI64-GW/123456/A/relativeHumidity/0", {"value": 50, "sampleTime": 2}, emit)
+    assert emitted == [("EUI64-GW/123456/A/dewPoint/0", {"value": 9.26, "sampleTime": 2})]
+
+    # Unchanged inputs, and changes that round to the same dew point, emit nothing.
+    derived.update("EUI64-GW/123456/A/temperatureK/0", {"value": 293.15, "sampleTime": 3}, emit)
+    derived.update("EUI64-GW/123456/A/relativeHumidity/0", {"value": 50.0001, "sampleTime": 4}, emit)
+    assert len(emitted) == 1
+
+    derived.update("EUI64-GW/123456/A/temperatureK/0", {"value": 295.15, "sampleTime": 5}, emit)
+    assert len(emitted) == 2
+    assert emitted[1][1]["sampleTime"] == 5
+
+
+def test_shared_input_extracted_once():
+    """Test an input used by several derivations is extracted once per sample."""
+    calls = []
+
+    def extractor(sample):
+        calls.append(sample)
+        return sample["value"]
+
+    derived = DerivedVariables()
+    device = make_device()
+    for name in ["a", "b"]:
+        source = make_source(device, name)
+        source.inputs = [("key", extractor), ("other", extractor)]
+        derived.add(source)
+
+    derived.update("key", {"value": 1}, lambda key, sample: None)
+
+    assert len(calls) == 1
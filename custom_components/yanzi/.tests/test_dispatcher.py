@@ -0,0 +1,61 @@
+"""Test the yanzi sample dispatcher and coalescing."""
+import asyncio
+
+from custom_components.yanzi.dispatcher import Coalescer, YanziDispatcher
+
+
+def test_coalescer_delivers_latest_after_interval():
+    """Test samples within the interval are replaced by the latest, which is delivered later."""
+    delivered = []
+
+    async def run():
+        coalescer = Coalescer(delivered.append, 0.05, significant=None)
+        coalescer({"value": 1})
+        coalescer({"value": 2})
+        coalescer({"value": 3})
+        assert delivered == [{"value": 1}]
+
+        await asyncio.sleep(0.08)
+        assert delivered == [{"value": 1}, {"value": 3}]
+        assert coalescer.coalesced == 1
+
+        # Nothing pending, so nothing more is delivered.
+        await asyncio.sleep(0.08)
+        assert len(delivered) == 2
+
+    asyncio.run(run())
+
+
+def test_coalescer_significant_change_is_immediate():
+    """Test a significant change is delivered at once and drops the pending sample."""
+    delivered = []
+
+    async def run():
+        coalescer = Coalescer(delivered.append, 10)
+        coalescer({"value": 100})
+        coalescer({"value": 105})
+        coalescer({"value": 200})
+        assert delivered == [{"value": 100}, {"value": 200}]
+        assert coalescer._timer is None
+        assert coalescer.coalesced == 1
+
+        coalescer({"value": 201})
+        coalescer.cancel()
+        assert coalescer._timer is None
+
+    asyncio.run(run())
+
+
+def test_dispatch_only_to_key():
+    """Test a sample only reaches the listeners of its key."""
+    dispatcher = YanziDispatcher()
+    a, b = [], []
+    dispatcher.subscribe("a", a.append)
+    remove = dispatcher.subscribe("b", b.append)
+
+    dispatcher.dispatch("a", 1)
+    remove()
+    dispatcher.dispatch("b", 2)
+
+    assert a == [1]
+    assert b == []
@@ -0,0 +1,66 @@
+"""Test the yanzi energy integrator."""
+from custom_components.yanzi.energy import EnergyIntegrator
+
+
+def test_integrates_power_after_reconcile():
+    """Test power samples are integrated from the device counter on."""
+    energy = EnergyIntegrator(max_gap=3600)
+    energy.add("key", {"sampleTime": 0, "instantPower": 100})
+    assert energy.total("key") is None
+
+    energy.reconcile("key", {"sampleTime": 0, "totalEnergy": 3600 * 1000 * 10})
+    energy.add("key", {"sampleTime": 1800 * 1000, "instantPower": 300})
+    energy.add("key", {"sampleTime": 1800 * 1000, "instantPower": 1000})
+
+    assert energy.total("key") == 10 + 100
+
+
+def test_skips_long_gaps():
+    """Test the power is not integrated across gaps of unknown power."""
+    energy = EnergyIntegrator(max_gap=60)
+    energy.reconcile("key", {"sampleTime": 0, "totalEnergy": 0})
+    energy.add("key", {"sampleTime": 0, "instantPower": 1000})
+    energy.add("key", {"sampleTime": 3600 * 1000, "instantPower": 1000})
+
+    assert energy.total("key") == 0
+
+
+def test_reconcile_never_decreases():
+    """Test an integrated total ahead of the device is paid off, not reset."""
+    energy = EnergyIntegrator(max_gap=3600)
+    energy.reconcile("key", {"sampleTime": 0, "totalEnergy": 0})
+    energy.add("key", {"sampleTime": 0, "instantPower": 1000})
+    energy.add("key", {"sampleTime": 3600 * 1000, "instantPower": 1000})
+    assert energy.total("key") == 1000
+
+    assert energy.reconcile("key", {"sampleTime": 3600 * 1000, "totalEnergy": 3600 * 1000 * 900}) == -100
+    energy.add("key", {"sampleTime": 2 * 3600 * 1000, "instantPower": 1000})
+    assert energy.total("key") == 1900
+
+    restored = EnergyIntegrator()
+    restored.load(energy.dump())
+    assert restored.total("key") == 1900
+
+
+def test_samples_with_counter_reconcile():
+    """Test power samples that carry the device counter follow it, and integration bridges those without."""
+    wh = 3600 * 1000
+    energy = EnergyIntegrator(max_gap=3600)
+    energy.add("key", {"sampleTime": 0, "instantPower": 1000, "totalEnergy": 10 * wh})
+    assert energy.total("key") == 10
+
+    energy.add("key", {"sampleTime": 1800 * 1000, "instantPower": 1000, "totalEnergy": 400 * wh})
+    assert energy.total("key") == 400
+
+    energy.add("key", {"sampleTime": 3600 * 1000, "instantPower": 1000})
+    assert energy.total("key") == 900
+
+    # A counter behind the integrated total does not make it decrease.
+    energy.add("key", {"sampleTime": 3600 * 1000, "instantPower": 1000, "totalEnergy": 800 * wh})
+    assert energy.total("key") == 900
+    energy.add("key", {"sampleTime": 2 * 3600 * 1000, "instantPower": 1000, "totalEnergy": 1800 * wh})
+    assert energy.total("key") == 1800
+
+    # Older samples are ignored.
+    energy.add("key", {"sampleTime": 0, "instantPower": 1000, "totalEnergy": 5000 * wh})
+    assert energy.total("key") == 1800
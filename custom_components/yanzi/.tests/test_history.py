@@ -0,0 +1,54 @@
+"""Test the yanzi history import."""
+from datetime import datetime, timezone
+from operator import itemgetter
+
+from custom_components.yanzi.history import HOUR, HourlyStatistics, statistic_id
+
+
+def hour(n):
+    return datetime.fromtimestamp(n * HOUR / 1000, timezone.utc)
+
+
+def test_measurements_fold_into_hourly_mean_min_max():
+    """Test each completed hour becomes one row, the last one on finish."""
+    statistics = HourlyStatistics(itemgetter("value"))
+
+    rows = statistics.add([
+        {"sampleTime": 0, "value": 1},
+        {"sampleTime": HOUR - 1, "value": 3},
+        {"sampleTime": HOUR, "value": 10},
+        {"value": 100},
+    ])
+
+    assert rows == [{"start": hour(0), "mean": 2, "min": 1, "max": 3}]
+    assert statistics.add([{"sampleTime": HOUR + 1, "value": 20}]) == []
+    assert statistics.finish() == [{"start": hour(1), "mean": 15, "min": 10, "max": 20}]
+    assert statistics.finish() == []
+
+
+def test_counters_sum_across_resets():
+    """Test counters keep a growing sum, also when the device counter resets."""
+    statistics = HourlyStatistics(itemgetter("value"), has_sum=True)
+
+    rows = statistics.add([
+        {"sampleTime": 0, "value": 100},
+        {"sampleTime": 1, "value": 110},
+        {"sampleTime": HOUR, "value": 5},
+    ])
+
+    assert rows == [{"start": hour(0), "state": 110, "sum": 10}]
+    assert statistics.finish() == [{"start": hour(1), "state": 5, "sum": 15}]
+
+
+def test_counters_continue_from_earlier_rows():
+    """Test a counter continues the sum of rows imported earlier."""
+    statistics = HourlyStatistics(itemgetter("value"), has_sum=True, last_state=90, last_sum=40)
+
+    statistics.add([{"sampleTime": 0, "value": 100}])
+
+    assert statistics.finish() == [{"start": hour(0), "state": 100, "sum": 50}]
+
+
+def test_statistic_id_of_entity():
+    """Test the history of an entity is imported as external statistics."""
+    assert statistic_id("sensor.desk_temperature") == "yanzi:sensor_desk_temperature"
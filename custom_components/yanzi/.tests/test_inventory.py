@@ -0,0 +1,77 @@
+"""Test the yanzi inventory diffing."""
+from custom_components.yanzi.inventory import YanziInventory, source_id
+from custom_components.yanzi.records import YanziDevice, YanziSource
+
+
+def make_inventory(name="Desk", variable_names=("motion", "temperatureC")):
+    device = YanziDevice("dev", "did", "gw", name, "0090DA03010104B0", life_cycle_state="present")
+    return [
+        (device, YanziSource(f"src-{vn}", "did", vn, "NA", device))
+        for vn in variable_names
+    ]
+
+
+def test_unchanged_refresh_keeps_references():
+    """Test a refresh with the same topology adds nothing and keeps the records."""
+    inventory = YanziInventory()
+    first = make_inventory()
+    assert inventory.update(first) == first
+
+    first[0][1].latest = {"value": 1}
+    assert inventory.update(make_inventory()) == []
+    assert inventory.device_sources[0][0] is first[0][0]
+    assert inventory.device_sources[0][1].latest == {"value": 1}
+
+
+def test_refresh_updates_removes_and_adds():
+    """Test changed metadata is applied in place and listeners are told."""
+    inventory = YanziInventory()
+    first = make_inventory()
+    inventory.update(first)
+
+    updates = []
+    for device, source in first:
+        inventory.listeners.subscribe(source_id(source), updates.append)
+
+    added = inventory.update(make_inventory("Office", ("motion", "battery")))
+
+    assert [source.variable_name for _, source in added] == ["battery"]
+    assert added[0][1].device is first[0][0]
+    assert first[0][0].name == "Office"
+    assert first[0][0].device_info["name"] == "Office"
+    assert first[0][1].name == "Office"
+    assert first[1][1].removed is True
+    assert [s.variable_name for _, s in inventory.device_sources] == ["motion", "battery"]
+    assert {source.variable_name for source in updates} == {"motion", "temperatureC"}
+
+
+def test_loaded_cache_is_refreshed():
+    """Test the first refresh after loading a cache updates devices and prunes sources."""
+    cached = YanziInventory()
+    cached.update(make_inventory("Old name"))
+    cached.device_sources[0][0].life_cycle_state = "shadow"
+
+    inventory = YanziInventory()
+    inventory.load(cached.dump())
+    device, motion = inventory.device_sources[0]
+
+    assert inventory.merge(make_inventory("Desk", ("motion",))) == []
+    inventory.prune()
+
+    assert device.name == "Desk"
+    assert device.life_cycle_state == "present"
+    assert [s for _, s in inventory.device_sources] == [motion]
+
+
+def test_dump_round_trip():
+    """Test the cached inventory is rebuilt into equivalent records."""
+    inventory = YanziInventory()
+    inventory.update(make_inventory())
+    inventory.device_sources[0][1].latest = {"value": 1}
+
+    loaded = list(YanziInventory.device_sources_from_dump(inventory.dump()))
+
+    assert [source.as_dict() for _, source in loaded] == \
+        [source.as_dict() for _, source in inventory.device_sources]
+    assert loaded[0][0].device_info == inventory.device_sources[0][0].device_info
+    assert loaded[0][1].device is loaded[1][1].device
@@ -0,0 +1,158 @@
+"""Test the yanzi location helpers."""
+import asyncio
+import contextlib
+
+from custom_components.yanzi.derived import derive
+from custom_components.yanzi.location import KeyIndex, YanziLocation, message_to_batch
+from custom_components.yanzi.records import YanziDevice, YanziSource
+
+
+def make_sample_list(did, variable_name, samples):
+    return {
+        "dataSourceAddress": {
+            "serverDid": "EUI64-GW",
+            "locationId": "123456",
+            "did": did,
+            "variableName": {"name": variable_name},
+            "instanceNumber": 0,
+        },
+        "list": samples,
+    }
+
+
+def test_message_to_batch_keeps_every_sample():
+    """Test all data sources and samples of a message are returned in order."""
+    message = {
+        "messageType": "SubscribeData",
+        "list": [
+            make_sample_list("A", "motion", [{"value": 1}, {"value": 2}]),
+            make_sample_list("B", "relativeHumidity", [{"value": 3}]),
+        ],
+    }
+
+    assert message_to_batch(message) == [
+        ("EUI64-GW/123456/A/motion/0", {"value": 1}),
+        ("EUI64-GW/123456/A/motion/0", {"value": 2}),
+        ("EUI64-GW/123456/B/relativeHumidity/0", {"value": 3}),
+    ]
+
+
+def test_message_to_batch_reuses_inventory_keys():
+    """Test keys are looked up in the index and derived variables are not emulated."""
+    keys = KeyIndex()
+    key = "".join(["EUI64-GW/123456/A/", "temperatureK/0"])
+    keys.add(key)
+    message = {
+        "messageType": "SubscribeData",
+        "list": [make_sample_list("A", "temperatureK", [{"value": 295.65}])],
+    }
+
+    batch = message_to_batch(message, keys=keys)
+
+    assert batch == [("EUI64-GW/123456/A/temperatureK/0", {"value": 295.65})]
+    assert batch[0][0] is key
+
+
+def test_celsius_computed_from_kelvin():
+    """Test a temperatureC source listens to temperatureK samples and converts them."""
+    device = YanziDevice("dev", "A", "EUI64-GW", "Desk", "0090DA03010104A0")
+    kelvin = YanziSource("EUI64-GW/123456/A/temperatureK/0", "A", "temperatureK", "kelvin", device)
+    source = YanziSource("EUI64-GW/123456/A/temperatureC/0", "A", "temperatureC", "celsius", device)
+
+    derive(device, [kelvin, source])
+
+    assert source.sample_key == "EUI64-GW/123456/A/temperatureK/0"
+    assert source.sample_variable == "temperatureK"
+    assert source.value({"value": 295.65}) == 22.5
+
+
+def test_message_to_batch_tracks_last_seen():
+    """Test the latest sample time per key is recorded for backfilling."""
+    last_seen = {"EUI64-GW/123456/A/motion/0": 500}
+    message = {
+        "messageType": "SubscribeData",
+        "list": [
+            make_sample_list("A", "motion", [{"sampleTime": 1000}, {"sampleTime": 900}]),
+            make_sample_list("B", "temperatureK", [{"sampleTime": 800, "value": 273.15}]),
+        ],
+    }
+
+    message_to_batch(message, last_seen)
+
+    assert last_seen == {
+        "EUI64-GW/123456/A/motion/0": 1000,
+        "EUI64-GW/123456/B/temperatureK/0": 800,
+    }
+
+
+class FakeSocket:
+    """A connection that records the order of subscribe and backfill requests."""
+
+    exception = None
+
+    def __init__(self):
+        self.events = []
+        self.frames = asyncio.Queue()
+
+    @contextlib.asynccontextmanager
+    async def subscription(self, subscribe_request):
+        self.events.append("subscribe")
+        yield self._frames()
+
+    async def _frames(self):
+        while True:
+            yield await self.frames.get()
+
+    async def request(self, request, timeout=5):
+        self.events.append("backfill")
+        # A live sample arrives while the backfill is in flight.
+        self.frames.put_nowait({
+            "messageType": "SubscribeData",
+            "list": [make_sample_list("A", "motion", [{"sampleTime": 3000}])],
+        })
+        return {
+            "responseCode": {"name": "success"},
+            "sampleListDto": {"list": [{"sampleTime": 2000}, {"sampleTime": 1500}]},
+        }
+
+
+class FakePool:
+    """A pool handing out one connection to a FakeSocket."""
+
+    reconnects = 0
+
+    def __init__(self, socket):
+        self._socket = socket
+
+    def acquire(self, host, credentials):
+        return self
+
+    def release(self, connection):
+        pass
+
+    async def socket(self):
+        return self._socket
+
+
+def test_watch_subscribes_before_backfill():
+    """Test samples arriving during the backfill are queued and come after it."""
+    socket = FakeSocket()
+    pool = FakePool(socket)
+    key = "EUI64-GW/123456/A/motion/0"
+
+    async def run():
+        location = YanziLocation("host", {"accessToken": "token"}, "123456", pool=pool)
+        location.last_seen[key] = 1000
+        watch = location.watch()
+        batches = [await watch.__anext__(), await watch.__anext__()]
+        await watch.aclose()
+        return location, batches
+
+    location, batches = asyncio.run(run())
+
+    assert socket.events == ["subscribe", "backfill"]
+    assert batches == [
+        [(key, {"sampleTime": 1500}), (key, {"sampleTime": 2000})],
+        [(key, {"sampleTime": 3000})],
+    ]
+    assert location.last_seen[key] == 3000
@@ -0,0 +1,45 @@
+"""Test the yanzi pipeline metrics."""
+from types import SimpleNamespace
+
+from custom_components.yanzi.metrics import LocationMetrics
+
+
+def location(round_trips):
+    return SimpleNamespace(
+        connection=SimpleNamespace(stats={"in_flight": 0, "round_trips": round_trips}),
+        reconnects=0,
+        device_sources={},
+        expiry=[],
+    )
+
+
+def test_dispatch_latency_covers_last_interval():
+    """Test the latency quantiles only cover the batches since the previous snapshot."""
+    metrics = LocationMetrics()
+    metrics.record_batch(1, 0.2)
+    assert metrics.snapshot(location({}))["dispatch_latency_p99"] == 500
+
+    for _ in range(10):
+        metrics.record_batch(1, 0.000_05)
+    latest = metrics.snapshot(location({}))
+    assert latest["dispatch_latency_p99"] == 0.1
+    assert latest["dispatch_latency"]["count"] == 10
+    assert latest["samples"] == 11
+
+    # Nothing dispatched, the last figures stay.
+    assert metrics.snapshot(location({}))["dispatch_latency_p99"] == 0.1
+
+
+def test_round_trips_cover_last_interval():
+    """Test the round trip means are those of the requests since the previous snapshot."""
+    metrics = LocationMetrics()
+    latest = metrics.snapshot(location({"PeriodicRequest": {"count": 10, "total": 10.0, "mean": 1.0}}))
+    assert latest["round_trips"] == {"PeriodicRequest": {"count": 10, "mean": 1.0}}
+
+    latest = metrics.snapshot(location({"PeriodicRequest": {"count": 12, "total": 10.2, "mean": 0.85}}))
+    assert latest["round_trips"]["PeriodicRequest"]["count"] == 2
+    assert round(latest["round_trips"]["PeriodicRequest"]["mean"], 3) == 0.1
+
+    # A reconnect starts counting again.
+    latest = metrics.snapshot(location({"PeriodicRequest": {"count": 1, "total": 0.3, "mean": 0.3}}))
+    assert latest["round_trips"] == {"PeriodicRequest": {"count": 1, "mean": 0.3}}
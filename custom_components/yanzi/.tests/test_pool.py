@@ -0,0 +1,112 @@
+"""Test the yanzi connection pool."""
+import asyncio
+import json
+
+import websockets
+
+from custom_components.yanzi.pool import CirrusPool
+
+LOGIN = {"username": "user", "password": "secret"}
+
+
+def test_locations_of_an_account_share_a_connection():
+    """Test locations logging in with the same account share one connection."""
+
+    async def run():
+        pool = CirrusPool("ws://127.0.0.1:9/{host}")
+        first = pool.acquire("host", dict(LOGIN))
+        second = pool.acquire("host", dict(LOGIN))
+        token = pool.acquire("host", {"accessToken": "token"})
+        other_host = pool.acquire("other", dict(LOGIN))
+
+        assert first is second
+        assert first.references == 2
+        assert token is not first
+        assert other_host is not first
+        assert len(pool) == 3
+
+        pool.release(first)
+        assert len(pool) == 3
+        pool.release(second)
+        pool.release(token)
+        pool.release(other_host)
+        assert len(pool) == 0
+        await asyncio.sleep(0)
+        assert first._task.cancelled()
+
+    asyncio.run(run())
+
+
+def test_shared_connection_reconnects():
+    """Test a dropped connection is replaced straight away and socket() waits for it."""
+    logins = []
+
+    async def handler(ws, path=None):
+        async for message in ws:
+            request = json.loads(message)
+            response = {
+                "messageIdentifier": request["messageIdentifier"],
+                "responseCode": {"name": "success"},
+            }
+            if request["messageType"] == "LoginRequest":
+                logins.append(request)
+                response["sessionId"] = "session"
+            await ws.send(json.dumps(response))
+            if len(logins) == 1:
+                # Drop the first connection right after the login.
+                await ws.close()
+                return
+
+    async def run():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = CirrusPool(f"ws://127.0.0.1:{port}/{{host}}")
+            connection = pool.acquire("host", dict(LOGIN))
+            try:
+                first = await asyncio.wait_for(connection.socket(), 5)
+                await asyncio.wait_for(first.wait_closed(), 5)
+
+                second = await asyncio.wait_for(connection.socket(), 5)
+                assert second is not first
+                assert second.exception is None
+                assert connection.reconnects == 1
+                assert connection.stats["connected"]
+            finally:
+                pool.release(connection)
+
+    asyncio.run(run())
+    assert [login["username"] for login in logins] == ["user", "user"]
+
+
+def test_refused_login_is_not_retried():
+    """Test a refused login calls the auth listeners once instead of reconnecting."""
+    logins = []
+
+    async def handler(ws, path=None):
+        async for message in ws:
+            request = json.loads(message)
+            if request["messageType"] == "LoginRequest":
+                logins.append(request)
+            await ws.send(json.dumps({
+                "messageIdentifier": request["messageIdentifier"],
+                "responseCode": {"name": "error"},
+            }))
+
+    async def run():
+        async with websockets.serve(handler, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = CirrusPool(f"ws://127.0.0.1:{port}/{{host}}")
+            connection = pool.acquire("host", dict(LOGIN))
+            refused = asyncio.Event()
+            connection.add_auth_listener(refused.set)
+            try:
+                await asyncio.wait_for(refused.wait(), 5)
+                await asyncio.sleep(0.1)
+                assert connection.auth_failed
+                assert connection.reconnects == 0
+                assert connection._task.done()
+            finally:
+                pool.release(connection)
+
+    asyncio.run(run())
+    assert len(logins) == 1
@@ -0,0 +1,92 @@
+"""Test the yanzi expiry scheduler and reconnect backoff."""
+import asyncio
+import time
+
+from custom_components.yanzi.timers import Backoff, ExpiryScheduler
+
+
+def test_deadlines_fire_in_order():
+    """Test callbacks are called once, in deadline order, and rescheduling moves a deadline."""
+    calls = []
+
+    async def run():
+        scheduler = ExpiryScheduler()
+        now = time.time()
+        scheduler.schedule("a", now + 0.03, lambda: calls.append("a"))
+        scheduler.schedule("b", now + 0.06, lambda: calls.append("b"))
+        # Moving a deadline earlier re-arms the timer for it.
+        scheduler.schedule("b", now + 0.01, lambda: calls.append("b"))
+        scheduler.schedule("c", now + 0.02, lambda: calls.append("c"))
+        scheduler.cancel("c")
+
+        await asyncio.sleep(0.02)
+        assert calls == ["b"]
+        assert len(scheduler) == 1
+
+        # Moving a deadline later keeps it from firing at the old one.
+        scheduler.schedule("a", time.time() + 0.05, lambda: calls.append("a"))
+        await asyncio.sleep(0.03)
+        assert calls == ["b"]
+        await asyncio.sleep(0.05)
+        assert calls == ["b", "a"]
+        assert len(scheduler) == 0
+        assert scheduler._timer is None
+
+    asyncio.run(run())
+
+
+def test_failing_callback_does_not_stop_others():
+    """Test an exception in one callback still lets later deadlines fire."""
+    calls = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    async def run():
+        scheduler = ExpiryScheduler()
+        now = time.time()
+        scheduler.schedule("a", now, fail)
+        scheduler.schedule("b", now, lambda: calls.append("b"))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert calls == ["b"]
+
+
+def test_heap_is_compacted():
+    """Test rescheduling one key over and over keeps the heap bounded."""
+
+    async def run():
+        scheduler = ExpiryScheduler()
+        now = time.time()
+        for i in range(1000):
+            scheduler.schedule("a", now + 60 + i, lambda: None)
+
+        assert len(scheduler) == 1
+        assert len(scheduler._heap) <= 4 + 64 + 1
+
+        scheduler.clear()
+        assert scheduler._timer is None
+        assert len(scheduler._heap) == 0
+
+    asyncio.run(run())
+
+
+def test_backoff_doubles_up_to_cap():
+    """Test the first retry is immediate and later ones double up to the cap."""
+    backoff = Backoff(base=1, cap=10, jitter=0)
+
+    assert [backoff.next_delay() for _ in range(7)] == [0, 1, 2, 4, 8, 10, 10]
+
+    backoff.reset()
+    assert backoff.next_delay() == 0
+
+
+def test_backoff_jitter_shortens_delay():
+    """Test jitter takes at most its share off each delay."""
+    backoff = Backoff(base=4, cap=100, jitter=0.5)
+    backoff.next_delay()
+
+    for _ in range(20):
+        backoff.attempt = 1
+        assert 2 <= backoff.next_delay() <= 4
@@ -0,0 +1,72 @@
+"""Test the yanzi variable descriptors."""
+from custom_components.yanzi.records import YanziDevice, YanziSource
+from custom_components.yanzi.variables import VARIABLES, describe
+
+
+def test_descriptor_extracts_state():
+    """Test known variables extract their own fields from a sample."""
+    assert VARIABLES["battery"].value({"percentFull": 87.5}) == 87
+    assert VARIABLES["totalEnergy"].value({"totalEnergy": 7200000}) == 2
+    assert VARIABLES["uplog"].value({"deviceUpState": {"name": "goingUp"}}) is True
+    assert VARIABLES["onOffOutput"].value({"value": {"name": "off"}}) is False
+    assert VARIABLES["onOffTransition"].platform is None
+
+
+def test_power_sample_state():
+    """Test a totalPowerInst sample gives the instant power of a power sensor."""
+    sample = {
+        "resourceType": "SampleElectricalEnergySimple",
+        "instantPower": 41230,
+        "totalEnergy": 982311000,
+        "minPower": 40990,
+        "maxPower": 41500,
+        "sampleTime": 1650000000000,
+    }
+    descriptor = describe("totalPowerInst")
+
+    assert descriptor.value(sample) == 41230
+    assert descriptor.device_class == "power"
+    assert descriptor.aggregate is True
+
+
+def test_unknown_variable_falls_back_to_value():
+    """Test unknown variables become sensors reading 'value' or their own name."""
+    descriptor = describe("someNewVariable")
+
+    assert descriptor.platform == "sensor"
+    assert descriptor.value({"value": 3}) == 3
+    assert descriptor.value({"someNewVariable": 4}) == 4
+    assert describe("someNewVariable") is descriptor
+
+
+def test_source_resolves_descriptor_and_unit():
+    """Test a source looks up its descriptor and unit once."""
+    device = YanziDevice("dev", "did", "gw", "Desk", "0090DA03010104A0")
+
+    battery = YanziSource("key", "did", "battery", "NA", device)
+    humidity = YanziSource("key", "did", "relativeHumidity", "percent", device)
+
+    assert battery.descriptor is VARIABLES["battery"]
+    assert battery.unit_of_measurement == "%"
+    assert humidity.unit_of_measurement == "%"
+    assert humidity.descriptor.device_class == "humidity"
+
+
+def test_statistics_decoded_once_per_sample():
+    """Test the statistics blob is decoded when a new sample is set."""
+    device = YanziDevice("dev", "did", "gw", "Desk", "0090DA03010104A0")
+    source = YanziSource("key", "did", "statistics", "NA", device)
+    blob = "01d20300" + "10000000" + "00" * 8 + "0200" + "0300" + "0405" + "00" * 10
+
+    source.latest = {"value": blob}
+    attributes = source.attributes
+    source.latest = source.latest
+
+    assert source.attributes is attributes
+    assert attributes["parent_rssi"] == 0xd2
+    assert attributes["parent_switches"] == 3
+    assert attributes["parent_rank"] == 2
+    assert attributes["free_neighbors"] == 5
+
+    source.latest = {"value": "not hex"}
+    assert source.attributes is None
@@ -1,62 +1,205 @@
 import asyncio
 import logging
+import time
+
+from datetime import timedelta
 
 import voluptuous as vol
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, ServiceCall, callback
+from homeassistant.exceptions import ConfigEntryAuthFailed
+from homeassistant.helpers import config_validation as cv, entity_registry as er
+from homeassistant.helpers.dispatcher import async_dispatcher_send
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
+from homeassistant.util import dt as dt_util
 
-from .const import DOMAIN
+from .accounts import async_get_accounts
+from .const import (COALESCE_INTERVALS, DATA_POOL, DEVICE_PAGE_SIZE, DOMAIN,
+                    HISTORY_CONCURRENCY, METRICS_INTERVAL, SIGNAL_METRICS, SIGNAL_NEW_SOURCES, STORAGE_VERSION)
+from .history import async_import_history
+from .inventory import source_id
 from .location import YanziLocation
+from .pool import CirrusPool
+
+log = logging.getLogger(__name__)
 
 CONFIG_SCHEMA = vol.Schema({DOMAIN: vol.Schema({})}, extra=vol.ALLOW_EXTRA)
 
 # For your initial PR, limit it to 1 platform.
 PLATFORMS = ['sensor', 'binary_sensor', 'switch']
 
+IMPORT_HISTORY_SCHEMA = vol.Schema({
+    vol.Required('entity_id'): cv.entity_ids,
+    vol.Required('start'): cv.datetime,
+    vol.Optional('end'): cv.datetime,
+})
+
 
 async def async_setup(hass: HomeAssistant, config: dict):
     """Set up the yanzi component."""
     hass.data[DOMAIN] = {}
+
+    async def import_history(call: ServiceCall):
+        start = dt_util.as_utc(call.data['start'])
+        end = dt_util.as_utc(call.data['end']) if 'end' in call.data else dt_util.utcnow()
+        hass.async_create_task(async_import_entities_history(
+            hass, call.data['entity_id'], start, end))
+
+    hass.services.async_register(
+        DOMAIN, 'import_history', import_history, schema=IMPORT_HISTORY_SCHEMA)
+
     return True
 
 
+async def async_import_entities_history(hass: HomeAssistant, entity_ids, start, end):
+    """Import the history of Yanzi sensors as external long-term statistics."""
+    registry = er.async_get(hass)
+    sources = {}
+    targets = []
+    for entity_id in entity_ids:
+        entity = registry.async_get(entity_id)
+        location = hass.data[DOMAIN].get(entity.config_entry_id) if entity is not None else None
+        if location is None or entity.platform != DOMAIN or entity.domain != 'sensor':
+            log.warning('Can not import history of %s, it is not a Yanzi sensor', entity_id)
+            continue
+
+        if location not in sources:
+            sources[location] = {}
+            for device, source in location.device_sources:
+                sources[location].setdefault(source.key, source)
+
+        source = sources[location].get(entity.unique_id)
+        if source is None or source.sample_variable is None:
+            log.warning('Can not import history of %s, it has no data source', entity_id)
+            continue
+        targets.append((location, source, entity_id, entity.name or entity.original_name))
+
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+
+    async def import_one(location, source, entity_id, name):
+        async with semaphore:
+            try:
+                await async_import_history(hass, location, source, entity_id, start, end, name)
+            except Exception as e:
+                log.warning('Failed to import history of %s: %s', entity_id, e, exc_info=e)
+
+    await asyncio.gather(*[import_one(*target) for target in targets])
+
+
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Set up yanzi from a config entry."""
 
     location = YanziLocation(
         entry.data['host'],
-        entry.data['access_token'],
-        entry.data['location_id'])
+        await async_entry_credentials(hass, entry),
+        entry.data['location_id'],
+        page_size=entry.options.get('page_size', DEVICE_PAGE_SIZE),
+        store=inventory_store(hass, entry),
+        coalesce_intervals=COALESCE_INTERVALS if entry.options.get('coalesce', True) else {},
+        pool=hass.data.setdefault(DATA_POOL, CirrusPool()))
+
+    if location.connection.auth_failed:
+        location.unload()
+        raise ConfigEntryAuthFailed(f'Login to {entry.data["host"]} was refused')
 
     hass.data[DOMAIN][entry.entry_id] = location
+    entry.async_on_unload(location.connection.add_auth_listener(
+        lambda: entry.async_start_reauth(hass)))
+
+    async def forward_platforms():
+        await asyncio.gather(*[
+            hass.config_entries.async_forward_entry_setup(entry, component)
+            for component in PLATFORMS
+        ])
+
+    # Entities are created from the cached inventory straight away, the live
+    # inventory is reconciled with it once the connection is up.
+    cached = await location.load_cache()
+    if cached:
+        hass.async_create_task(forward_platforms())
+
+    # An event per sample is costly, and only needed for automations on raw samples.
+    fire_events = entry.options.get('sample_events', True)
+
+    @callback
+    def handle_sample(key, sample):
+        # Every power sample counts, so integrate before coalescing.
+        location.energy.add(key, sample)
+        location.aggregator.add(key, sample)
+        location.derived.update(key, sample, handle_sample)
+        location.dispatcher.dispatch(key, sample)
+        if fire_events:
+            hass.bus.async_fire(
+                'yanzi_data', {'key': key, 'sample': sample})
 
     async def watch():
-        counter_key = 'sensor.yanzi_sample_counter_' + \
-            entry.data['location_id']
-        count = 0
-        async for key, sample in location.watch():
-            hass.bus.async_fire('yanzi_data', {'key': key, 'sample': sample})
-            count = count + 1
-            hass.states.async_set(counter_key, count, {
-                                  'unit_of_measurement': 'samples'})
+        async for batch in location.watch():
+            start = time.perf_counter()
+            for key, sample in batch:
+                handle_sample(key, sample)
+            location.metrics.record_batch(len(batch), time.perf_counter() - start)
+
+    @callback
+    def flush_aggregates(now):
+        location.aggregator.flush()
+
+    @callback
+    def update_metrics(now):
+        location.metrics.snapshot(location)
+        async_dispatcher_send(hass, SIGNAL_METRICS.format(entry.entry_id))
 
     async def sources():
+        platforms_loaded = cached
+        stale = cached
         while location.is_loaded:
             try:
-                await location.get_device_sources()
-                for component in PLATFORMS:
-                    hass.async_create_task(
-                        hass.config_entries.async_forward_entry_setup(entry, component))
+                async for added in location.get_device_sources():
+                    await location.get_latest_samples(
+                        [source for device, source in added])
+
+                    if not platforms_loaded:
+                        await forward_platforms()
+                        platforms_loaded = True
+                    elif added:
+                        async_dispatcher_send(
+                            hass, SIGNAL_NEW_SOURCES.format(entry.entry_id), added)
+
+                if stale:
+                    # The cached samples may be old, refresh them all once.
+                    device_sources = location.device_sources
+                    await location.get_latest_samples(
+                        [source for device, source in device_sources])
+                    location.inventory.notify(
+                        source_id(source) for device, source in device_sources)
+                    stale = False
+
+                location.save_cache()
+            except Exception as e:
+                log.warning('Failed to refresh device sources: %s',
+                            e, exc_info=e)
             finally:
                 await asyncio.sleep(60*10)
 
     location._hass_watcher_task = asyncio.create_task(watch())
     location._hass_sources_task = asyncio.create_task(sources())
 
+    entry.async_on_unload(entry.add_update_listener(async_reload_entry))
+    entry.async_on_unload(async_track_time_interval(
+        hass, update_metrics, METRICS_INTERVAL))
+    if entry.options.get('aggregate_interval'):
+        entry.async_on_unload(async_track_time_interval(
+            hass, flush_aggregates, timedelta(seconds=entry.options['aggregate_interval'])))
+
     return True
 
 
+async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry):
+    """Reload a config entry after its options changed."""
+    await hass.config_entries.async_reload(entry.entry_id)
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Unload a config entry."""
     location = hass.data[DOMAIN].pop(entry.entry_id)
@@ -77,3 +220,48 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
         location._hass_sources_task.cancel()
 
     return unload_ok
+
+
+async def async_remove_entry(hass: HomeAssistant, entry: ConfigEntry):
+    """Remove the cached inventory of a config entry, and its login once unused."""
+    await inventory_store(hass, entry).async_remove()
+
+    if 'username' in entry.data and not any(
+            other.entry_id != entry.entry_id
+            and other.data.get('host') == entry.data['host']
+            and other.data.get('username') == entry.data['username']
+            for other in hass.config_entries.async_entries(DOMAIN)):
+        await async_get_accounts(hass).async_remove(entry.data['host'], entry.data['username'])
+
+
+async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry):
+    """Move the password of an entry to the account logins."""
+    if entry.version == 1:
+        data = dict(entry.data)
+        password = data.pop('password', None)
+        if password is not None:
+            await async_get_accounts(hass).async_set(data['host'], data['username'], password)
+
+        entry.version = 2
+        hass.config_entries.async_update_entry(entry, data=data)
+
+    return True
+
+
+async def async_entry_credentials(hass: HomeAssistant, entry: ConfigEntry):
+    """The login of the connection of an entry.
+
+    Entries with an account login share one connection per host, older
+    entries only have the access token of their location.
+    """
+    if 'username' not in entry.data:
+        return {'accessToken': entry.data['access_token']}
+
+    login = await async_get_accounts(hass).async_login(entry.data['host'], entry.data['username'])
+    if login is None:
+        raise ConfigEntryAuthFailed(f'No password stored for {entry.data["username"]}')
+    return login
+
+
+def inventory_store(hass: HomeAssistant, entry: ConfigEntry):
+    return Store(hass, STORAGE_VERSION, f'{DOMAIN}.{entry.data["location_id"]}')
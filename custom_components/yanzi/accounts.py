@@ -0,0 +1,53 @@
+import asyncio
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .const import ACCOUNTS_STORAGE_KEY, DATA_ACCOUNTS, STORAGE_VERSION
+
+
+def account_id(host, username):
+    return f'{username}@{host}'
+
+
+def async_get_accounts(hass: HomeAssistant):
+    '''The YanziAccounts of `hass`.'''
+    if DATA_ACCOUNTS not in hass.data:
+        hass.data[DATA_ACCOUNTS] = YanziAccounts(hass)
+    return hass.data[DATA_ACCOUNTS]
+
+
+class YanziAccounts:
+    '''The logins of the accounts, shared by the config entries of their locations.
+
+    A password is stored once per account rather than in every config
+    entry, so a changed password is entered once for all its locations.
+    '''
+
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, ACCOUNTS_STORAGE_KEY, private=True)
+        self._logins = None
+        self._lock = asyncio.Lock()
+
+    async def async_login(self, host, username):
+        '''The credentials of a LoginRequest for the account, None if unknown.'''
+        async with self._lock:
+            login = (await self._async_load()).get(account_id(host, username))
+            return dict(login) if login is not None else None
+
+    async def async_set(self, host, username, password):
+        async with self._lock:
+            logins = await self._async_load()
+            logins[account_id(host, username)] = {'username': username, 'password': password}
+            await self._store.async_save(logins)
+
+    async def async_remove(self, host, username):
+        async with self._lock:
+            logins = await self._async_load()
+            if logins.pop(account_id(host, username), None) is not None:
+                await self._store.async_save(logins)
+
+    async def _async_load(self):
+        if self._logins is None:
+            self._logins = await self._store.async_load() or {}
+        return self._logins
@@ -0,0 +1,100 @@
+from array import array
+
+from .const import AGGREGATE_BUFFER_SIZE
+from .dispatcher import YanziDispatcher
+
+
+class RingBuffer:
+    '''The values of a key since the last drain, in a preallocated array.
+
+    Once more than `size` values arrive between two drains the oldest ones
+    are overwritten, so memory stays fixed however chatty the source is.
+    '''
+
+    __slots__ = ('values', 'size', 'index', 'count')
+
+    def __init__(self, size):
+        self.values = array('d', bytes(8 * size))
+        self.size = size
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.index] = value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+        self.count += 1
+
+    def drain(self):
+        '''The min, mean and max of the buffered values, or None if empty.'''
+        if not self.count:
+            return None
+
+        values = self.values if self.count >= self.size else self.values[:self.count]
+        aggregate = {
+            'min': min(values),
+            'mean': sum(values) / len(values),
+            'max': max(values),
+            'count': self.count,
+        }
+
+        self.index = 0
+        self.count = 0
+        return aggregate
+
+
+class Aggregator:
+    '''Downsamples the samples of subscribed keys to min/mean/max.
+
+    `add` is called for every sample and only buffers the value. `flush`
+    is called at the aggregation cadence and hands each aggregate to its
+    listeners. Several aggregates, each with its own id, can be computed
+    from the samples of one key.
+    '''
+
+    def __init__(self, size=AGGREGATE_BUFFER_SIZE):
+        self.size = size
+        self.latest = {}
+        self.listeners = YanziDispatcher()
+        self._buffers = {}
+
+    def subscribe(self, aggregate_id, key, value, listener):
+        '''Aggregate `value(sample)` of the samples of `key` as `aggregate_id`.
+
+        `listener(aggregate)` is called on every flush with new values.
+        Returns a function that removes the listener again.
+        '''
+        buffers = self._buffers.setdefault(key, {})
+        if aggregate_id not in buffers:
+            buffers[aggregate_id] = (value, RingBuffer(self.size))
+        unsubscribe = self.listeners.subscribe(aggregate_id, listener)
+
+        def remove():
+            unsubscribe()
+            if aggregate_id not in self.listeners:
+                buffers.pop(aggregate_id, None)
+                if not buffers:
+                    self._buffers.pop(key, None)
+                self.latest.pop(aggregate_id, None)
+
+        return remove
+
+    def add(self, key, sample):
+        buffers = self._buffers.get(key)
+        if buffers is None:
+            return
+
+        for value, buffer in buffers.values():
+            try:
+                buffer.append(float(value(sample)))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def flush(self):
+        for buffers in list(self._buffers.values()):
+            for aggregate_id, (value, buffer) in list(buffers.items()):
+                aggregate = buffer.drain()
+                if aggregate is not None:
+                    self.latest[aggregate_id] = aggregate
+                    self.listeners.dispatch(aggregate_id, aggregate)
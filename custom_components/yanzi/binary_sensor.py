@@ -1,59 +1,57 @@
-import asyncio
 import time
 
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.components.binary_sensor import BinarySensorEntity
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DOMAIN
+from .const import DOMAIN, MOTION_TIMEOUT, SIGNAL_NEW_SOURCES
 from .yanzi_entity import YanziEntity
 
-BINARY_VARIABLE_NAMES = [
-    'uplog',
-    'motion',
-]
-
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback):
     location = hass.data[DOMAIN][entry.entry_id]
 
-    async_add_entities([
-        BinaryYanziSensor(location, device, source)
-        for device, source in location.device_sources
-        if source['variableName'] in BINARY_VARIABLE_NAMES
-    ])
+    @callback
+    def add_sources(device_sources):
+        async_add_entities([
+            BinaryYanziSensor(location, device, source)
+            for device, source in device_sources
+            if source.descriptor.platform == 'binary_sensor'
+        ])
+
+    add_sources(location.device_sources)
+    entry.async_on_unload(async_dispatcher_connect(
+        hass, SIGNAL_NEW_SOURCES.format(entry.entry_id), add_sources))
 
 
 class BinaryYanziSensor(BinarySensorEntity, YanziEntity):
-    async def on_sample(self, sample):
-        # We need to refresh ourselves after 60 seconds, since we use
-        # time.time() in self.state
-        await asyncio.sleep(60)
-        await self.async_update_ha_state()
+    async def async_will_remove_from_hass(self):
+        self.location.expiry.cancel(self.unique_id)
+
+    @callback
+    def on_sample(self, sample):
+        if self.source.variable_name == 'motion':
+            # is_on depends on time.time(), so the state has to be written
+            # again once the motion is too old.
+            deadline = sample['timeLastMotion'] / 1000 + MOTION_TIMEOUT
+            if deadline > time.time():
+                self.location.expiry.schedule(
+                    self.unique_id, deadline, self.async_write_ha_state)
 
     @property
     def device_class(self):
-        vn = self.source['variableName']
-
-        if vn == 'motion':
-            return 'motion'
-        elif vn == 'uplog':
-            return 'connectivity'
+        return self.descriptor.device_class
 
     @property
     def is_on(self):
-        vn = self.source['variableName']
-        l = self.source['latest']
-
-        if l is None:
+        latest = self.source.latest
+        if latest is None:
             return None
 
-        if vn == 'motion':
-            return l['timeLastMotion'] / 1000 > time.time() - 60
-        elif vn == 'uplog':
-            return l['deviceUpState']['name'] in ['up', 'goingUp']
+        return self.source.value(latest)
 
     @property
     def state_attributes(self):
-        return self.source['latest']
+        return self.source.latest
@@ -1,29 +1,185 @@
 import asyncio
 import ssl
-import json
 import time
 import contextlib
+import itertools
 import logging
+from collections import OrderedDict
 
 import websockets.client
+
+from .codec import default_codec
+
 log = logging.getLogger(__name__)
 
+# What to do when a consumer queue is full.
+DROP_OLDEST = 'drop_oldest'  # Drop the oldest queued frame.
+COALESCE = 'coalesce'  # Replace a queued frame with the same key, else drop the oldest.
+DISCONNECT = 'disconnect'  # Stop the consumer with a SlowConsumerError.
+
+CONSUMER_QUEUE_SIZE = 10000
+
+# Seconds between PeriodicRequests, and how long to wait for their response
+# before the connection is considered dead.
+PERIODIC_INTERVAL = 30
+PERIODIC_TIMEOUT = 10
+
 
 @contextlib.asynccontextmanager
-async def connect(uri, **kwargs):
+async def connect(uri, codec=None, queue_size=CONSUMER_QUEUE_SIZE, overflow=DROP_OLDEST, **kwargs):
     async with websockets.client.connect(uri, **kwargs) as ws:
         ws._uri = uri
-        async with Cirrus(ws) as ws:
+        async with Cirrus(ws, codec, queue_size, overflow) as ws:
             yield ws
 
 
+class SlowConsumerError(RuntimeError):
+    '''Raised in a consumer that was disconnected for falling behind.'''
+
+
+def frame_key(message):
+    '''Frames with the same key can replace each other when coalescing.'''
+    if type(message) is not dict:
+        return None
+
+    return message.get('messageType'), tuple(
+        (dsa.get('did'), dsa.get('variableName', {}).get('name'), dsa.get('instanceNumber'))
+        for dsa in (item.get('dataSourceAddress', {}) for item in message.get('list', ())))
+
+
+def frame_location_id(message):
+    '''The locationId a frame belongs to, if it says.'''
+    if type(message) is not dict:
+        return None
+
+    items = message.get('list')
+    if items and type(items[0]) is dict and 'dataSourceAddress' in items[0]:
+        return items[0]['dataSourceAddress'].get('locationId')
+
+    for field in ['locationAddress', 'unitAddress', 'dataSourceAddress']:
+        if type(message.get(field)) is dict:
+            return message[field].get('locationId')
+
+    return None
+
+
+class ConsumerQueue:
+    '''A queue that never blocks the producer.
+
+    When more than `maxsize` frames are queued the `overflow` policy decides
+    what is thrown away, and `dropped`/`coalesced` count how often that
+    happened.
+    '''
+
+    def __init__(self, maxsize=CONSUMER_QUEUE_SIZE, overflow=DROP_OLDEST, key=frame_key, location_id=None):
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.key = key
+        self.location_id = location_id
+
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = False
+        self.exception = None
+
+        self._items = OrderedDict()
+        self._slots = {}
+        self._counter = itertools.count()
+        self._waiter = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def put_nowait(self, item):
+        if self.disconnected:
+            return
+
+        key = None
+        if self.maxsize and len(self._items) >= self.maxsize:
+            if self.overflow == DISCONNECT:
+                self.disconnected = True
+                self._items.clear()
+                self._slots.clear()
+                self._wake()
+                return
+
+            if self.overflow == COALESCE:
+                key = self.key(item)
+                slot = self._slots.get(key)
+                if slot is not None:
+                    self._items[slot] = (key, item)
+                    self.coalesced += 1
+                    return
+
+            self._forget(*self._items.popitem(last=False))
+            self.dropped += 1
+
+        if self.overflow == COALESCE and key is None:
+            key = self.key(item)
+
+        slot = next(self._counter)
+        self._items[slot] = (key, item)
+        if key is not None:
+            self._slots[key] = slot
+        self._wake()
+
+    def fail(self, exception):
+        '''Raise `exception` in the consumer once the queued frames are consumed.'''
+        self.exception = exception
+        self._wake()
+
+    async def get(self):
+        while not self._items:
+            if self.exception is not None:
+                raise self.exception
+            if self.disconnected:
+                raise SlowConsumerError(
+                    f'Consumer fell more than {self.maxsize} frames behind')
+
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        return self._forget(*self._items.popitem(last=False))
+
+    def _forget(self, slot, entry):
+        key, item = entry
+        if key is not None and self._slots.get(key) == slot:
+            del self._slots[key]
+        return item
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
 class Cirrus:
-    def __init__(self, ws: websockets.client.WebSocketClientProtocol):
+    def __init__(self, ws: websockets.client.WebSocketClientProtocol, codec=None,
+                 queue_size=CONSUMER_QUEUE_SIZE, overflow=DROP_OLDEST,
+                 periodic_interval=PERIODIC_INTERVAL, periodic_timeout=PERIODIC_TIMEOUT):
         self.ws = ws
+        self.codec = codec or default_codec()
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.periodic_interval = periodic_interval
+        self.periodic_timeout = periodic_timeout
         self._current_message_id = 0
 
-        self._consumers = []
+        # Consumers by the locationId they watch, None watches everything.
+        self._location_consumers = {}
+        self._pending = {}
         self.exception = None
+        self._closed = asyncio.Event()
+
+        # messageType -> [count, total seconds, max seconds] until the first response.
+        self.round_trips = {}
+
+        # Frames lost by consumers that have already gone away.
+        self._dropped = 0
+        self._coalesced = 0
+        self._disconnected = 0
 
     async def __aenter__(self):
         self._producer_task = asyncio.create_task(self._producer())
@@ -39,57 +195,156 @@ class Cirrus:
         try:
             while True:
                 res = await self.ws.recv()
-                await self._put(res)
-        except websockets.ConnectionClosedOK:
-            pass
+                if type(res) is str:
+                    self._route(self.codec.loads(res))
+                else:
+                    self._put(res)
         except Exception as e:
-            self.exception = e
+            self._fail(e)
+
+    def _route(self, message):
+        message_id = message.get('messageIdentifier', {}).get('messageId')
+        waiter = self._pending.get(message_id)
+
+        if waiter is None:
+            self._put(message)
+        elif isinstance(waiter, asyncio.Future):
+            if not waiter.done():
+                waiter.set_result(message)
+        else:
+            waiter.put_nowait(message)
+
+    def _fail(self, exception):
+        '''Stop everyone waiting on this connection, it won't recover.'''
+        if self.exception is None:
+            self.exception = exception
+        self._closed.set()
+        self._fail_pending(exception)
+        for q in self._consumers:
+            q.fail(exception)
+
+    def _fail_pending(self, exception):
+        for waiter in self._pending.values():
+            if isinstance(waiter, asyncio.Future):
+                if not waiter.done():
+                    waiter.set_exception(exception)
+            else:
+                waiter.put_nowait(exception)
 
     async def _periodic(self):
+        # A missing response means the socket is dead even if it hasn't been
+        # closed yet, so fail fast and let the consumers reconnect.
         try:
             while True:
-                response = await self.request({'messageType': 'PeriodicRequest'})
-                await asyncio.sleep(120)
+                response = await self.request({'messageType': 'PeriodicRequest'}, self.periodic_timeout)
                 if response['responseCode']['name'] != 'success':
                     raise RuntimeError(f'PeriodicRequest failed: {response}')
+                await asyncio.sleep(self.periodic_interval)
+        except asyncio.TimeoutError:
+            self._fail(ConnectionError(
+                f'No response to PeriodicRequest within {self.periodic_timeout} seconds'))
         except Exception as e:
-            self.exception = e
+            self._fail(e)
 
-    async def _put(self, res):
-        for q in self._consumers:
-            await q.put(res)
+    @property
+    def _consumers(self):
+        return [q for queues in self._location_consumers.values() for q in queues]
+
+    def _put(self, res):
+        for q in self._location_consumers.get(None, ()):
+            q.put_nowait(res)
+
+        location_id = frame_location_id(res)
+        if location_id is not None:
+            for q in self._location_consumers.get(location_id, ()):
+                q.put_nowait(res)
+
+    async def wait_closed(self):
+        '''Wait until the connection has failed or closed, returning why.'''
+        await self._closed.wait()
+        return self.exception
+
+    @property
+    def stats(self):
+        '''Frames dropped or coalesced because a consumer fell behind.'''
+        consumers = self._consumers
+        return {
+            'consumers': len(consumers),
+            'queued': sum(len(q) for q in consumers),
+            'dropped': self._dropped + sum(q.dropped for q in consumers),
+            'coalesced': self._coalesced + sum(q.coalesced for q in consumers),
+            'disconnected': self._disconnected + sum(q.disconnected for q in consumers),
+            'in_flight': len(self._pending),
+            'round_trips': {
+                message_type: {
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'max': longest,
+                }
+                for message_type, (count, total, longest) in self.round_trips.items()
+            },
+        }
+
+    def _record_round_trip(self, request, start):
+        elapsed = time.monotonic() - start
+        stats = self.round_trips.setdefault(request.get('messageType'), [0, 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
 
     async def send_json(self, message):
-        await self.ws.send(json.dumps(message))
+        await self.ws.send(self.codec.dumps(message))
 
     async def send_binary(self, message):
         await self.ws.send(message)
 
-    async def _watch(self, timeout):
-        q = asyncio.Queue()
-        self._consumers.append(q)
+    def _add_consumer(self, maxsize=None, overflow=None, location_id=None):
+        q = ConsumerQueue(
+            self.queue_size if maxsize is None else maxsize,
+            overflow or self.overflow,
+            location_id=location_id)
+        if self.exception is not None:
+            q.fail(self.exception)
+        self._location_consumers.setdefault(location_id, []).append(q)
+        return q
+
+    def _remove_consumer(self, q):
+        queues = self._location_consumers[q.location_id]
+        queues.remove(q)
+        if not queues:
+            del self._location_consumers[q.location_id]
+        self._dropped += q.dropped
+        self._coalesced += q.coalesced
+        self._disconnected += q.disconnected
+        if q.dropped or q.coalesced or q.disconnected:
+            log.warning('Consumer fell behind: %d frames dropped, %d coalesced, disconnected: %s',
+                        q.dropped, q.coalesced, q.disconnected)
+
+    async def _watch(self, timeout, maxsize=None, overflow=None, location_id=None):
+        q = self._add_consumer(maxsize, overflow, location_id)
         try:
             while True:
-                item = await asyncio.wait_for(q.get(), timeout)
-
-                if self.exception:
-                    raise self.exception
-                else:
-                    yield item
+                yield await asyncio.wait_for(q.get(), timeout)
         finally:
-            self._consumers.remove(q)
+            self._remove_consumer(q)
 
-    async def watch(self, timeout=None):
-        async for message in self._watch(timeout):
-            if type(message) is str:
-                yield json.loads(message)
+    async def watch(self, timeout=None, maxsize=None, overflow=None, location_id=None):
+        '''Frames that are not responses to a request, optionally only those
+        of one location.'''
+        async for message in self._watch(timeout, maxsize, overflow, location_id):
+            if type(message) is dict:
+                yield message
 
-    async def watch_binary(self, timeout=None):
-        async for message in self._watch(timeout):
+    async def watch_binary(self, timeout=None, maxsize=None, overflow=None):
+        async for message in self._watch(timeout, maxsize, overflow):
             if type(message) is bytes:
                 yield message
 
-    async def send(self, request, timeout=30):
+    def _extend(self, request):
+        if self.exception is not None:
+            raise self.exception
+
         message_id = str(self._current_message_id)
         self._current_message_id += 1
         extended_request = {
@@ -100,25 +355,53 @@ class Cirrus:
             }
         }
 
-        await self.send_json(extended_request)
+        return message_id, extended_request
+
+    async def send(self, request, timeout=30, idle_timeout=None):
+        '''All responses to a request, until none has arrived for a while.
 
+        Waits `timeout` seconds for the first response and `idle_timeout`,
+        by default the same, for each following one.
+        '''
+        message_id, extended_request = self._extend(request)
+
+        q = asyncio.Queue()
+        self._pending[message_id] = q
         response_count = 0
+        start = time.monotonic()
         try:
-            async for response in self.watch(timeout):
-                if 'messageIdentifier' not in response:
-                    log.debug(
-                        'Ignoring response without messageIdentifier: %s', response)
-                elif response['messageIdentifier']['messageId'] == message_id:
-                    response_count += 1
-                    yield response
+            await self.send_json(extended_request)
+
+            while True:
+                response = await asyncio.wait_for(
+                    q.get(), timeout if response_count == 0 or idle_timeout is None else idle_timeout)
+                if isinstance(response, Exception):
+                    raise response
+
+                if response_count == 0:
+                    self._record_round_trip(request, start)
+                response_count += 1
+                yield response
 
         except asyncio.TimeoutError as e:
             if response_count == 0:
                 raise e
+        finally:
+            self._pending.pop(message_id, None)
 
     async def request(self, request, timeout=5):
-        async for response in self.send(request, timeout):
+        message_id, extended_request = self._extend(request)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message_id] = future
+        start = time.monotonic()
+        try:
+            await self.send_json(extended_request)
+            response = await asyncio.wait_for(future, timeout)
+            self._record_round_trip(request, start)
             return response
+        finally:
+            self._pending.pop(message_id, None)
 
     async def authenticate(self, credentials):
         response = await self.request({'messageType': 'LoginRequest', **credentials}, 30)
@@ -126,27 +409,60 @@ class Cirrus:
         self.session_id = session_id
         return session_id
 
-    async def subscribe(self, subscribe_request):
-        async def send_subscribe():
+    async def _request_subscription(self, subscribe_request):
+        '''Send a SubscribeRequest, returns the seconds until it expires.'''
+        log.debug('Sending subscribe request.')
+        response = await self.request(subscribe_request)
+        if response['responseCode']['name'] != 'success':
+            raise RuntimeError(
+                f'Error when sending SubscribeRequest to cirrus: {response}')
+        delay = response['expireTime'] / 1000 - time.time()
+        log.debug(
+            'Sending next subscribe request in %d seconds. (%d minutes)', delay, delay / 60)
+        return delay
+
+    async def _renew_subscription(self, subscribe_request, delay, q):
+        try:
             while True:
-                log.debug('Sending subscribe request.')
-                response = await self.request(subscribe_request)
-                if response['responseCode']['name'] != 'success':
-                    raise RuntimeError(
-                        f'Error when sending SubscribeRequest to cirrus: {response}')
-                delay = response['expireTime'] / 1000 - time.time()
-                log.debug(
-                    'Sending next subscribe request in %d seconds. (%d minutes)', delay, delay / 60)
                 await asyncio.sleep(delay)
+                delay = await self._request_subscription(subscribe_request)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Ends the iteration of the frames however quiet the location is.
+            q.fail(e)
 
-        subscription_task = asyncio.create_task(send_subscribe())
+    @contextlib.asynccontextmanager
+    async def subscription(self, subscribe_request):
+        '''Subscribe, giving an iterator of the SubscribeData frames.
 
+        The frames are queued from before the SubscribeRequest is sent, and
+        the subscription is live once the block is entered, so nothing is
+        missed by work done in the block before iterating.
+        '''
+        location_id = subscribe_request.get('unitAddress', {}).get('locationId')
+        q = self._add_consumer(location_id=location_id)
         try:
-            async for message in self.watch(timeout=120):
-                if message['messageType'] == 'SubscribeData':
-                    yield message
-                if subscription_task.done():
-                    raise subscription_task.exception()
+            delay = await self._request_subscription(subscribe_request)
+            subscription_task = asyncio.create_task(
+                self._renew_subscription(subscribe_request, delay, q))
+            try:
+                yield self._subscription_frames(q)
+            finally:
+                subscription_task.cancel()
         finally:
-            subscription_task.cancel()
+            self._remove_consumer(q)
             log.debug('Exiting subscription')
+
+    async def _subscription_frames(self, q):
+        # No idle timeout: a location may be quiet for long, and the
+        # PeriodicRequest keepalive already fails the queue of a dead socket.
+        while True:
+            message = await q.get()
+            if type(message) is dict and message['messageType'] == 'SubscribeData':
+                yield message
+
+    async def subscribe(self, subscribe_request):
+        async with self.subscription(subscribe_request) as frames:
+            async for message in frames:
+                yield message
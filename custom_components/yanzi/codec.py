@@ -0,0 +1,36 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonCodec:
+    '''Encodes and decodes Cirrus text frames with the standard library.'''
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, message):
+        return json.dumps(message)
+
+
+class OrjsonCodec:
+    '''Encodes and decodes Cirrus text frames with orjson.'''
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, message):
+        # Cirrus expects text frames, so the bytes are decoded back to str.
+        return orjson.dumps(message).decode()
+
+
+def default_codec():
+    '''The fastest codec available in this environment.'''
+    if orjson is not None:
+        return OrjsonCodec()
+    return JsonCodec()
@@ -4,92 +4,128 @@ import base64
 import voluptuous as vol
 
 from homeassistant import config_entries, core, exceptions
+from homeassistant.core import callback
+import homeassistant.helpers.config_validation as cv
 
-from .const import DOMAIN  # pylint:disable=unused-import
+from .const import DEVICE_PAGE_SIZE, DOMAIN, LOCATIONS_IDLE_TIMEOUT, LOCATIONS_TIMEOUT  # pylint:disable=unused-import
 from websockets.exceptions import WebSocketException
+from .accounts import async_get_accounts
 from .cirrus import connect
 
 _LOGGER = logging.getLogger(__name__)
 
 DATA_SCHEMA = vol.Schema({
     'host': str,
-    'location_id': str,
+    vol.Optional('location_id'): str,
     'username': str,
     'password': str,
 })
 
 
-async def validate_input(host, username, password):
-    credentials = {
-        'username': username,
-        'password': password
-    }
+async def authenticate(ws, credentials):
+    session_id = await ws.authenticate(credentials)
+    if not session_id:
+        raise InvalidAuth
+    else:
+        return session_id
 
-    async with connect(f'wss://{host}/cirrusAPI') as ws:
-        session_id = await ws.authenticate(credentials)
-        if not session_id:
-            raise InvalidAuth
-        else:
-            return session_id
 
+async def get_access_token(ws, location_id):
+    response = await ws.request({
+        'messageType': 'CirrusLocalRequest',
+        'localMessageType': 'configAPI',
+        'list': [{
+            'resourceType': 'BlobDTO',
+            'blobType': 'getAccessToken',
+            'blobData': base64.b64encode(location_id.encode()).decode()
+        }]
+    })
 
-async def get_access_token(host, session_id, location_id):
-    async with connect(f'wss://{host}/cirrusAPI') as ws:
-        await ws.authenticate({'sessionId': session_id})
-        response = await ws.request({
-            'messageType': 'CirrusLocalRequest',
-            'localMessageType': 'configAPI',
-            'list': [{
-                'resourceType': 'BlobDTO',
-                'blobType': 'getAccessToken',
-                'blobData': base64.b64encode(location_id.encode()).decode()
-            }]
-        })
+    return base64.b64decode(response['list'][0]['blobData']).decode()
 
-        return base64.b64decode(response['list'][0]['blobData']).decode()
 
+async def get_locations(ws, location_id=None):
+    '''Names of the locations the session has access to, by location id.
 
-async def get_location_name(host, session_id, location_id):
-    async with connect(f'wss://{host}/cirrusAPI') as ws:
-        await ws.authenticate({'sessionId': session_id})
-        async for response in ws.send({'messageType': 'GetLocationsRequest'}):
-            for location in response['list']:
-                if location['locationAddress']['locationId'] == location_id:
-                    return location['name']
+    Stops as soon as `location_id` has been listed, if given.
+    '''
+    locations = {}
+    async for response in ws.send({'messageType': 'GetLocationsRequest'},
+                                  LOCATIONS_TIMEOUT, LOCATIONS_IDLE_TIMEOUT):
+        for location in response['list']:
+            locations[location['locationAddress']['locationId']] = location['name']
+        if location_id in locations:
+            break
+
+    return locations
 
-        raise InvalidLocation
+
+async def get_access_tokens(host, session_id, location_ids):
+    '''Access tokens for several locations over a single connection.'''
+    async with connect(f'wss://{host}/cirrusAPI') as ws:
+        await authenticate(ws, {'sessionId': session_id})
+        return {
+            location_id: await get_access_token(ws, location_id)
+            for location_id in location_ids
+        }
 
 
 class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     '''Handle a config flow for yanzi.'''
 
-    VERSION = 1
+    VERSION = 2
     CONNECTION_CLASS = config_entries.CONN_CLASS_CLOUD_PUSH
 
+    def __init__(self):
+        self._host = None
+        self._username = None
+        self._password = None
+        self._session_id = None
+        self._locations = {}
+        self._reauth_entry = None
+
     async def async_step_user(self, user_input=None):
-        '''Handle the initial step.'''
+        '''Handle the initial step.
+
+        Logging in, listing locations and getting an access token all happen
+        over one connection. Without a location id all locations are listed
+        to pick from in the next step.
+        '''
         errors = {}
         if user_input is not None:
             try:
                 host = user_input['host']
                 username = user_input['username']
                 password = user_input['password']
-                location_id = user_input['location_id']
+                location_id = user_input.get('location_id')
 
-                await self.async_set_unique_id(f'yanzi://{username}@{host}/{location_id}')
-                self._abort_if_unique_id_configured()
-
-                session_id = await validate_input(host, username, password)
-                access_token = await get_access_token(host, session_id, location_id)
-                location_name = await get_location_name(host, session_id, location_id)
+                if location_id:
+                    await self.async_set_unique_id(f'yanzi://{username}@{host}/{location_id}')
+                    self._abort_if_unique_id_configured()
 
-                return self.async_create_entry(
-                    title=f'{location_name} ({location_id})',
-                    data={
-                        'host': host,
-                        'location_id': location_id,
-                        'access_token': access_token
+                async with connect(f'wss://{host}/cirrusAPI') as ws:
+                    session_id = await authenticate(ws, {
+                        'username': username,
+                        'password': password
                     })
+                    locations = await get_locations(ws, location_id)
+
+                    if not location_id:
+                        self._host = host
+                        self._username = username
+                        self._password = password
+                        self._session_id = session_id
+                        self._locations = locations
+                        return await self.async_step_locations()
+
+                    if location_id not in locations:
+                        raise InvalidLocation
+
+                    access_token = await get_access_token(ws, location_id)
+
+                await async_get_accounts(self.hass).async_set(host, username, password)
+                return self._create_entry(
+                    host, username, location_id, locations[location_id], access_token)
             except WebSocketException as e:
                 _LOGGER.exception(e)
                 errors['base'] = 'cannot_connect'
@@ -107,6 +143,175 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             step_id='user', data_schema=DATA_SCHEMA, errors=errors
         )
 
+    async def async_step_locations(self, user_input=None):
+        '''Pick any number of locations to add at once.'''
+        configured = {
+            entry.unique_id for entry in self._async_current_entries()}
+        available = {
+            location_id: f'{name} ({location_id})'
+            for location_id, name in self._locations.items()
+            if self._unique_id(location_id) not in configured
+        }
+        if not available:
+            return self.async_abort(reason='already_configured')
+
+        errors = {}
+        if user_input is not None and user_input.get('location_ids'):
+            location_ids = user_input['location_ids']
+            try:
+                access_tokens = await get_access_tokens(
+                    self._host, self._session_id, location_ids)
+            except WebSocketException as e:
+                _LOGGER.exception(e)
+                errors['base'] = 'cannot_connect'
+            except Exception as e:  # pylint: disable=broad-except
+                _LOGGER.exception(e)
+                errors['base'] = 'unknown'
+            else:
+                await async_get_accounts(self.hass).async_set(
+                    self._host, self._username, self._password)
+                for location_id in location_ids[1:]:
+                    self.hass.async_create_task(self.hass.config_entries.flow.async_init(
+                        DOMAIN,
+                        context={'source': config_entries.SOURCE_IMPORT},
+                        data={
+                            'host': self._host,
+                            'username': self._username,
+                            'location_id': location_id,
+                            'location_name': self._locations[location_id],
+                            'access_token': access_tokens[location_id],
+                        }))
+
+                location_id = location_ids[0]
+                await self.async_set_unique_id(self._unique_id(location_id))
+                self._abort_if_unique_id_configured()
+                return self._create_entry(
+                    self._host, self._username, location_id, self._locations[location_id], access_tokens[location_id])
+
+        return self.async_show_form(
+            step_id='locations',
+            data_schema=vol.Schema({
+                vol.Required('location_ids'): cv.multi_select(available),
+            }),
+            errors=errors)
+
+    async def async_step_import(self, import_data):
+        '''Add a location picked together with others in the locations step.'''
+        await self.async_set_unique_id(
+            f'yanzi://{import_data["username"]}@{import_data["host"]}/{import_data["location_id"]}')
+        self._abort_if_unique_id_configured()
+
+        return self._create_entry(
+            import_data['host'], import_data['username'], import_data['location_id'], import_data['location_name'], import_data['access_token'])
+
+    def _unique_id(self, location_id):
+        return f'yanzi://{self._username}@{self._host}/{location_id}'
+
+    async def async_step_reauth(self, entry_data):
+        '''Ask for the password again when the login of an entry is refused.'''
+        self._reauth_entry = self.hass.config_entries.async_get_entry(self.context['entry_id'])
+        self._host = entry_data['host']
+        self._username = entry_data.get('username')
+        return await self.async_step_reauth_confirm()
+
+    async def async_step_reauth_confirm(self, user_input=None):
+        '''Check the new password, then reload every location of the account.
+
+        Entries from before the account login get one too.
+        '''
+        errors = {}
+        if user_input is not None:
+            username = self._username or user_input['username']
+            try:
+                async with connect(f'wss://{self._host}/cirrusAPI') as ws:
+                    await authenticate(ws, {
+                        'username': username,
+                        'password': user_input['password']
+                    })
+            except WebSocketException as e:
+                _LOGGER.exception(e)
+                errors['base'] = 'cannot_connect'
+            except InvalidAuth as e:
+                _LOGGER.exception(e)
+                errors['base'] = 'invalid_auth'
+            except Exception as e:  # pylint: disable=broad-except
+                _LOGGER.exception(e)
+                errors['base'] = 'unknown'
+            else:
+                await async_get_accounts(self.hass).async_set(
+                    self._host, username, user_input['password'])
+                if self._username is None:
+                    self.hass.config_entries.async_update_entry(
+                        self._reauth_entry, data={**self._reauth_entry.data, 'username': username})
+                return self._async_reload_account(username)
+
+        schema = {'password': str}
+        if self._username is None:
+            schema = {'username': str, **schema}
+        return self.async_show_form(
+            step_id='reauth_confirm',
+            data_schema=vol.Schema(schema),
+            description_placeholders={'host': self._host},
+            errors=errors)
+
+    def _async_reload_account(self, username):
+        entry_ids = {self._reauth_entry.entry_id} | {
+            entry.entry_id for entry in self._async_current_entries()
+            if entry.data['host'] == self._host and entry.data.get('username') == username
+        }
+        for entry_id in entry_ids:
+            self.hass.async_create_task(self.hass.config_entries.async_reload(entry_id))
+
+        # The other locations of the account may have asked as well.
+        for flow in self._async_in_progress():
+            if flow['context'].get('source') == config_entries.SOURCE_REAUTH and \
+                    flow['context'].get('entry_id') in entry_ids:
+                self.hass.config_entries.flow.async_abort(flow['flow_id'])
+
+        return self.async_abort(reason='reauth_successful')
+
+    def _create_entry(self, host, username, location_id, location_name, access_token):
+        # The account login, stored once in YanziAccounts, lets all
+        # locations on the host share a connection.
+        return self.async_create_entry(
+            title=f'{location_name} ({location_id})',
+            data={
+                'host': host,
+                'username': username,
+                'location_id': location_id,
+                'access_token': access_token
+            })
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        return OptionsFlow(config_entry)
+
+
+class OptionsFlow(config_entries.OptionsFlow):
+    '''Handle the options of a yanzi location.'''
+
+    def __init__(self, config_entry):
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input=None):
+        '''Manage the options.'''
+        if user_input is not None:
+            return self.async_create_entry(title='', data=user_input)
+
+        options = self.config_entry.options
+        return self.async_show_form(
+            step_id='init',
+            data_schema=vol.Schema({
+                vol.Optional('page_size', default=options.get('page_size', DEVICE_PAGE_SIZE)):
+                    vol.All(int, vol.Range(min=1)),
+                vol.Optional('coalesce', default=options.get('coalesce', True)): bool,
+                vol.Optional('statistics_sensors', default=options.get('statistics_sensors', False)): bool,
+                vol.Optional('aggregate_interval', default=options.get('aggregate_interval', 0)):
+                    vol.All(int, vol.Range(min=0)),
+                vol.Optional('sample_events', default=options.get('sample_events', True)): bool,
+            }))
+
 
 class InvalidAuth(exceptions.HomeAssistantError):
     '''Error to indicate there is invalid auth.'''
@@ -4,3 +4,71 @@ from datetime import timedelta
 DOMAIN = "yanzi"
 
 SCAN_INTERVAL = timedelta(minutes=10)
+
+# Sent with a list of (device, source) pairs found by an inventory refresh.
+SIGNAL_NEW_SOURCES = 'yanzi_new_sources_{}'
+
+# Sent when the metrics of a location have been updated.
+SIGNAL_METRICS = 'yanzi_metrics_{}'
+METRICS_INTERVAL = timedelta(seconds=5)
+
+# Number of GetSamplesRequests kept in flight when loading initial state.
+LATEST_SAMPLES_CONCURRENCY = 32
+
+# Number of units fetched per page of the inventory GraphQL query.
+DEVICE_PAGE_SIZE = 100
+
+# Version of the cached inventory in .storage, and how long to wait before
+# writing it after a change (seconds).
+STORAGE_VERSION = 1
+CACHE_SAVE_DELAY = 30
+
+# Minimum seconds between state writes for chatty variables. Samples in
+# between are coalesced, keeping the latest, unless they change significantly.
+COALESCE_INTERVALS = {
+    'totalPowerInst': 5,
+    'totalEnergy': 5,
+    'soundPressureLevel': 5,
+    'motion': 1,
+}
+
+# Seconds after the last motion that a motion sensor turns off.
+MOTION_TIMEOUT = 60
+
+# Reconnection backoff (seconds). A connection that stayed up for
+# STABLE_CONNECTION seconds starts over with an immediate retry.
+RECONNECT_BASE = 1
+RECONNECT_CAP = 300
+STABLE_CONNECTION = 60
+
+# Samples missed while disconnected are backfilled up to this many seconds back.
+BACKFILL_MAX_AGE = 6 * 60 * 60
+
+# Samples kept per key between two min/mean/max aggregates, beyond which
+# the oldest are overwritten.
+AGGREGATE_BUFFER_SIZE = 1024
+
+# History imports fetch samples in pages of HISTORY_PAGE seconds, for at
+# most HISTORY_CONCURRENCY sources at once, and hand them to the recorder
+# HISTORY_BATCH hours at a time.
+HISTORY_PAGE = 6 * 60 * 60
+HISTORY_CONCURRENCY = 4
+HISTORY_BATCH = 1000
+
+# Gaps between power samples longer than ENERGY_MAX_GAP seconds are not
+# integrated into the energy totals.
+ENERGY_MAX_GAP = 15 * 60
+
+# Cirrus may list locations over several responses. The config flow waits
+# this long (seconds) for the first one, and LOCATIONS_IDLE_TIMEOUT for each
+# following one, unless the location it looks for has already been listed.
+LOCATIONS_TIMEOUT = 5
+LOCATIONS_IDLE_TIMEOUT = 0.5
+
+# hass.data key of the CirrusPool shared by all config entries.
+DATA_POOL = 'yanzi_pool'
+
+# hass.data key of the YanziAccounts, and the .storage key of the account
+# logins, which are stored once however many locations use them.
+DATA_ACCOUNTS = 'yanzi_accounts'
+ACCOUNTS_STORAGE_KEY = f'{DOMAIN}.accounts'
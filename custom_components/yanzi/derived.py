@@ -0,0 +1,205 @@
+import logging
+import math
+
+from operator import itemgetter
+
+from .records import YanziSource
+from .variables import describe
+
+log = logging.getLogger(__name__)
+
+
+class Derivation:
+    '''A variable of a device that is computed from other variables of it.
+
+    `inputs` are variable names, or (variable name, extractor) pairs when
+    something other than the descriptor value of the input is needed.
+    `compute(*values)` gets the input values and returns the derived value,
+    or None if there is none.
+
+    A derivation with one input is computed by the entities of the derived
+    source from the input's samples, without any work in the sample path.
+    One with several inputs is evaluated by DerivedVariables each time one
+    of its inputs changes.
+    '''
+
+    __slots__ = ('variable_name', 'inputs', 'compute', 'si_unit')
+
+    def __init__(self, variable_name, inputs, compute, si_unit='NA'):
+        self.variable_name = variable_name
+        self.inputs = [
+            (variable, describe(variable).value) if isinstance(variable, str) else tuple(variable)
+            for variable in inputs
+        ]
+        self.compute = compute
+        self.si_unit = si_unit
+
+
+def derive(device, sources):
+    '''The sources of a device, with the variables of DERIVATIONS added.
+
+    Every source of the first input of a derivation gets a derived source,
+    under its key with the variable name replaced, so each channel of a
+    multi-channel unit is derived on its own. The other inputs come from the
+    same did and instance, or, for units like the Comfort sensor that report
+    each quantity from a child of its own, from the only source of that
+    variable on the device. A derived variable that is already one of the
+    sources, like the temperatureC that Cirrus lists but never sends samples
+    for, is computed in place.
+    '''
+    by_key = {source.key: source for source in sources}
+    by_variable = {}
+    for source in sources:
+        by_variable.setdefault(source.variable_name, []).append(source)
+
+    for derivation in DERIVATIONS:
+        (variable, _), others = derivation.inputs[0], derivation.inputs[1:]
+        firsts = list(by_variable.get(variable, []))
+        for first in firsts:
+            inputs = [first] + [
+                _matching_input(by_variable, first, len(firsts) == 1, other)
+                for other, _ in others
+            ]
+            if None in inputs:
+                continue
+
+            key = replace_variable(first.key, derivation.variable_name)
+            source = by_key.get(key)
+            if source is None:
+                source = by_key[key] = YanziSource(
+                    key, first.did, derivation.variable_name, derivation.si_unit, device)
+                sources.append(source)
+                by_variable.setdefault(derivation.variable_name, []).append(source)
+
+            source.derive(derivation, inputs)
+
+    return sources
+
+
+def _matching_input(by_variable, first, unique, variable_name):
+    candidates = by_variable.get(variable_name, [])
+    channel = _channel(first)
+    for candidate in candidates:
+        if _channel(candidate) == channel:
+            return candidate
+
+    if unique and len(candidates) == 1:
+        return candidates[0]
+    return None
+
+
+def _channel(source):
+    return source.did, source.key.rsplit('/', 1)[-1]
+
+
+def replace_variable(key, variable_name):
+    parts = key.split('/')
+    if len(parts) != 5:
+        return f'{key}/{variable_name}'
+    parts[3] = variable_name
+    return '/'.join(parts)
+
+
+class _Input:
+    __slots__ = ('extractor', 'value', 'dependents')
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.value = None
+        self.dependents = []
+
+
+class _Derived:
+    __slots__ = ('source', 'inputs', 'value')
+
+    def __init__(self, source, inputs):
+        self.source = source
+        self.inputs = inputs
+        self.value = None
+
+
+class DerivedVariables:
+    '''Evaluates the derivations with several inputs of a location.
+
+    Each input key keeps the last value of every extractor used on it, so
+    an input shared by several derivations is extracted once per sample,
+    and a derivation is only computed again when one of its values changed.
+    '''
+
+    def __init__(self):
+        self._inputs = {}
+
+    def add(self, source):
+        '''Start evaluating a derived source with several inputs.'''
+        if not source.inputs:
+            return
+
+        inputs = []
+        for key, extractor in source.inputs:
+            entries = self._inputs.setdefault(key, [])
+            entry = next((x for x in entries if x.extractor is extractor), None)
+            if entry is None:
+                entry = _Input(extractor)
+                entries.append(entry)
+            inputs.append(entry)
+
+        derived = _Derived(source, inputs)
+        for entry in inputs:
+            entry.dependents.append(derived)
+
+    def update(self, key, sample, emit):
+        '''Feed a sample, calling `emit(key, sample)` for every derived value that changed.'''
+        entries = self._inputs.get(key)
+        if entries is None:
+            return
+
+        for entry in entries:
+            try:
+                value = entry.extractor(sample)
+            except (KeyError, TypeError, ValueError):
+                continue
+            if value is None or value == entry.value:
+                continue
+
+            entry.value = value
+            for derived in entry.dependents:
+                self._evaluate(derived, sample, emit)
+
+    def _evaluate(self, derived, sample, emit):
+        values = [entry.value for entry in derived.inputs]
+        if None in values:
+            return
+
+        try:
+            value = derived.source.derivation.compute(*values)
+        except (ArithmeticError, ValueError) as e:
+            log.debug('Failed to derive %s from %s: %s', derived.source.key, values, e)
+            return
+
+        if value is None or value == derived.value:
+            return
+
+        derived.value = value
+        emit(derived.source.key, {'value': value, 'sampleTime': sample.get('sampleTime')})
+
+
+def _kelvin_to_celsius(kelvin):
+    return round(kelvin - 273.15, 2)
+
+
+def _dew_point(kelvin, relative_humidity):
+    # Magnus formula, good to within 0.35 °C between -45 and 60 °C.
+    if relative_humidity <= 0:
+        return None
+    celsius = kelvin - 273.15
+    gamma = math.log(relative_humidity / 100) + 17.62 * celsius / (243.12 + celsius)
+    return round(243.12 * gamma / (17.62 - gamma), 2)
+
+
+DERIVATIONS = [
+    Derivation('temperatureC', ['temperatureK'], _kelvin_to_celsius, 'celsius'),
+    # The power samples carry the energy counter of the device, mWs -> Wh.
+    Derivation('totalEnergy', [('totalPowerInst', itemgetter('totalEnergy'))],
+               lambda energy: energy / (3600 * 1000), 'mWs'),
+    Derivation('dewPoint', ['temperatureK', 'relativeHumidity'], _dew_point, 'celsius'),
+]
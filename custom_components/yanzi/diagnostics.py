@@ -0,0 +1,20 @@
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+TO_REDACT = ['access_token', 'password']
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry):
+    """Return diagnostics for a config entry."""
+    location = hass.data[DOMAIN][entry.entry_id]
+
+    return {
+        'entry': {
+            'data': async_redact_data(dict(entry.data), TO_REDACT),
+            'options': dict(entry.options),
+        },
+        'metrics': location.metrics.latest,
+    }
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+
+from .const import MOTION_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+# Sample fields compared to decide if a change is significant.
+SIGNIFICANT_FIELDS = ['value', 'instantPower', 'max']
+SIGNIFICANT_RELATIVE_CHANGE = 0.1
+
+
+def significant_change(previous, sample):
+    '''Whether `sample` differs enough from `previous` to be shown at once.'''
+    if 'timeLastMotion' in sample:
+        # Motion after a quiet period turns a motion sensor on.
+        return sample['timeLastMotion'] - previous.get('timeLastMotion', 0) > MOTION_TIMEOUT * 1000
+
+    for field in SIGNIFICANT_FIELDS:
+        old = previous.get(field)
+        new = sample.get(field)
+        if type(new) not in (int, float) or type(old) not in (int, float):
+            continue
+
+        return abs(new - old) > abs(old) * SIGNIFICANT_RELATIVE_CHANGE
+
+    return False
+
+
+class Coalescer:
+    '''Wraps a listener so that it is called at most once every `interval` seconds.
+
+    Samples arriving in between replace each other and the latest one is
+    delivered when the interval has passed, unless `significant(previous,
+    sample)` says it can't wait.
+    '''
+
+    def __init__(self, listener, interval, significant=significant_change):
+        self.listener = listener
+        self.interval = interval
+        self.significant = significant
+
+        self.coalesced = 0
+
+        self._last_flush = None
+        self._flushed = None
+        self._pending = None
+        self._timer = None
+
+    def __call__(self, sample):
+        now = time.monotonic()
+
+        if self._last_flush is None or now - self._last_flush >= self.interval or \
+                (self.significant is not None and self.significant(self._flushed, sample)):
+            self.cancel()
+            self._flush(sample, now)
+            return
+
+        if self._pending is not None:
+            self.coalesced += 1
+        self._pending = sample
+
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._last_flush + self.interval - now, self._flush_pending)
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending is not None:
+            self.coalesced += 1
+            self._pending = None
+
+    def _flush_pending(self):
+        self._timer = None
+        sample, self._pending = self._pending, None
+        try:
+            self._flush(sample, time.monotonic())
+        except Exception:
+            log.exception('Error flushing coalesced sample')
+
+    def _flush(self, sample, now):
+        self._last_flush = now
+        self._flushed = sample
+        self.listener(sample)
+
+
+class YanziDispatcher:
+    '''Routes samples to the listeners registered for their key.
+
+    Listeners are indexed by the key produced by `dsa_to_key`, so a sample
+    only wakes up the entities that own it, no matter how many entities
+    the location has.
+    '''
+
+    def __init__(self):
+        self._listeners = {}
+
+    def __len__(self):
+        return len(self._listeners)
+
+    def __contains__(self, key):
+        return key in self._listeners
+
+    def subscribe(self, key, listener, interval=None):
+        '''Call `listener(sample)` for every sample dispatched on `key`.
+
+        With an `interval` (seconds) bursts of samples are coalesced, see
+        `Coalescer`. Returns a function that removes the listener again.
+        '''
+        coalescer = None
+        if interval:
+            listener = coalescer = Coalescer(listener, interval)
+
+        # Listeners are stored as tuples and replaced on change, so dispatch
+        # never has to copy the list to guard against concurrent removal.
+        self._listeners[key] = self._listeners.get(key, ()) + (listener,)
+
+        def unsubscribe():
+            listeners = tuple(
+                x for x in self._listeners.get(key, ()) if x is not listener)
+            if listeners:
+                self._listeners[key] = listeners
+            else:
+                self._listeners.pop(key, None)
+
+            if coalescer is not None:
+                coalescer.cancel()
+
+        return unsubscribe
+
+    def dispatch(self, key, sample):
+        '''Deliver `sample` to the listeners of `key`.
+
+        Returns True if anyone was listening.
+        '''
+        listeners = self._listeners.get(key)
+        if listeners is None:
+            return False
+
+        for listener in listeners:
+            try:
+                listener(sample)
+            except Exception:
+                log.exception('Error dispatching sample for %s', key)
+
+        return True
@@ -0,0 +1,116 @@
+import logging
+
+from .const import ENERGY_MAX_GAP
+
+log = logging.getLogger(__name__)
+
+# Indices into an accumulator list, which is kept as a list so that it can
+# be stored as is.
+ENERGY, TIME, POWER, DEBT = range(4)
+
+
+class EnergyIntegrator:
+    '''Running energy totals (Wh) per key, integrated from instantPower samples.
+
+    Samples are integrated with the trapezoidal rule as they arrive. Gaps
+    longer than ENERGY_MAX_GAP are not integrated, since the power in between
+    is unknown. Samples that carry the totalEnergy counter of the device are
+    reconciled with it instead. `reconcile` brings a total in line with the
+    counter without ever making it decrease: if the integrated total is
+    ahead, the difference is paid off from the next increments instead.
+    '''
+
+    def __init__(self, max_gap=ENERGY_MAX_GAP):
+        self.max_gap = max_gap * 1000
+        self._accumulators = {}
+
+    def total(self, key):
+        accumulator = self._accumulators.get(key)
+        if accumulator is None:
+            return None
+        return accumulator[ENERGY]
+
+    def add(self, key, sample):
+        '''Integrate an instantPower sample into the total of `key`.
+
+        Samples without power, or older than the last one, are ignored.
+        '''
+        power = sample.get('instantPower')
+        sample_time = sample.get('sampleTime')
+        if power is None or sample_time is None:
+            return
+
+        accumulator = self._accumulators.get(key)
+        if accumulator is not None and sample_time < accumulator[TIME]:
+            return
+
+        if sample.get('totalEnergy') is not None:
+            self.reconcile(key, sample)
+            self._accumulators[key][POWER] = power
+            return
+
+        if accumulator is None:
+            # The total stays unknown until it is reconciled with the device.
+            self._accumulators[key] = [None, sample_time, power, 0]
+            return
+
+        elapsed = sample_time - accumulator[TIME]
+        if accumulator[ENERGY] is not None and accumulator[POWER] is not None and elapsed <= self.max_gap:
+            increment = (accumulator[POWER] + power) / 2 * elapsed / 3600000
+            if accumulator[DEBT]:
+                paid = min(accumulator[DEBT], increment)
+                accumulator[DEBT] -= paid
+                increment -= paid
+            accumulator[ENERGY] += increment
+
+        accumulator[TIME] = sample_time
+        accumulator[POWER] = power
+
+    def reconcile(self, key, sample):
+        '''Correct the total of `key` with a totalEnergy sample of the device.
+
+        Returns the difference between the device and the integrated total.
+        '''
+        device_energy = sample.get('totalEnergy')
+        sample_time = sample.get('sampleTime')
+        if device_energy is None or sample_time is None:
+            return None
+
+        # mWs -> Wh
+        device_energy = device_energy / (3600 * 1000)
+
+        accumulator = self._accumulators.get(key)
+        if accumulator is None:
+            self._accumulators[key] = [device_energy, sample_time, None, 0]
+            return None
+
+        if sample_time < accumulator[TIME]:
+            if accumulator[POWER] is not None:
+                # Estimate what the device counter would read now.
+                device_energy += accumulator[POWER] * (accumulator[TIME] - sample_time) / 3600000
+        else:
+            # The counter already includes everything up to its sample.
+            accumulator[TIME] = sample_time
+
+        if accumulator[ENERGY] is None:
+            accumulator[ENERGY] = device_energy
+            return None
+
+        drift = device_energy - accumulator[ENERGY]
+        if drift >= 0:
+            accumulator[ENERGY] = device_energy
+            accumulator[DEBT] = 0
+        else:
+            accumulator[DEBT] = -drift
+
+        log.debug('Reconciled energy of %s, drift %.3f Wh', key, drift)
+        return drift
+
+    def dump(self):
+        '''A JSON serializable copy of the accumulators.'''
+        return {key: list(accumulator) for key, accumulator in self._accumulators.items()}
+
+    def load(self, data):
+        '''Restore accumulators from a `dump()`.'''
+        for key, accumulator in data.items():
+            self._accumulators.setdefault(key, list(accumulator))
@@ -0,0 +1,142 @@
+import logging
+import time
+
+from datetime import datetime, timezone
+
+from homeassistant.components.recorder import get_instance
+from homeassistant.components.recorder.statistics import async_add_external_statistics, get_last_statistics
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN, HISTORY_BATCH
+
+log = logging.getLogger(__name__)
+
+HOUR = 60 * 60 * 1000
+
+
+class HourlyStatistics:
+    '''Folds samples, oldest first, into hourly rows of long-term statistics.
+
+    Measurements get the mean, min and max of each hour. Counters get the
+    last state of each hour and a sum that keeps growing across resets.
+    Only the hour being filled is kept, so memory does not depend on how
+    much history is folded.
+    '''
+
+    def __init__(self, value, has_sum=False, last_state=None, last_sum=0):
+        self.value = value
+        self.has_sum = has_sum
+        self._hour = None
+        self._count = 0
+        self._total = 0
+        self._min = None
+        self._max = None
+        # The last state and sum of earlier rows, for counters to continue from.
+        self._state = last_state
+        self._sum = last_sum
+
+    def add(self, samples):
+        '''Fold in samples, returns the rows of the hours that were completed.'''
+        rows = []
+        for sample in samples:
+            sample_time = sample.get('sampleTime')
+            try:
+                value = float(self.value(sample))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if sample_time is None:
+                continue
+
+            hour = sample_time - sample_time % HOUR
+            if hour != self._hour:
+                if self._count:
+                    rows.append(self._row())
+                self._hour = hour
+                self._count = 0
+                self._total = 0
+                self._min = self._max = value
+
+            if self.has_sum and self._state is not None:
+                # A decreasing counter has been reset.
+                self._sum += value - self._state if value >= self._state else value
+
+            self._count += 1
+            self._total += value
+            self._min = min(self._min, value)
+            self._max = max(self._max, value)
+            self._state = value
+
+        return rows
+
+    def finish(self):
+        '''The row of the last hour, if any.'''
+        rows = [self._row()] if self._count else []
+        self._count = 0
+        return rows
+
+    def _row(self):
+        start = datetime.fromtimestamp(self._hour / 1000, timezone.utc)
+        if self.has_sum:
+            return {'start': start, 'state': self._state, 'sum': self._sum}
+        return {'start': start, 'mean': self._total / self._count, 'min': self._min, 'max': self._max}
+
+
+def statistic_id(entity_id):
+    '''The id of the external statistics imported for an entity.'''
+    return f'{DOMAIN}:{entity_id.replace(".", "_")}'
+
+
+async def async_import_history(hass: HomeAssistant, location, source, entity_id, start, end, name=None):
+    '''Import the samples of a source between two datetimes as hourly external statistics.
+
+    The statistics of an entity are kept under statistic_id(entity_id).
+    Counters continue from the sum of the last imported row if it is older
+    than `start`.
+    Samples are fetched a page at a time and handed to the recorder in
+    batches of HISTORY_BATCH hours.
+    '''
+    time_start = int(start.timestamp() * 1000)
+    # The hour in progress is incomplete, a later import brings it in.
+    time_end = min(int(end.timestamp() * 1000), int(time.time() * 1000) // HOUR * HOUR) - 1
+
+    has_sum = source.descriptor.state_class == 'total_increasing'
+    metadata = {
+        'has_mean': not has_sum,
+        'has_sum': has_sum,
+        'name': name,
+        'source': DOMAIN,
+        'statistic_id': statistic_id(entity_id),
+        'unit_of_measurement': source.unit_of_measurement,
+    }
+
+    last_state, last_sum = None, 0
+    if has_sum:
+        last = await get_instance(hass).async_add_executor_job(
+            get_last_statistics, hass, 1, metadata['statistic_id'], True, {'state', 'sum'})
+        for row in last.get(metadata['statistic_id'], []):
+            row_start = row['start']
+            if isinstance(row_start, datetime):
+                row_start = row_start.timestamp()
+            if row_start * 1000 < time_start and row.get('sum') is not None:
+                last_state, last_sum = row.get('state'), row['sum']
+
+    statistics = HourlyStatistics(source.value, has_sum, last_state, last_sum)
+
+    started = time.monotonic()
+    count = 0
+    rows = []
+    async for samples in location.get_history(source, time_start, time_end):
+        rows += statistics.add(samples)
+        if len(rows) >= HISTORY_BATCH:
+            async_add_external_statistics(hass, metadata, rows)
+            count += len(rows)
+            rows = []
+
+    rows += statistics.finish()
+    if rows:
+        async_add_external_statistics(hass, metadata, rows)
+        count += len(rows)
+
+    log.info('Imported %d hours of statistics for %s in %.1f seconds',
+             count, metadata['statistic_id'], time.monotonic() - started)
+    return count
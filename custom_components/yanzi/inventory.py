@@ -0,0 +1,135 @@
+import logging
+
+from .derived import derive
+from .dispatcher import YanziDispatcher
+from .records import YanziDevice, YanziSource
+
+log = logging.getLogger(__name__)
+
+
+def source_id(source):
+    # Caches from before derived sources got keys of their own hold a
+    # totalEnergy source under the key of totalPowerInst.
+    return source.key, source.variable_name
+
+
+class YanziInventory:
+    '''Keeps the device/source records of a location stable across refreshes.
+
+    Each refresh is diffed against the previous one: new sources are
+    reported as added, missing ones are flagged as removed, and changed
+    metadata is written into the existing records so that entities holding
+    references to them see the update.
+    '''
+
+    def __init__(self):
+        self._devices = {}
+        self._sources = {}
+        self._seen_devices = set()
+        self._seen_sources = set()
+        self.listeners = YanziDispatcher()
+
+    @property
+    def device_sources(self):
+        return [(device, source) for device, source in self._sources.values()
+                if not source.removed]
+
+    def dump(self):
+        '''A JSON serializable copy of the inventory, including latest samples.'''
+        devices = {}
+        for device, source in self.device_sources:
+            if device.key not in devices:
+                devices[device.key] = {
+                    **device.as_dict(),
+                    'dataSources': [],
+                }
+            devices[device.key]['dataSources'].append(source.as_dict())
+
+        return list(devices.values())
+
+    @staticmethod
+    def device_sources_from_dump(data):
+        '''The (device, source) pairs of a `dump()`.'''
+        for item in data:
+            device = YanziDevice.from_dict(item)
+            sources = [YanziSource.from_dict(source, device) for source in item['dataSources']]
+            for source in derive(device, sources):
+                yield device, source
+
+    def load(self, data):
+        '''Fill the inventory from a `dump()`.
+
+        Nothing loaded counts as seen, so the next refresh still updates every
+        device and flags the sources that are gone.
+        '''
+        self.merge(self.device_sources_from_dump(data))
+        self._seen_devices = set()
+        self._seen_sources = set()
+
+    def update(self, device_sources):
+        '''Replace the inventory with a complete list of (device, source) pairs.
+
+        Returns the list of pairs that were not known before.
+        '''
+        added = self.merge(device_sources)
+        self.prune()
+        return added
+
+    def merge(self, device_sources):
+        '''Merge (part of) a fresh list of (device, source) pairs.
+
+        Returns the list of pairs that were not known before.
+        '''
+        added = []
+        changed = set()
+
+        for device, source in device_sources:
+            existing_device = self._devices.get(device.key)
+            if existing_device is None:
+                self._devices[device.key] = existing_device = device
+            elif device.key not in self._seen_devices:
+                if existing_device.update(device):
+                    changed.update(
+                        sid for sid, (d, s) in self._sources.items() if d is existing_device)
+            self._seen_devices.add(device.key)
+
+            sid = source_id(source)
+            self._seen_sources.add(sid)
+
+            existing = self._sources.get(sid)
+            if existing is None:
+                source.device = existing_device
+                self._sources[sid] = (existing_device, source)
+                added.append((existing_device, source))
+                continue
+
+            existing_source = existing[1]
+            removed = existing_source.removed
+            existing_source.removed = False
+            if existing_source.update(source) or removed:
+                changed.add(sid)
+
+        log.debug('Inventory merge: %d added, %d changed',
+                  len(added), len(changed))
+        self.notify(changed)
+
+        return added
+
+    def prune(self):
+        '''Flag every source not merged since the last prune as removed.'''
+        changed = set()
+        for sid, (device, source) in self._sources.items():
+            if sid not in self._seen_sources and not source.removed:
+                source.removed = True
+                changed.add(sid)
+
+        self._seen_devices = set()
+        self._seen_sources = set()
+
+        log.debug('Inventory prune: %d removed', len(changed))
+        self.notify(changed)
+
+    def notify(self, changed):
+        '''Tell the listeners of the given source ids that their source changed.'''
+        for sid in changed:
+            self.listeners.dispatch(sid, self._sources[sid][1])
@@ -1,151 +1,202 @@
 import asyncio
+import json
 import logging
+import sys
 import time
-import json
 
 from concurrent.futures import CancelledError
 
-from .cirrus import connect
+from .const import (BACKFILL_MAX_AGE, CACHE_SAVE_DELAY, COALESCE_INTERVALS, DEVICE_PAGE_SIZE, HISTORY_PAGE,
+                    LATEST_SAMPLES_CONCURRENCY, RECONNECT_BASE, RECONNECT_CAP, STABLE_CONNECTION)
+from .aggregate import Aggregator
+from .derived import DerivedVariables, derive
+from .dispatcher import YanziDispatcher
+from .energy import EnergyIntegrator
+from .inventory import YanziInventory
+from .metrics import LocationMetrics
+from .pool import CirrusPool
+from .records import YanziDevice, YanziSource
+from .timers import Backoff, ExpiryScheduler
 
 log = logging.getLogger(__name__)
 
 
 class YanziLocation:
-    def __init__(self, host, access_token, location_id):
+    def __init__(self, host, credentials, location_id, page_size=DEVICE_PAGE_SIZE, store=None,
+                 coalesce_intervals=COALESCE_INTERVALS, pool=None):
         self.host = host
-        self.access_token = access_token
         self.location_id = location_id
-
-        self.device_sources = {}
-        self._socket = asyncio.Future()
+        self.page_size = page_size
+        self.store = store
+        self.coalesce_intervals = coalesce_intervals
+
+        self._pool = pool if pool is not None else CirrusPool()
+        self.connection = self._pool.acquire(host, credentials)
+
+        self.inventory = YanziInventory()
+        self.dispatcher = YanziDispatcher()
+        self.expiry = ExpiryScheduler()
+        self.metrics = LocationMetrics()
+        self.energy = EnergyIntegrator()
+        self.aggregator = Aggregator()
+        self.keys = KeyIndex()
+        self.derived = DerivedVariables()
+        self.last_seen = {}
         self.is_loaded = True
 
     def unload(self):
         self.is_loaded = False
+        self.expiry.clear()
+        self._pool.release(self.connection)
+
+    @property
+    def reconnects(self):
+        return self.connection.reconnects
+
+    @property
+    def device_sources(self):
+        return self.inventory.device_sources
+
+    async def load_cache(self):
+        '''Fill the inventory from the last saved one, if there is a store.
+
+        Returns True if anything was loaded.
+        '''
+        if self.store is None:
+            return False
+
+        start = time.monotonic()
+        data = await self.store.async_load()
+        if not data or data.get('location_id') != self.location_id:
+            return False
+
+        self.inventory.load(data['devices'])
+        self.energy.load(data.get('energy', {}))
+
+        # Whatever happened since the cached samples is backfilled on connect.
+        for device, source in self.device_sources:
+            self.keys.add(source.key)
+            self.derived.add(source)
+            if source.derivation is not None:
+                # Computed from other variables, which are backfilled instead.
+                continue
+            if source.latest and 'sampleTime' in source.latest:
+                self.last_seen.setdefault(source.key, source.latest['sampleTime'])
+
+        log.info('Loaded %d cached device sources for %s in %.3f seconds',
+                 len(self.device_sources), self.location_id, time.monotonic() - start)
+        return True
+
+    def save_cache(self):
+        '''Schedule a write of the current inventory to the store.'''
+        if self.store is not None:
+            self.store.async_delay_save(lambda: {
+                'location_id': self.location_id,
+                'devices': self.inventory.dump(),
+                'energy': self.energy.dump(),
+            }, CACHE_SAVE_DELAY)
 
     async def get_device_sources(self):
-        self.device_sources = [x async for x in self._get_device_sources()]
-
-    async def _get_device_sources(self):
-        ws = await self._socket
-        gql_response = await ws.request({
-            'messageType': 'GraphQLRequest',
-            'locationAddress': {
-                'resourceType': 'LocationAddress',
-                'locationId': self.location_id,
-            },
-            'query': qq_query,
-            'vars': {},
-            'isLS': False
-        })
-
-        if 'result' not in gql_response:
-            raise RuntimeError(
-                f'Failed to get list of devices: {gql_response}')
+        '''Refresh the inventory page by page.
 
-        location = json.loads(gql_response['result'])['data']['location']
+        Yields the newly found (device, source) pairs of each page as soon as
+        it has arrived. Sources that are gone are only flagged once all
+        pages have been loaded.
+        '''
+        async for page in self._get_device_sources():
+            added = self.inventory.merge(page)
+            for device, source in added:
+                self.keys.add(source.key)
+                self.derived.add(source)
+            yield added
 
-        if location['units']['cursor'] != location['units']['endCursor']:
-            raise RuntimeError(
-                'I\'m unable to handle multiple pages of sensors.')
+        self.inventory.prune()
 
-        key_to_version = {item['key']: item['version']
-                          for item in location['inventory']['list']}
-
-        device = location['gateway']
-        device['version'] = key_to_version[device['key']]
-        for source in device['dataSources']:
-            source['did'] = device['unitAddress']['did']
-            source['name'] = device['name']
-            source['latest'] = None
-
-            yield device, source
-
-        for device in location['units']['list']:
-            device['version'] = key_to_version[device['key']]
-
-            for source in device['dataSources']:
-                if source['variableName'] in ['log', 'unitState']:
-                    # These two are always null for physical devices?
-                    continue
-
-                source['did'] = device['unitAddress']['did']
-                source['name'] = device['name']
-                source['latest'] = None
-
-                yield device, source
-
-            for child in device['chassisChildren']:
-                for source in child['dataSources']:
-                    source['did'] = child['unitAddress']['did']
-                    source['name'] = device['name']
-                    source['latest'] = None
-
-                    yield device, source
-
-                    if source['variableName'] == 'totalPowerInst':
-                        yield device, {
-                            'key': source['key'],
-                            'did': source['did'],
-                            'name': device['name'],
-                            'latest': None,
-                            'variableName': 'totalEnergy',
-                            'siUnit': 'mWs'
-                        }
+    async def _get_device_sources(self):
+        ws = await self.connection.socket()
+        key_to_version = {}
+        cursor = None
+        while True:
+            gql_response = await ws.request({
+                'messageType': 'GraphQLRequest',
+                'locationAddress': {
+                    'resourceType': 'LocationAddress',
+                    'locationId': self.location_id,
+                },
+                'query': qq_query(self.page_size, cursor),
+                'vars': {},
+                'isLS': False
+            })
+
+            if 'result' not in gql_response:
+                raise RuntimeError(
+                    f'Failed to get list of devices: {gql_response}')
+
+            location = ws.codec.loads(gql_response['result'])['data']['location']
+
+            if 'inventory' in location:
+                key_to_version = {item['key']: item['version']
+                                  for item in location['inventory']['list']}
+
+            page = list(location_to_device_sources(location, key_to_version))
+            log.debug('Got page of %d device sources after cursor %s',
+                      len(page), cursor)
+            yield page
+
+            units = location['units']
+            if not units['list'] or units['cursor'] == units['endCursor']:
+                break
+            cursor = units['cursor']
 
     async def watch(self):
         log.debug('Starting watch')
+        backoff = Backoff(RECONNECT_BASE, RECONNECT_CAP)
         while self.is_loaded:
+            ws = await self.connection.socket()
+            subscribed_at = None
             try:
-                async with connect(f'wss://{self.host}/cirrusAPI') as ws:
-                    await ws.authenticate({'accessToken': self.access_token})
-                    self._socket.set_result(ws)
-
-                    subscribe_request = {
-                        'messageType': 'SubscribeRequest',
-                        'unitAddress': {
-                            'resourceType': 'UnitAddress',
-                            'locationId': self.location_id
-                        },
-                        'subscriptionType': {
-                            'resourceType': 'SubscriptionType',
-                            'name': 'data'
-                        },
-                    }
-
-                    async for message in ws.subscribe(subscribe_request):
-
-                        dsa = message['list'][0]['dataSourceAddress']
-                        sample = message['list'][0]['list'][0]
-
-                        yield dsa_to_key(dsa), sample
-
-                        if dsa['variableName']['name'] == 'temperatureK':
-                            emulated_dsa = {
-                                **dsa,
-                                'variableName': {
-                                    **dsa['variableName'],
-                                    'name': 'temperatureC'
-                                }
-                            }
-                            emulated_sample = {
-                                **sample,
-                                'value': round(sample['value'] - 273.15, 2)
-                            }
-
-                            yield dsa_to_key(emulated_dsa), emulated_sample
+                subscribe_request = {
+                    'messageType': 'SubscribeRequest',
+                    'unitAddress': {
+                        'resourceType': 'UnitAddress',
+                        'locationId': self.location_id
+                    },
+                    'subscriptionType': {
+                        'resourceType': 'SubscriptionType',
+                        'name': 'data'
+                    },
+                }
+
+                async with ws.subscription(subscribe_request) as frames:
+                    subscribed_at = time.monotonic()
+                    if self.last_seen:
+                        # Live frames are queued meanwhile, so the backfill
+                        # only has to reach the start of the subscription.
+                        async for batch in self.backfill(int(time.time() * 1000)):
+                            yield batch
+
+                    async for message in frames:
+                        yield message_to_batch(message, self.last_seen, self.keys)
 
             except CancelledError:
                 await asyncio.sleep(1)
             except Exception as e:
+                if ws.exception is not None:
+                    # The shared connection reconnects by itself.
+                    log.warning('Restarting ws watch of %s on a new connection because of: %s',
+                                self.location_id, e)
+                    continue
+
+                if subscribed_at is not None and time.monotonic() - subscribed_at > STABLE_CONNECTION:
+                    backoff.reset()
+
+                delay = backoff.next_delay()
                 log.warning(
-                    'Restarting ws watch in 60 seconds because of: %s', e, exc_info=e)
-                await asyncio.sleep(60)
-            finally:
-                self._socket = asyncio.Future()
+                    'Restarting ws watch in %.1f seconds because of: %s', delay, e, exc_info=e)
+                await asyncio.sleep(delay)
 
     async def get_latest(self, did, variable_name):
-        ws = await self._socket
+        ws = await self.connection.socket()
         response = await ws.request({
             'messageType': 'GetSamplesRequest',
             'dataSourceAddress': {
@@ -173,8 +224,104 @@ class YanziLocation:
             return None
         return response['sampleListDto']['list'][0]
 
+    async def get_samples(self, dsa, time_start, time_end):
+        '''The samples of a data source between two times (ms), oldest first.'''
+        ws = await self.connection.socket()
+        response = await ws.request({
+            'messageType': 'GetSamplesRequest',
+            'dataSourceAddress': dsa,
+            'timeSerieSelection': {
+                'resourceType': 'TimeSerieSelection',
+                'timeStart': time_start,
+                'timeEnd': time_end,
+            }
+        }, 30)
+        if response['responseCode']['name'] != 'success':
+            log.warning('Error when getting samples %s %s', dsa_to_key(dsa), response)
+            return []
+
+        samples = response.get('sampleListDto', {}).get('list', [])
+        return sorted(samples, key=lambda sample: sample.get('sampleTime', 0))
+
+    async def get_history(self, source, time_start, time_end, page=HISTORY_PAGE):
+        '''The samples of a source between two times (ms), oldest first.
+
+        Yields one list of samples per `page` seconds, so that long ranges
+        are never held in memory at once.
+        '''
+        dsa = key_to_dsa(source.sample_key)
+        dsa['variableName']['name'] = source.sample_variable
+
+        while time_start <= time_end:
+            page_end = min(time_start + page * 1000 - 1, time_end)
+            yield await self.get_samples(dsa, time_start, page_end)
+            time_start = page_end + 1
+
+    async def backfill(self, until=None, concurrency=LATEST_SAMPLES_CONCURRENCY):
+        '''Fetch the samples missed since each key was last seen, up to `until` (ms).
+
+        Yields one batch per key, in sample order, to be handled like the
+        batches from the subscription. Gaps are limited to BACKFILL_MAX_AGE.
+        '''
+        now = until if until is not None else int(time.time() * 1000)
+        oldest = now - BACKFILL_MAX_AGE * 1000
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(key, since):
+            async with semaphore:
+                dsa = key_to_dsa(key)
+                samples = await self.get_samples(dsa, max(since + 1, oldest), now)
+                return message_to_batch({'list': [{
+                    'dataSourceAddress': dsa,
+                    'list': samples,
+                }]}, self.last_seen, self.keys)
+
+        start = time.monotonic()
+        count = 0
+        tasks = [asyncio.ensure_future(fetch(key, since))
+                 for key, since in self.last_seen.items() if since < now]
+        try:
+            for next_batch in asyncio.as_completed(tasks):
+                try:
+                    batch = await next_batch
+                except Exception as e:
+                    log.warning('Failed to backfill samples: %s', e)
+                    continue
+
+                if batch:
+                    count += len(batch)
+                    yield batch
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        log.info('Backfilled %d samples for %d sources in %.2f seconds',
+                 count, len(tasks), time.monotonic() - start)
+
+    async def get_latest_samples(self, sources, concurrency=LATEST_SAMPLES_CONCURRENCY):
+        '''Fill in source.latest for all sources, keeping at most
+        `concurrency` GetSamplesRequests in flight at once.'''
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(source):
+            async with semaphore:
+                source.latest = await self.get_latest(source.did, source.sample_variable)
+
+        # Sources derived from several variables only get samples from DerivedVariables.
+        sources = [source for source in sources if source.sample_variable is not None]
+
+        start = time.monotonic()
+        results = await asyncio.gather(*[fetch(source) for source in sources], return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+
+        log.info('Fetched latest samples for %d sources in %.2f seconds (%d failed)',
+                 len(results), time.monotonic() - start, len(failed))
+        if failed:
+            log.warning('Failed to get latest sample: %s',
+                        failed[0], exc_info=failed[0])
+
     async def control_request_binary(self, did, value):
-        ws = await self._socket
+        ws = await self.connection.socket()
         response = await ws.request({
             'messageType': 'control_request',
             'unitAddress': {
@@ -189,6 +336,107 @@ class YanziLocation:
         })
 
 
+def location_to_device_sources(location, key_to_version):
+    '''The (device, source) records of one page of the inventory query.'''
+    gateway = location.get('gateway')
+    if gateway is not None:
+        device = YanziDevice.from_dict(gateway, key_to_version.get(gateway['key']))
+        sources = [YanziSource.from_dict(source, device, device.did) for source in gateway['dataSources']]
+        for source in derive(device, sources):
+            yield device, source
+
+    for unit in location['units']['list']:
+        device = YanziDevice.from_dict(unit, key_to_version.get(unit['key']))
+
+        sources = [
+            YanziSource.from_dict(source, device, device.did)
+            for source in unit['dataSources']
+            # These two are always null for physical devices?
+            if source['variableName'] not in ['log', 'unitState']
+        ]
+        for child in unit['chassisChildren']:
+            did = child['unitAddress']['did']
+            sources += [YanziSource.from_dict(source, device, did) for source in child['dataSources']]
+
+        for source in derive(device, sources):
+            yield device, source
+
+
+def message_to_batch(message, last_seen=None, keys=None):
+    '''All (key, sample) pairs of a SubscribeData message, in order.
+
+    If given, `last_seen` is updated with the latest sampleTime per key,
+    and keys are looked up in the KeyIndex `keys`.
+    '''
+    batch = []
+    for sample_list in message.get('list', []):
+        dsa = sample_list['dataSourceAddress']
+        key = keys.key(dsa) if keys is not None else dsa_to_key(dsa)
+        samples = sample_list.get('list')
+        if not samples:
+            continue
+
+        if last_seen is None:
+            batch.extend((key, sample) for sample in samples)
+            continue
+
+        latest = last_seen.get(key, 0)
+        for sample in samples:
+            batch.append((key, sample))
+            sample_time = sample.get('sampleTime', 0)
+            if sample_time > latest:
+                latest = sample_time
+        last_seen[key] = latest
+
+    return batch
+
+
+class KeyIndex:
+    '''Maps data source addresses to the keys of the inventory.
+
+    A lookup walks a few dicts instead of formatting a new string for every
+    sample list, and returns the same str object each time, so its hash is
+    already cached for the dispatcher and every other dict keyed by it.
+    '''
+
+    def __init__(self):
+        self._index = {}
+
+    def add(self, key):
+        try:
+            gwdid, location_id, did, variable_name, instance_number = key.split('/')
+            instance_number = int(instance_number)
+        except ValueError:
+            return
+
+        self._index.setdefault(gwdid, {}).setdefault(did, {}) \
+            .setdefault(variable_name, {})[instance_number] = key
+
+    def key(self, dsa):
+        try:
+            return self._index[dsa['serverDid']][dsa['did']][dsa['variableName']['name']][dsa['instanceNumber']]
+        except KeyError:
+            key = sys.intern(dsa_to_key(dsa))
+            self.add(key)
+            return key
+
+
+def key_to_dsa(key):
+    gwdid, location_id, did, variable_name, instance_number = key.split('/')
+
+    return {
+        'resourceType': 'DataSourceAddress',
+        'serverDid': gwdid,
+        'locationId': location_id,
+        'did': did,
+        'variableName': {
+            'resourceType': 'VariableName',
+            'name': variable_name
+        },
+        'instanceNumber': int(instance_number),
+    }
+
+
 def dsa_to_key(dsa):
     gwdid = dsa['serverDid']
     location_id = dsa['locationId']
@@ -199,24 +447,22 @@ def dsa_to_key(dsa):
     return f'{gwdid}/{location_id}/{did}/{variable_name}/{instance_number}'
 
 
-qq_query = '''query {
-  location {
-    gateway {
-      key
-      productType
-      name
-      lifeCycleState
-      unitAddress {
-        did
-        serverDid
-      }
-      dataSources {
-        key
-        variableName
-        siUnit
-      }
-    }
-    units(filter:[{ name:unitTypeFixed, type: equals, value:"physicalOrChassis"}]) {
+def qq_query(page_size, cursor=None):
+    '''The inventory query for one page of units.
+
+    The gateway and the inventory versions are only included on the first
+    page, later pages continue after `cursor`.
+    '''
+    units_args = f'first: {int(page_size)}, '
+    if cursor is not None:
+        units_args += f'after: {json.dumps(cursor)}, '
+
+    return (qq_first_page_query if cursor is None else qq_next_page_query) \
+        .replace('UNITS_ARGS', units_args)
+
+
+qq_units_query = '''
+    units(UNITS_ARGSfilter:[{ name:unitTypeFixed, type: equals, value:"physicalOrChassis"}]) {
       cursor
       endCursor
       list {
@@ -252,7 +498,25 @@ qq_query = '''query {
           }
         }
       }
-    }
+    }'''
+
+qq_first_page_query = '''query {
+  location {
+    gateway {
+      key
+      productType
+      name
+      lifeCycleState
+      unitAddress {
+        did
+        serverDid
+      }
+      dataSources {
+        key
+        variableName
+        siUnit
+      }
+    }''' + qq_units_query + '''
     inventory {
       list {
         key
@@ -261,3 +525,8 @@ qq_query = '''query {
     }
   }
 }'''
+
+qq_next_page_query = '''query {
+  location {''' + qq_units_query + '''
+  }
+}'''
@@ -0,0 +1,123 @@
+import bisect
+import time
+
+# Upper bounds (milliseconds) of the dispatch latency histogram buckets.
+LATENCY_BUCKETS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, float('inf')]
+
+
+class Histogram:
+    '''Counts of observations per fixed bucket.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-quantile.'''
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return self.buckets[-1]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+class LocationMetrics:
+    '''Throughput and latency of the sample pipeline of a location.
+
+    Recording is cheap and happens per batch, `snapshot()` does the
+    aggregation and is meant to be called every few seconds. Latencies are
+    reported for the time since the previous snapshot; a snapshot without
+    any keeps reporting those of the last one that had them.
+    '''
+
+    def __init__(self):
+        self.samples = 0
+        self.batches = 0
+        self.dispatch_latency = Histogram()
+        self.last_sample = None
+        self.latest = {}
+
+        self._snapshot_time = time.monotonic()
+        self._snapshot_samples = 0
+        self._snapshot_round_trips = {}
+        self._latencies = {}
+
+    def record_batch(self, count, seconds):
+        self.samples += count
+        self.batches += 1
+        self.dispatch_latency.observe(seconds * 1000)
+        if count:
+            self.last_sample = time.time()
+
+    def snapshot(self, location):
+        now = time.monotonic()
+        elapsed = now - self._snapshot_time
+        rate = (self.samples - self._snapshot_samples) / elapsed if elapsed > 0 else 0
+        self._snapshot_time = now
+        self._snapshot_samples = self.samples
+
+        latency, self.dispatch_latency = self.dispatch_latency, Histogram()
+        if latency.count:
+            self._latencies.update({
+                'dispatch_latency_p50': latency.quantile(0.5),
+                'dispatch_latency_p99': latency.quantile(0.99),
+                'dispatch_latency': latency.as_dict(),
+            })
+
+        connection = dict(location.connection.stats)
+        round_trips = self._round_trip_window(connection.pop('round_trips', {}))
+        if round_trips:
+            self._latencies['round_trips'] = round_trips
+
+        self.latest = {
+            'samples': self.samples,
+            'samples_per_second': round(rate, 2),
+            'batches': self.batches,
+            'seconds_since_last_sample':
+                round(time.time() - self.last_sample, 1) if self.last_sample else None,
+            'reconnects': location.reconnects,
+            'sources': len(location.device_sources),
+            'timers': len(location.expiry),
+            **connection,
+            **self._latencies,
+        }
+        return self.latest
+
+    def _round_trip_window(self, round_trips):
+        '''Count and mean per message type of the round trips since the last snapshot.'''
+        previous = self._snapshot_round_trips
+        self._snapshot_round_trips = {}
+        window = {}
+        for message_type, stats in round_trips.items():
+            count, total = stats['count'], stats['total']
+            self._snapshot_round_trips[message_type] = (count, total)
+            last_count, last_total = previous.get(message_type, (0, 0))
+            if count < last_count:
+                # A new connection, counting from zero.
+                last_count, last_total = 0, 0
+            if count > last_count:
+                window[message_type] = {
+                    'count': count - last_count,
+                    'mean': (total - last_total) / (count - last_count),
+                }
+        return window
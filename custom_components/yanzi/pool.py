@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+from .cirrus import connect
+from .const import RECONNECT_BASE, RECONNECT_CAP, STABLE_CONNECTION
+from .timers import Backoff
+
+log = logging.getLogger(__name__)
+
+
+class CirrusPool:
+    '''Shares Cirrus connections between the locations on a host.
+
+    Locations share a connection when they log in to the same host with the
+    same credentials. An account login gives access to all locations of the
+    account, so every location of it shares one socket. An access token
+    only covers its own location. Each connection is reference counted and
+    closed when its last location releases it.
+    '''
+
+    def __init__(self, uri='wss://{host}/cirrusAPI'):
+        self.uri = uri
+        self._connections = {}
+
+    def __len__(self):
+        return len(self._connections)
+
+    def acquire(self, host, credentials):
+        '''The connection to `host` logged in with the `credentials` of a LoginRequest.'''
+        key = (host, tuple(sorted(credentials.items())))
+        connection = self._connections.get(key)
+        if connection is None:
+            connection = self._connections[key] = SharedCirrus(
+                host, credentials, self.uri.format(host=host))
+            connection.key = key
+            connection.start()
+
+        connection.references += 1
+        return connection
+
+    def release(self, connection):
+        connection.references -= 1
+        if connection.references == 0:
+            del self._connections[connection.key]
+            connection.stop()
+
+
+class SharedCirrus:
+    '''An authenticated Cirrus connection that reconnects by itself.
+
+    The first retry is immediate, after that it backs off exponentially
+    with jitter. A connection that stayed up for STABLE_CONNECTION seconds
+    starts over with an immediate retry. A refused login is not retried,
+    the auth listeners are called instead and socket() waits until the
+    connection is released for one with a new login.
+    '''
+
+    def __init__(self, host, credentials, uri=None):
+        self.host = host
+        self.credentials = credentials
+        self.key = None
+        self.uri = uri or f'wss://{host}/cirrusAPI'
+        self.references = 0
+        self.reconnects = 0
+        self.auth_failed = False
+        self.cirrus = None
+
+        self._socket = asyncio.Future()
+        self._task = None
+        self._auth_listeners = []
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def add_auth_listener(self, listener):
+        '''Call `listener` when the login is refused, returns a function removing it.'''
+        self._auth_listeners.append(listener)
+        return lambda: self._auth_listeners.remove(listener)
+
+    @property
+    def stats(self):
+        '''Stats of the current connection, if there is one.'''
+        return {
+            'connected': self.cirrus is not None,
+            'locations': self.references,
+            **(self.cirrus.stats if self.cirrus is not None else {}),
+        }
+
+    async def socket(self):
+        '''The current connection, waiting for it if needed.'''
+        if self._socket.done() and self._socket.result().exception is not None:
+            # Failed, but _run hasn't noticed yet.
+            self._socket = asyncio.Future()
+        return await asyncio.shield(self._socket)
+
+    async def _run(self):
+        backoff = Backoff(RECONNECT_BASE, RECONNECT_CAP)
+        while True:
+            connected_at = None
+            try:
+                async with connect(self.uri) as ws:
+                    if not await ws.authenticate(self.credentials):
+                        raise AuthenticationError(f'Failed to log in to {self.host}')
+                    connected_at = time.monotonic()
+                    self.cirrus = ws
+                    self._socket.set_result(ws)
+
+                    try:
+                        raise await ws.wait_closed() or ConnectionError('Connection closed')
+                    finally:
+                        self.cirrus = None
+                        if self._socket.done():
+                            self._socket = asyncio.Future()
+            except asyncio.CancelledError:
+                raise
+            except AuthenticationError as e:
+                log.warning('%s, waiting for new credentials', e)
+                self.auth_failed = True
+                for listener in list(self._auth_listeners):
+                    listener()
+                return
+            except Exception as e:
+                if connected_at is not None and time.monotonic() - connected_at > STABLE_CONNECTION:
+                    backoff.reset()
+
+                delay = backoff.next_delay()
+                self.reconnects += 1
+                log.warning(
+                    'Reconnecting to %s in %.1f seconds because of: %s', self.host, delay, e, exc_info=e)
+                await asyncio.sleep(delay)
+
+
+class AuthenticationError(Exception):
+    '''The host refused the login.'''
@@ -0,0 +1,241 @@
+from .const import DOMAIN
+from .variables import describe
+
+
+class YanziDevice:
+    '''A physical unit (or the gateway) of a location.
+
+    Only the fields the entities use are kept from the GraphQL response, and
+    `device_info` is built once instead of on every state write.
+    '''
+
+    __slots__ = ('key', 'did', 'server_did', 'name', 'product_type', 'version',
+                 'life_cycle_state', 'area', 'device_info')
+
+    def __init__(self, key, did, server_did, name, product_type, version=None,
+                 life_cycle_state=None, area=None):
+        self.key = key
+        self.did = did
+        self.server_did = server_did
+        self.name = name
+        self.product_type = product_type
+        self.version = version
+        self.life_cycle_state = life_cycle_state
+        self.area = area
+        self.device_info = self._device_info()
+
+    @classmethod
+    def from_dict(cls, item, version=None):
+        '''A device from a GraphQL unit, or from `as_dict()`.'''
+        unit_address = item.get('unitAddress') or {}
+        return cls(
+            item['key'],
+            unit_address.get('did'),
+            unit_address.get('serverDid'),
+            item.get('name'),
+            item.get('productType'),
+            item.get('version', version),
+            item.get('lifeCycleState'),
+            (item.get('assetParent') or {}).get('name'),
+        )
+
+    def as_dict(self):
+        '''The device in the shape of the GraphQL response.'''
+        return {
+            'key': self.key,
+            'productType': self.product_type,
+            'name': self.name,
+            'lifeCycleState': self.life_cycle_state,
+            'assetParent': {'name': self.area} if self.area is not None else None,
+            'unitAddress': {'did': self.did, 'serverDid': self.server_did},
+            'version': self.version,
+        }
+
+    def update(self, other):
+        '''Copy the metadata of a fresher record of the same device.
+
+        Returns True if anything changed.
+        '''
+        changed = False
+        for field in YanziDevice.__slots__[1:-1]:
+            value = getattr(other, field)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+
+        if changed:
+            self.device_info = self._device_info()
+        return changed
+
+    def _device_info(self):
+        return {
+            'identifiers': {(DOMAIN, self.key), (DOMAIN, self.did)},
+            'name': self.name,
+            'manufacturer': 'Yanzi Networks',
+            'model': DEVICE_MODELS.get(self.product_type, self.product_type),
+            'sw_version': self.version,
+            'suggested_area': self.area,
+            'via_device': (DOMAIN, self.server_did),
+        }
+
+
+class YanziSource:
+    '''A data source of a device, with its latest sample.
+
+    Several sources share one `YanziDevice`. The descriptor and unit only
+    depend on the variable name and SI unit, so they are looked up once.
+    `value(sample)` is the state of a sample. Samples are received under
+    `sample_key` and fetched as `sample_variable`, which differ from the key
+    and variable name of derived sources, see `derive`.
+    '''
+
+    __slots__ = ('key', 'did', 'variable_name', 'si_unit', 'device', '_latest', 'attributes', 'removed',
+                 'descriptor', 'unit_of_measurement', 'value', 'sample_key', 'sample_variable',
+                 'derivation', 'inputs')
+
+    def __init__(self, key, did, variable_name, si_unit, device, latest=None):
+        self.key = key
+        self.did = did
+        self.variable_name = variable_name
+        self.si_unit = si_unit
+        self.device = device
+        self.removed = False
+        self.descriptor = describe(variable_name)
+        self.value = self.descriptor.value
+        self.sample_key = key
+        self.sample_variable = variable_name
+        self.derivation = None
+        self.inputs = None
+        self._latest = None
+        self.attributes = None
+        self.latest = latest
+        self._lookup()
+
+    @classmethod
+    def from_dict(cls, item, device, did=None):
+        '''A source from a GraphQL data source, or from `as_dict()`.'''
+        return cls(
+            item['key'],
+            item.get('did', did),
+            item['variableName'],
+            item.get('siUnit'),
+            device,
+            item.get('latest'),
+        )
+
+    def as_dict(self):
+        '''The source in the shape of the GraphQL response, with its latest sample.'''
+        return {
+            'key': self.key,
+            'variableName': self.variable_name,
+            'siUnit': self.si_unit,
+            'did': self.did,
+            'latest': self.latest,
+        }
+
+    @property
+    def name(self):
+        return self.device.name
+
+    @property
+    def latest(self):
+        return self._latest
+
+    @latest.setter
+    def latest(self, sample):
+        # Several entities can share a source, decode each sample only once.
+        if sample is self._latest:
+            return
+
+        self._latest = sample
+        decode = self.descriptor.attributes
+        self.attributes = decode(sample) if decode is not None and sample is not None else None
+
+    def derive(self, derivation, inputs):
+        '''Compute this source with a Derivation from the given input sources.
+
+        With a single input the samples of the input are used directly, with
+        several the source gets the samples that DerivedVariables emits for
+        `inputs`, a list of (sample key, extractor) pairs.
+        '''
+        self.derivation = derivation
+        if len(inputs) == 1:
+            extractor = derivation.inputs[0][1]
+            compute = derivation.compute
+            self.value = lambda sample: compute(extractor(sample))
+            self.sample_key = inputs[0].sample_key
+            self.sample_variable = inputs[0].sample_variable
+        else:
+            self.sample_variable = None
+            self.inputs = [(source.sample_key, extractor)
+                           for source, (variable, extractor) in zip(inputs, derivation.inputs)]
+
+    def update(self, other):
+        '''Copy the metadata of a fresher record of the same source.
+
+        Returns True if anything changed.
+        '''
+        if self.did == other.did and self.si_unit == other.si_unit:
+            return False
+
+        self.did = other.did
+        self.si_unit = other.si_unit
+        self._lookup()
+        return True
+
+    def _lookup(self):
+        self.unit_of_measurement = self.descriptor.unit or SI_UNITS.get(self.si_unit, self.si_unit)
+
+
+SI_UNITS = {
+    'NA': None,
+    'celsius': '°C',
+    'kelvin': 'K',
+    'percent': '%',
+    'mlux': 'mlx',
+    'watt': 'W',
+    'mWs': 'Wh'
+}
+
+DEVICE_MODELS = {
+    '0090DA03010104A3': 'Yanzi LED',
+    '0090DA03010104A1': 'Yanzi LED',
+    '0090DA03010104B0': 'Yanzi Motion',
+    '0090DA03010104A0': 'Yanzi Climate',
+    '0090DA03010104D0': 'Yanzi Distance',
+    '0090DA03010104D3': 'Yanzi Distance',
+    '0090DA03010104D4': 'Yanzi Distance',
+    '0090DA0301010491': 'Yanzi Plug',
+    '0090DA0301010492': 'Yanzi Plug',
+    '0090DA03010104C1': 'Yanzi Air',
+    '0090DA03010104A5': 'Yanzi Light',
+    '0090DA0301010510': 'Yanzi Decibel',
+    '0090DA0301020422': 'Yanzi Gateway',
+    '0090DA0301020421': 'Yanzi Gateway',
+    '0090DA0301020423': 'Yanzi Gateway',
+    '0090DA0301020424': 'Yanzi Gateway',
+    '0090DA0301010521': 'Yanzi Motion+',
+    '0090DA0301010522': 'Yanzi Comfort',
+    '0090DA0301010523': 'Yanzi Climate+',
+    '0090DA0301010524': 'Yanzi Presence',
+    '0090DA0301028030': 'Axis Camera 1',
+    '0090DA0301028002': 'Axis Camera 2',
+    '0090DA0301028021': 'Sercom Camera',
+    '0090DA0301020010': 'IoT Access Point',
+    '0090DA0301020011': 'IoT Access Point',
+    '0090DA0301020012': 'IoT Access Point',
+    '0090DA0302010014': 'Border Router',
+    '0090DA0301088010': 'Footfall Camera',
+    '0090DA03010104D5': 'Katrin Towel Dispenser',
+    '0090DA03010104D6': 'Katrin Hand Towel M Dispenser',
+    '0090DA03010104D7': 'Katrin Toilet Dispenser',
+    '0090DA03010104D9': 'Katrin Soap 1000 Dispenser',
+    '0090DA03010104D8': 'Katrin Soap 1000 Dispenser',
+    '0090DA03010104DB': 'Katrin Towel Dispenser',
+    '0090DA03010104DC': 'Katrin Smart Hand Towel M',
+    '0090DA0301038031': 'Carlo Gavassi EM24',
+    '0090DA0301048052': 'CG Modbus Ethernet SIU',
+    '0090DA0301038041': 'Humidity MODBUS',
+    '0090DA0301010532': 'Yanzi Presence Mini',
+    '0090DA0301010502': 'Yanzi IoT Mesh',
+}
@@ -1,26 +1,52 @@
-import struct
-
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.components.sensor import SensorEntity
+from homeassistant.helpers.device_registry import DeviceEntryType
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import EntityCategory
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DOMAIN
-from .binary_sensor import BINARY_VARIABLE_NAMES
-from .switch import SWITCH_VARIABLE_NAMES
+from .const import DOMAIN, SIGNAL_METRICS, SIGNAL_NEW_SOURCES
+from .inventory import source_id
 from .yanzi_entity import YanziEntity
 
-IGNORED_VARIABLE_NAMES = ['onOffTransition']
-
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback):
     location = hass.data[DOMAIN][entry.entry_id]
 
+    statistics_sensors = entry.options.get('statistics_sensors', False)
+    aggregate = bool(entry.options.get('aggregate_interval'))
+
+    @callback
+    def add_sources(device_sources):
+        entities = [
+            SENSOR_CLASSES.get(source.variable_name, YanziSensor)(location, device, source)
+            for device, source in device_sources
+            if source.descriptor.platform == 'sensor'
+        ]
+        if statistics_sensors:
+            entities += [
+                YanziStatisticSensor(location, device, source, field)
+                for device, source in device_sources
+                if source.variable_name == 'statistics'
+                for field in STATISTICS_SENSORS
+            ]
+        if aggregate:
+            entities += [
+                YanziAggregateSensor(location, device, source, statistic)
+                for device, source in device_sources
+                if source.descriptor.platform == 'sensor' and source.descriptor.aggregate
+                for statistic in AGGREGATE_STATISTICS
+            ]
+        async_add_entities(entities)
+
+    add_sources(location.device_sources)
+    entry.async_on_unload(async_dispatcher_connect(
+        hass, SIGNAL_NEW_SOURCES.format(entry.entry_id), add_sources))
+
     async_add_entities([
-        YanziSensor(location, device, source)
-        for device, source in location.device_sources
-        if source['variableName'] not in BINARY_VARIABLE_NAMES and
-        source['variableName'] not in SWITCH_VARIABLE_NAMES and
-        source['variableName'] not in IGNORED_VARIABLE_NAMES
+        YanziMetricSensor(entry, key, name, unit, state_class)
+        for key, name, unit, state_class in METRIC_SENSORS
     ])
 
 
@@ -28,96 +54,207 @@ class YanziSensor(YanziEntity):
 
     @property
     def should_poll(self):
-        if self.source['variableName'] == 'battery':
-            return True
-
-        return False
+        return self.descriptor.should_poll
 
     @property
     def unit_of_measurement(self):
-        u = self.source['siUnit']
-        vn = self.source['variableName']
-
-        return UNIT_BY_VARIABLE_NAME.get(vn, SI_UNITS.get(u, u))
+        return self.source.unit_of_measurement
 
     @property
     def state(self):
-        vn = self.source['variableName']
-        l = self.source['latest']
+        latest = self.source.latest
+        if latest is None:
+            return None
+
+        return self.source.value(latest)
+
+    @property
+    def state_class(self):
+        return self.descriptor.state_class
+
+    @property
+    def state_attributes(self):
+        if self.source.attributes is not None:
+            return self.source.attributes
+        return self.source.latest
+
+
+class YanziEnergySensor(YanziSensor):
+    '''Energy integrated from the power samples, see EnergyIntegrator.'''
 
-        if l is None:
+    @property
+    def state(self):
+        energy = self.location.energy.total(self.source.sample_key)
+        if energy is None:
             return None
+        return round(energy, 3)
+
+    @callback
+    def on_sample(self, sample):
+        # Start from the device counter in the latest sample, the live
+        # samples keep the total in line with it, see EnergyIntegrator.add.
+        if self.location.energy.total(self.source.sample_key) is None:
+            self.location.energy.reconcile(self.source.sample_key, sample)
+
+
+class YanziStatisticSensor(YanziSensor):
+    '''One field of the mesh statistics of a unit, as a separate sensor.'''
 
-        if vn == 'up':
-            return l['deviceUpState']['name']
-        elif vn == 'positionLog':
-            return l['longitude'], l['latitude']
-        elif vn == 'battery':
-            return int(l['percentFull'])
-        elif vn == 'soundPressureLevel':
-            return l['max']
-        elif vn == 'totalpowerInst':
-            return l['instantPower']
-        elif vn == 'totalEnergy':
-            # seconds -> hours, millis -> kilo
-            return l['totalEnergy'] / (3600 * 1000)
-        elif 'value' in l:
-            return l['value']
-        elif vn in l:
-            return l[vn]
-        else:
+    def __init__(self, location, device, source, field):
+        super().__init__(location, device, source)
+        self.field = field
+
+    @property
+    def unique_id(self):
+        return f'{self.source.key}_{self.field}'
+
+    @property
+    def name(self):
+        return f'{self.source.name} {self.field.replace("_", " ")}'
+
+    @property
+    def unit_of_measurement(self):
+        return None
+
+    @property
+    def state(self):
+        if self.source.attributes is None:
             return None
+        return self.source.attributes[self.field]
 
     @property
-    def state_class(self):
-        if self.source['variableName'] == 'totalEnergy':
-            return "total_increasing"
+    def state_attributes(self):
+        return None
 
-        return "measurement"
+    @property
+    def entity_registry_enabled_default(self):
+        return True
+
+
+class YanziAggregateSensor(YanziSensor):
+    '''The min, mean or max of a source over each aggregation interval.'''
+
+    def __init__(self, location, device, source, statistic):
+        super().__init__(location, device, source)
+        self.statistic = statistic
+
+    async def async_added_to_hass(self):
+        self.async_write_ha_state()
+        self.async_on_remove(self.location.aggregator.subscribe(
+            source_id(self.source), self.source.sample_key, self.source.value, self._handle_aggregate))
+        self.async_on_remove(self.location.inventory.listeners.subscribe(
+            source_id(self.source), self._handle_inventory_update))
+
+    @callback
+    def _handle_aggregate(self, aggregate):
+        self.async_write_ha_state()
+
+    @property
+    def should_poll(self):
+        return False
+
+    @property
+    def unique_id(self):
+        return f'{self.source.key}_{self.statistic}'
+
+    @property
+    def name(self):
+        return f'{super().name} {self.statistic}'
+
+    @property
+    def state(self):
+        aggregate = self.location.aggregator.latest.get(source_id(self.source))
+        if aggregate is None:
+            return None
+        return round(aggregate[self.statistic], 3)
 
     @property
     def state_attributes(self):
-        if self.source['variableName'] == 'statistics' and self.source['latest'] is not None:
-            # Grabbed from pan, not sure if still correct...
-            # uint8_t version;
-            # uint8_t parent_rssi; /* version > 0: Parent RSSI */
-            # uint16_t parent_switches; /* Number of parent switches */
-            # uint32_t parent_time; /* Time since last parent switch (seconds) */
-            # uint8_t parent[8]; /* 8 right most bytes of parent IP address*/
-            # uint16_t parent_rank; /* Rank of the parent */
-            # uint16_t parent_metric; /* Link metric to the parent */
-            # uint8_t free_routes;    /* version > 0: Number of free routes */
-            # uint8_t free_neighbors; /* version > 0: Number of free neighbors */
-            # uint8_t reserved_future[10];
-
-            res = struct.unpack('BBHIBBBBBBBBHHBBBBBBBBBBBB',
-                                bytes.fromhex(self.source['latest']['value']))
+        return None
+
+    @property
+    def entity_registry_enabled_default(self):
+        # Long-term statistics already keep min/max of the mean per hour.
+        return self.statistic == 'mean'
+
+
+class YanziMetricSensor(SensorEntity):
+    '''A diagnostic sensor for the sample pipeline of a location.'''
+
+    _attr_should_poll = False
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
+    def __init__(self, entry, key, name, unit, state_class):
+        self.entry = entry
+        self.key = key
+
+        location_id = entry.data['location_id']
+        self._attr_name = f'Yanzi {location_id} {name}'
+        self._attr_unique_id = f'{location_id}_metrics_{key}'
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = state_class
+        self._attr_device_info = {
+            'identifiers': {(DOMAIN, location_id)},
+            'name': entry.title,
+            'manufacturer': 'Yanzi Networks',
+            'model': 'Location',
+            'entry_type': DeviceEntryType.SERVICE,
+        }
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(async_dispatcher_connect(
+            self.hass, SIGNAL_METRICS.format(self.entry.entry_id), self.async_write_ha_state))
+
+    @property
+    def native_value(self):
+        metrics = self.hass.data[DOMAIN][self.entry.entry_id].metrics.latest
+        if self.key == 'round_trip':
+            round_trips = metrics.get('round_trips', {})
+            count = sum(x['count'] for x in round_trips.values())
+            if not count:
+                return None
+            return round(sum(x['mean'] * x['count'] for x in round_trips.values()) / count * 1000, 1)
+
+        return metrics.get(self.key)
+
+    @property
+    def extra_state_attributes(self):
+        if self.key == 'round_trip':
+            metrics = self.hass.data[DOMAIN][self.entry.entry_id].metrics.latest
             return {
-                'version': res[0],
-                'parent_rssi': res[1],
-                'parent_switches': res[2],
-                'parent_time': res[3],
-                'parent': res[4:12],
-                'parent_rank': res[12],
-                'parent_metric': res[13],
-                'free_routes': res[14],
-                'free_neighbors': res[15],
-                'reserved_future': res[16:]
+                message_type: round(x['mean'] * 1000, 1)
+                for message_type, x in metrics.get('round_trips', {}).items()
             }
+        if self.key == 'dispatch_latency_p99':
+            metrics = self.hass.data[DOMAIN][self.entry.entry_id].metrics.latest
+            return metrics.get('dispatch_latency')
 
-        return self.source['latest']
 
-
-SI_UNITS = {
-    'NA': None,
-    'celsius': '°C',
-    'kelvin': 'K',
-    'percent': '%',
-    'mlux': 'mlx',
-    'watt': 'W',
-    'mWs': 'Wh'
+SENSOR_CLASSES = {
+    'totalEnergy': YanziEnergySensor,
 }
 
-UNIT_BY_VARIABLE_NAME = {
-    'battery': '%'
-}
+AGGREGATE_STATISTICS = ['min', 'mean', 'max']
+
+# Numeric fields of the decoded statistics that get their own sensor.
+STATISTICS_SENSORS = [
+    'parent_rssi',
+    'parent_switches',
+    'parent_rank',
+    'parent_metric',
+    'free_routes',
+    'free_neighbors',
+]
+
+# key in LocationMetrics.snapshot(), name, unit, state class
+METRIC_SENSORS = [
+    ('samples', 'samples', 'samples', 'total_increasing'),
+    ('samples_per_second', 'sample rate', 'samples/s', 'measurement'),
+    ('dispatch_latency_p99', 'dispatch latency p99', 'ms', 'measurement'),
+    ('seconds_since_last_sample', 'time since last sample', 's', 'measurement'),
+    ('round_trip', 'request round trip', 'ms', 'measurement'),
+    ('in_flight', 'requests in flight', None, 'measurement'),
+    ('queued', 'queued frames', None, 'measurement'),
+    ('dropped', 'dropped frames', None, 'total_increasing'),
+    ('reconnects', 'reconnects', None, 'total_increasing'),
+]
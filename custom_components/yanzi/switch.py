@@ -1,46 +1,48 @@
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DOMAIN
+from .const import DOMAIN, SIGNAL_NEW_SOURCES
 from .yanzi_entity import YanziEntity
 from homeassistant.components.switch import SwitchEntity
 
-SWITCH_VARIABLE_NAMES = ['onOffOutput']
-
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback):
     location = hass.data[DOMAIN][entry.entry_id]
 
-    async_add_entities([
-        YanziSwitch(location, device, source)
-        for device, source in location.device_sources
-        if source['variableName'] in SWITCH_VARIABLE_NAMES
-    ])
+    @callback
+    def add_sources(device_sources):
+        async_add_entities([
+            YanziSwitch(location, device, source)
+            for device, source in device_sources
+            if source.descriptor.platform == 'switch'
+        ])
+
+    add_sources(location.device_sources)
+    entry.async_on_unload(async_dispatcher_connect(
+        hass, SIGNAL_NEW_SOURCES.format(entry.entry_id), add_sources))
 
 
 class YanziSwitch(SwitchEntity, YanziEntity):
     @property
     def is_on(self):
-        vn = self.source['variableName']
-        l = self.source['latest']
-
-        if l is None:
+        latest = self.source.latest
+        if latest is None:
             return None
 
-        if vn == 'onOffOutput':
-            return l['value']['name'] == 'on'
+        return self.source.value(latest)
 
     @property
     def state_attributes(self):
-        return self.source['latest']
+        return self.source.latest
 
     async def async_turn_on(self, **kwargs):
         """Turn the entity on."""
         self.location.control_request_binary(
-            self.source['did'], self.source['variableName'], 'onn')
+            self.source.did, self.source.variable_name, 'onn')
 
     async def async_turn_off(self, **kwargs):
         """Turn the entity off."""
         self.location.control_request_binary(
-            self.source['did'], self.source['variableName'], 'off')
+            self.source.did, self.source.variable_name, 'off')
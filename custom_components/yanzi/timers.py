@@ -0,0 +1,120 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    '''One timer for many deadlines.
+
+    Each key has at most one deadline (wall clock seconds). Scheduling a key
+    again moves its deadline, and its callback is called once when the
+    deadline passes. Deadlines live in a heap with lazy deletion, and a
+    single loop timer is armed for the earliest one.
+    '''
+
+    def __init__(self):
+        self._deadlines = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_deadline = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline, callback):
+        '''Call `callback()` at `deadline`, replacing any earlier deadline for `key`.'''
+        seq = next(self._counter)
+        self._deadlines[key] = (deadline, seq, callback)
+        heapq.heappush(self._heap, (deadline, seq, key))
+
+        if len(self._heap) > 4 * len(self._deadlines) + 64:
+            self._compact()
+
+        self._arm()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def clear(self):
+        self._deadlines.clear()
+        self._heap.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+
+    def _compact(self):
+        self._heap = [(deadline, seq, key)
+                      for key, (deadline, seq, _) in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def _arm(self):
+        while self._heap:
+            deadline, seq, key = self._heap[0]
+            current = self._deadlines.get(key)
+            if current is not None and current[1] == seq:
+                break
+            heapq.heappop(self._heap)
+        else:
+            return
+
+        if self._timer_deadline is not None and self._timer_deadline <= deadline:
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+
+        self._timer_deadline = deadline
+        self._timer = asyncio.get_running_loop().call_later(
+            max(0, deadline - time.time()), self._run)
+
+    def _run(self):
+        self._timer = None
+        self._timer_deadline = None
+
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(self._heap)
+            current = self._deadlines.get(key)
+            if current is None or current[1] != seq:
+                continue
+
+            del self._deadlines[key]
+            try:
+                current[2]()
+            except Exception:
+                log.exception('Error in expiry callback for %s', key)
+
+        self._arm()
+
+
+class Backoff:
+    '''Delays between reconnection attempts.
+
+    The first retry is immediate, after that the delay doubles from `base`
+    up to `cap` seconds. Each delay is randomized by up to `jitter` of its
+    length so that many clients don't retry in step.
+    '''
+
+    def __init__(self, base=1, cap=300, jitter=0.5):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self):
+        attempt, self.attempt = self.attempt, self.attempt + 1
+        if attempt == 0:
+            return 0
+
+        delay = min(self.cap, self.base * 2 ** (attempt - 1))
+        return delay - random.uniform(0, delay * self.jitter)
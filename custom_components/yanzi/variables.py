@@ -0,0 +1,138 @@
+import logging
+import struct
+import time
+
+from operator import itemgetter
+
+from .const import MOTION_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+DIAGNOSTIC = 'diagnostic'
+
+UP_STATES = ['up', 'goingUp']
+
+
+class VariableDescriptor:
+    '''How the samples of a Yanzi variable are turned into entity state.
+
+    `value` extracts the state from a sample dict, by default its 'value'.
+    `unit` overrides the unit derived from the source's siUnit. `platform`
+    is the entity platform that creates entities for the variable, or None
+    to ignore it. If given, `attributes` decodes the state attributes of a
+    sample once when it arrives, otherwise the sample itself is used.
+    Numeric variables with `aggregate` get min/mean/max sensors if enabled.
+    '''
+
+    __slots__ = ('value', 'attributes', 'platform', 'unit', 'device_class', 'state_class',
+                 'entity_category', 'enabled_default', 'should_poll', 'aggregate')
+
+    def __init__(self, value=None, attributes=None, platform='sensor', unit=None, device_class=None,
+                 state_class='measurement', entity_category=None, enabled_default=True, should_poll=False,
+                 aggregate=False):
+        self.value = value
+        self.attributes = attributes
+        self.platform = platform
+        self.unit = unit
+        self.device_class = device_class
+        self.state_class = state_class
+        self.entity_category = entity_category
+        self.enabled_default = enabled_default
+        self.should_poll = should_poll
+        self.aggregate = aggregate
+
+
+def describe(variable_name):
+    '''The descriptor of a variable, with a generic one for unknown variables.'''
+    descriptor = VARIABLES.get(variable_name)
+    if descriptor is None:
+        descriptor = VARIABLES[variable_name] = VariableDescriptor(_default_value(variable_name))
+    return descriptor
+
+
+def _default_value(variable_name):
+    def value(sample):
+        if 'value' in sample:
+            return sample['value']
+        return sample.get(variable_name)
+    return value
+
+
+def _motion(sample):
+    return sample['timeLastMotion'] / 1000 > time.time() - MOTION_TIMEOUT
+
+
+def _up(sample):
+    return sample['deviceUpState']['name'] in UP_STATES
+
+
+# Mesh statistics of a unit, grabbed from pan, not sure if still correct...
+# uint8_t version;
+# uint8_t parent_rssi; /* version > 0: Parent RSSI */
+# uint16_t parent_switches; /* Number of parent switches */
+# uint32_t parent_time; /* Time since last parent switch (seconds) */
+# uint8_t parent[8]; /* 8 right most bytes of parent IP address*/
+# uint16_t parent_rank; /* Rank of the parent */
+# uint16_t parent_metric; /* Link metric to the parent */
+# uint8_t free_routes;    /* version > 0: Number of free routes */
+# uint8_t free_neighbors; /* version > 0: Number of free neighbors */
+# uint8_t reserved_future[10];
+STATISTICS = struct.Struct('BBHIBBBBBBBBHHBBBBBBBBBBBB')
+
+
+def _statistics(sample):
+    try:
+        res = STATISTICS.unpack(bytes.fromhex(sample['value']))
+    except (KeyError, TypeError, ValueError, struct.error) as e:
+        log.debug('Failed to decode statistics %s: %s', sample, e)
+        return None
+
+    return {
+        'version': res[0],
+        'parent_rssi': res[1],
+        'parent_switches': res[2],
+        'parent_time': res[3],
+        'parent': res[4:12],
+        'parent_rank': res[12],
+        'parent_metric': res[13],
+        'free_routes': res[14],
+        'free_neighbors': res[15],
+        'reserved_future': res[16:]
+    }
+
+
+VARIABLES = {
+    'temperatureC': VariableDescriptor(device_class='temperature', aggregate=True),
+    'temperatureK': VariableDescriptor(device_class='temperature', aggregate=True),
+    'dewPoint': VariableDescriptor(device_class='temperature', aggregate=True),
+    'relativeHumidity': VariableDescriptor(device_class='humidity', aggregate=True),
+    'carbonDioxide': VariableDescriptor(device_class='carbon_dioxide', aggregate=True),
+    'volatileOrganicCompound': VariableDescriptor(device_class='volatile_organic_compounds', aggregate=True),
+    'pressure': VariableDescriptor(device_class='pressure', aggregate=True),
+    'illuminance': VariableDescriptor(device_class='illuminance', aggregate=True),
+    'battery': VariableDescriptor(
+        lambda sample: int(sample['percentFull']), unit='%', device_class='battery',
+        entity_category=DIAGNOSTIC, should_poll=True),
+    'soundPressureLevel': VariableDescriptor(itemgetter('max'), aggregate=True),
+    'totalPowerInst': VariableDescriptor(itemgetter('instantPower'), device_class='power', aggregate=True),
+    # seconds -> hours, millis -> kilo
+    'totalEnergy': VariableDescriptor(
+        lambda sample: sample['totalEnergy'] / (3600 * 1000),
+        device_class='energy', state_class='total_increasing'),
+    'up': VariableDescriptor(lambda sample: sample['deviceUpState']['name']),
+    'positionLog': VariableDescriptor(
+        itemgetter('longitude', 'latitude'), entity_category=DIAGNOSTIC, enabled_default=False),
+    'statistics': VariableDescriptor(
+        attributes=_statistics, entity_category=DIAGNOSTIC, enabled_default=False),
+    'siteOnlineStatus': VariableDescriptor(device_class='connectivity', entity_category=DIAGNOSTIC),
+    'upsState': VariableDescriptor(device_class='battery', enabled_default=False),
+    'motion': VariableDescriptor(_motion, platform='binary_sensor', device_class='motion'),
+    'uplog': VariableDescriptor(
+        _up, platform='binary_sensor', device_class='connectivity', entity_category=DIAGNOSTIC),
+    'onOffOutput': VariableDescriptor(lambda sample: sample['value']['name'] == 'on', platform='switch'),
+    'onOffTransition': VariableDescriptor(platform=None),
+}
+
+for variable_name, descriptor in VARIABLES.items():
+    if descriptor.value is None:
+        descriptor.value = _default_value(variable_name)
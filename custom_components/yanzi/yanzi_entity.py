@@ -1,7 +1,9 @@
 import logging
+from homeassistant.core import callback
 from homeassistant.helpers.entity import Entity, EntityCategory
 
-from .const import DOMAIN
+from .inventory import source_id
+from .variables import UP_STATES
 
 log = logging.getLogger(__name__)
 
@@ -12,33 +14,57 @@ class YanziEntity(Entity):
         self.device = device
         self.source = source
 
-    async def async_added_to_hass(self):
-        log.debug('async_added_to_hass %s', self.source['key'])
-
-        async def filter_data(event):
-            if event.data['key'] == self.source['key']:
-                self.source['latest'] = event.data['sample']
-
-                if self.source['variableName'] == 'uplog':
-                    upState = self.source['latest']['deviceUpState']['name']
-
-                    if upState in ['goingUp', 'up']:
-                        self.device['lifeCycleState'] = 'present'
-                    else:
-                        self.device['lifeCycleState'] = 'shadow'
-
-                await self.async_update_ha_state()
-                await self.on_sample(self.source['latest'])
+        # Everything that only depends on the variable is resolved once here.
+        self.descriptor = source.descriptor
+        self._entity_category = EntityCategory(self.descriptor.entity_category) \
+            if self.descriptor.entity_category else None
 
-        await self.async_update()
-        await self.async_update_ha_state()
-        self.hass.bus.async_listen('yanzi_data', filter_data)
-
-    async def on_sample(self, sample):
+    async def async_added_to_hass(self):
+        log.debug('async_added_to_hass %s', self.source.key)
+
+        self.async_write_ha_state()
+        if self.source.latest is None:
+            # Don't hold up adding the entity while waiting for a connection.
+            self.hass.async_create_task(self.async_update_ha_state(True))
+        else:
+            self.on_sample(self.source.latest)
+        self.async_on_remove(self.location.dispatcher.subscribe(
+            self.source.sample_key, self._handle_sample,
+            self.location.coalesce_intervals.get(self.source.variable_name)))
+        self.async_on_remove(self.location.inventory.listeners.subscribe(
+            source_id(self.source), self._handle_inventory_update))
+
+    @callback
+    def _handle_inventory_update(self, source):
+        self.async_write_ha_state()
+
+    @callback
+    def _handle_sample(self, sample):
+        self.source.latest = sample
+
+        if self.source.variable_name == 'uplog':
+            upState = sample['deviceUpState']['name']
+
+            if upState in UP_STATES:
+                self.device.life_cycle_state = 'present'
+            else:
+                self.device.life_cycle_state = 'shadow'
+
+        self.async_write_ha_state()
+        self.on_sample(sample)
+
+    @callback
+    def on_sample(self, sample):
         pass
 
     async def async_update(self):
-        self.source['latest'] = await self.location.get_latest(self.source['did'], self.source['variableName'])
+        if self.source.sample_variable is None:
+            # Derived from several variables, see DerivedVariables.
+            return
+
+        self.source.latest = await self.location.get_latest(self.source.did, self.source.sample_variable)
+        if self.source.latest is not None:
+            self.on_sample(self.source.latest)
 
     @property
     def should_poll(self):
@@ -46,101 +72,30 @@ class YanziEntity(Entity):
 
     @property
     def unique_id(self):
-        return self.source['key']
+        return self.source.key
 
     @property
     def name(self):
-        return self.source['name'] + ' ' + self.source['variableName']
+        return self.source.name + ' ' + self.source.variable_name
 
     @property
     def device_info(self):
-        return {
-            'identifiers': {(DOMAIN, self.device['key']), (DOMAIN, self.device['unitAddress']['did'])},
-            'name': self.device['name'],
-            'manufacturer': 'Yanzi Networks',
-            'model': DEVICE_MODELS.get(self.device['productType'], self.device['productType']),
-            'sw_version': self.device['version'],
-            'suggested_area': (self.device.get('assetParent', {}) or {}).get('name'),
-            'via_device': (DOMAIN, self.device['unitAddress']['serverDid']),
-        }
+        return self.device.device_info
 
     @property
     def available(self):
-        return self.device['lifeCycleState'] != 'shadow'
+        if self.source.removed:
+            return False
+        return self.device.life_cycle_state != 'shadow'
 
     @property
     def device_class(self):
-        vn = self.source['variableName']
-        return DEVICE_CLASSES.get(vn)
+        return self.descriptor.device_class
 
     @property
     def entity_category(self):
-        if self.source['variableName'] in ['uplog', 'battery', 'statistics', 'positionLog', 'siteOnlineStatus']:
-            return EntityCategory.DIAGNOSTIC
+        return self._entity_category
 
     @property
     def entity_registry_enabled_default(self):
-        if self.source['variableName'] in ['statistics', 'positionLog', 'upsState']:
-            return False
-        return True
-
-
-DEVICE_CLASSES = {
-    'temperatureC': 'temperature',
-    'temperatureK': 'temperature',
-    'relativeHumidity': 'humidity',
-    'carbonDioxide': 'carbon_dioxide',
-    'volatileOrganicCompound': 'volatile_organic_compounds',
-    'pressure': 'pressure',
-    'illuminance': 'illuminance',
-    'battery': 'battery',
-    'totalpowerInst': 'power',
-    'totalEnergy': 'energy',
-    'motion': 'motion',
-    'uplog': 'connectivity',
-    'siteOnlineStatus': 'connectivity',
-    'upsState': 'battery',
-}
-
-DEVICE_MODELS = {
-    '0090DA03010104A3': 'Yanzi LED',
-    '0090DA03010104A1': 'Yanzi LED',
-    '0090DA03010104B0': 'Yanzi Motion',
-    '0090DA03010104A0': 'Yanzi Climate',
-    '0090DA03010104D0': 'Yanzi Distance',
-    '0090DA03010104D3': 'Yanzi Distance',
-    '0090DA03010104D4': 'Yanzi Distance',
-    '0090DA0301010491': 'Yanzi Plug',
-    '0090DA0301010492': 'Yanzi Plug',
-    '0090DA03010104C1': 'Yanzi Air',
-    '0090DA03010104A5': 'Yanzi Light',
-    '0090DA0301010510': 'Yanzi Decibel',
-    '0090DA0301020422': 'Yanzi Gateway',
-    '0090DA0301020421': 'Yanzi Gateway',
-    '0090DA0301020423': 'Yanzi Gateway',
-    '0090DA0301020424': 'Yanzi Gateway',
-    '0090DA0301010521': 'Yanzi Motion+',
-    '0090DA0301010522': 'Yanzi Comfort',
-    '0090DA0301010523': 'Yanzi Climate+',
-    '0090DA0301010524': 'Yanzi Presence',
-    '0090DA0301028030': 'Axis Camera 1',
-    '0090DA0301028002': 'Axis Camera 2',
-    '0090DA0301028021': 'Sercom Camera',
-    '0090DA0301020010': 'IoT Access Point',
-    '0090DA0301020011': 'IoT Access Point',
-    '0090DA0301020012': 'IoT Access Point',
-    '0090DA0302010014': 'Border Router',
-    '0090DA0301088010': 'Footfall Camera',
-    '0090DA03010104D5': 'Katrin Towel Dispenser',
-    '0090DA03010104D6': 'Katrin Hand Towel M Dispenser',
-    '0090DA03010104D7': 'Katrin Toilet Dispenser',
-    '0090DA03010104D9': 'Katrin Soap 1000 Dispenser',
-    '0090DA03010104D8': 'Katrin Soap 1000 Dispenser',
-    '0090DA03010104DB': 'Katrin Towel Dispenser',
-    '0090DA03010104DC': 'Katrin Smart Hand Towel M',
-    '0090DA0301038031': 'Carlo Gavassi EM24',
-    '0090DA0301048052': 'CG Modbus Ethernet SIU',
-    '0090DA0301038041': 'Humidity MODBUS',
-    '0090DA0301010532': 'Yanzi Presence Mini',
-    '0090DA0301010502': 'Yanzi IoT Mesh',
-}
+        return self.descriptor.enabled_default